@@ -115,7 +115,33 @@ class PanopticServer:
             await self._emit_client_state(connection_id)
             await self._emit_server_state()
 
+        @self.sio.event
+        async def pause_task(sid, key: str):
+            project = self._get_sid_project(sid)
+            if project:
+                project.task_queue.pause(key)
+
+        @self.sio.event
+        async def resume_task(sid, key: str):
+            project = self._get_sid_project(sid)
+            if project:
+                project.task_queue.resume(key)
 
+        @self.sio.event
+        async def cancel_task(sid, key: str):
+            project = self._get_sid_project(sid)
+            if project:
+                project.task_queue.cancel(key)
+
+    def _get_sid_project(self, sid: str):
+        """
+        Project the client of the socket is connected to
+        """
+        connection_id = self.sid_to_connection_id.get(sid)
+        state = self.client_states.get(connection_id)
+        if state is None or state.connected_project is None:
+            return None
+        return self.panoptic.open_projects.get(state.connected_project)
 
     async def connect_user(self, connection_id: str, user_id: int):
         if user_id not in self.users:
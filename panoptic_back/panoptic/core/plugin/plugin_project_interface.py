@@ -1,6 +1,8 @@
 from __future__ import annotations
 
-from typing import TYPE_CHECKING, Callable, Awaitable
+from typing import TYPE_CHECKING, Callable, Awaitable, AsyncIterable
+
+import numpy as np
 
 from panoptic.core.task.task import Task
 
@@ -51,6 +53,13 @@ class PluginProjectInterface:
     async def get_vectors(self, type_id: int, sha1s: list[str] = None):
         return await self._project.db.get_vectors(type_id, sha1s)
 
+    async def get_vector_matrix(self, type_id: int):
+        """
+        sha1 of each row and a read-only view on all the vectors of the type as one float32 matrix, without copy
+        unless the type is stored with a reduced precision (params['precision'] 'float16' or 'int8')
+        """
+        return await self._project.db.get_vector_matrix(type_id)
+
     async def get_vector_types(self, source: str = None):
         return await self._project.db.get_vector_types(source=source)
 
@@ -133,6 +142,19 @@ class PluginProjectInterface:
     async def add_vector(self, vector: Vector):
         res = await self._project.db.add_vector(vector)
 
+    async def add_vectors(self, type_id: int, sha1s: list[str], matrix: np.ndarray):
+        """
+        Adds the vectors of many images at once, one row of the float32 matrix per sha1
+        """
+        return await self._project.db.add_vectors(type_id, sha1s, matrix)
+
+    async def add_vectors_stream(self, type_id: int, batches: AsyncIterable[tuple[list[str], np.ndarray]]):
+        """
+        Adds the (sha1s, matrix) batches given by an async iterator, the storage of a batch runs while the
+        next one is computed
+        """
+        return await self._project.db.add_vectors_stream(type_id, batches)
+
 
     # =====================================================
     # ======================= MAPS ========================
@@ -0,0 +1,92 @@
+import asyncio
+import atexit
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, Executor
+from concurrent.futures.process import BrokenProcessPool
+
+from panoptic.models import ProjectSettings
+
+# settings of the current worker process, sent once when the worker starts
+_worker_settings: ProjectSettings | None = None
+# pools broken in a row, without a result in between, before the imports stay on threads
+max_pool_failures = 3
+
+
+def _init_worker(settings: ProjectSettings):
+    global _worker_settings
+    _worker_settings = settings
+
+
+def _run_in_worker(function, *args):
+    return function(*args, _worker_settings)
+
+
+class ImportPool:
+    """
+    Process pool decoding and encoding the imported images.
+    Functions are called with the file arguments and the project settings the workers were started with.
+    A broken pool, like a worker killed by a corrupt image, is replaced and the calls it lost run on the thread
+    executor of the project. Threads are used for good once pools keep breaking
+    """
+    def __init__(self, fallback: Executor, workers: int = 0):
+        self.fallback = fallback
+        self.workers = workers or os.cpu_count()
+        self._settings: ProjectSettings | None = None
+        self._pool: ProcessPoolExecutor | None = None
+        self._failures = 0
+        self._broken = False
+        atexit.register(self.shutdown)
+
+    def set_settings(self, settings: ProjectSettings):
+        """
+        The workers are restarted on next use if the settings or the worker count changed
+        """
+        workers = settings.import_workers or os.cpu_count()
+        if self._settings == settings and self.workers == workers:
+            return
+        self._settings = settings
+        self.workers = workers
+        self.shutdown()
+
+    def _get_pool(self):
+        if self._pool is None:
+            # a forked worker can inherit a lock held by another thread of the server and never start
+            self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'),
+                                             initializer=_init_worker, initargs=(self._settings,))
+        return self._pool
+
+    async def run(self, function, *args):
+        """
+        Runs function(*args, settings) in a worker process
+        """
+        if not self._broken:
+            pool = None
+            try:
+                pool = self._get_pool()
+                res = await asyncio.wrap_future(pool.submit(_run_in_worker, function, *args))
+                self._failures = 0
+                return res
+            except (BrokenProcessPool, OSError) as e:
+                self._pool_failed(pool, e)
+        future = self.fallback.submit(function, *args, self._settings)
+        return await asyncio.wrap_future(future)
+
+    def _pool_failed(self, pool: ProcessPoolExecutor | None, error: Exception):
+        # every call running on the pool fails with it, it is only counted once
+        if pool is not None and pool is not self._pool:
+            return
+        self.shutdown()
+        self._failures += 1
+        if self._failures >= max_pool_failures:
+            logging.warning(f'Import process pool failed {self._failures} times, using threads: {error}')
+            self._broken = True
+        else:
+            logging.warning(f'Import process pool broken, starting a new one: {error}')
+
+    def shutdown(self):
+        if self._pool is not None:
+            # images already submitted finish with the previous settings
+            self._pool.shutdown(wait=False)
+            self._pool = None
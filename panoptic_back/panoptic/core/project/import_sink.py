@@ -0,0 +1,159 @@
+from __future__ import annotations
+
+import asyncio
+from dataclasses import dataclass
+from typing import TYPE_CHECKING
+
+from panoptic.models import Instance, DbCommit
+
+if TYPE_CHECKING:
+    from panoptic.core.project.project import Project
+
+# number of imported instances written in the same commit
+import_batch_size = 200
+# longest time an imported instance waits for its batch to be written, in seconds
+import_batch_delay = 0.2
+
+
+@dataclass(slots=True)
+class ImportedInstance:
+    instance: Instance
+    # small, medium, large thumbnails. None for a file already in the project
+    thumbnails: tuple[bytes, bytes, bytes] | None = None
+    raw: tuple[str, bytes] | None = None
+    # (size, mtime_ns, inode) of the file when it was read
+    fingerprint: tuple[int, int, int] | None = None
+    future: asyncio.Future | None = None
+
+
+class ImportSink:
+    """
+    Collects the instances decoded by the import tasks and writes them by batches:
+    one bulk image insert, one DbCommit and one import event per batch.
+    The instances and their file fingerprints are written in the same transaction
+    """
+    def __init__(self, project: Project):
+        self._project = project
+        self._pending: list[ImportedInstance] = []
+        self._timer: asyncio.TimerHandle | None = None
+        self._flush_lock = asyncio.Lock()
+        self._flush_tasks: set[asyncio.Task] = set()
+
+    async def add(self, instance: Instance, thumbnails: tuple[bytes, bytes, bytes] | None = None,
+                  raw: tuple[str, bytes] | None = None, fingerprint: tuple[int, int, int] | None = None) -> Instance:
+        """
+        Queues an instance and waits for its batch to be written. Returns the instance with its id
+        """
+        loop = asyncio.get_running_loop()
+        imported = ImportedInstance(instance, thumbnails, raw, fingerprint, loop.create_future())
+        self._pending.append(imported)
+        if len(self._pending) >= import_batch_size:
+            self._start_flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(import_batch_delay, self._start_flush)
+        return await imported.future
+
+    def _start_flush(self):
+        task = asyncio.create_task(self.flush())
+        self._flush_tasks.add(task)
+        task.add_done_callback(self._flush_tasks.discard)
+
+    async def flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+        # batches are written in the order they were filled
+        async with self._flush_lock:
+            try:
+                instances = await self._write(batch)
+            except Exception as e:
+                for imported in batch:
+                    if not imported.future.done():
+                        imported.future.set_exception(e)
+                return
+        for imported, instance in zip(batch, instances):
+            if not imported.future.done():
+                imported.future.set_result(instance)
+
+    async def _write(self, batch: list[ImportedInstance]) -> list[Instance]:
+        db = self._project.db
+        new = [i for i in batch if i.thumbnails is not None]
+
+        await self._write_images(new)
+
+        if new:
+            commit = DbCommit(instances=[i.instance for i in new])
+            async with db.transaction():
+                await db.apply_commit(commit)
+                await db.set_file_fingerprints([(i.instance.id, *i.fingerprint) for i in new if i.fingerprint])
+            for instance in commit.instances:
+                self._project.sha1_to_files[instance.sha1].append(instance.url)
+            self._project.ui.commits.append(commit)
+
+        instances = [i.instance for i in batch]
+        db.on_import_instances.emit(instances)
+        return instances
+
+    async def _write_images(self, batch: list[ImportedInstance]):
+        db = self._project.db
+        thumbnails = {}
+        raws = {}
+        for imported in batch:
+            sha1 = imported.instance.sha1
+            if sha1 not in thumbnails and not await db.has_image(sha1):
+                thumbnails[sha1] = (sha1, *imported.thumbnails)
+            if imported.raw is not None:
+                raws[sha1] = (sha1, *imported.raw)
+        if thumbnails:
+            await db.images.import_images(list(thumbnails.values()))
+        if raws:
+            await db.images.import_raw_images(list(raws.values()))
+
+    async def update(self, instance: Instance, thumbnails: tuple[bytes, bytes, bytes],
+                     raw: tuple[str, bytes] | None = None, fingerprint: tuple[int, int, int] | None = None):
+        """
+        Writes the new content of a modified file without batching, the instance keeps its id.
+        The write goes on if the import task is cancelled
+        """
+        task = asyncio.create_task(self._update(instance, thumbnails, raw, fingerprint))
+        self._flush_tasks.add(task)
+        task.add_done_callback(self._flush_tasks.discard)
+        return await asyncio.shield(task)
+
+    async def _update(self, instance: Instance, thumbnails: tuple[bytes, bytes, bytes],
+                      raw: tuple[str, bytes] | None, fingerprint: tuple[int, int, int] | None):
+        db = self._project.db
+        imported = ImportedInstance(instance, thumbnails, raw, fingerprint)
+        async with self._flush_lock:
+            old = await db.get_instances(ids=[instance.id])
+            await self._write_images([imported])
+            async with db.transaction():
+                await db.update_instance_files([instance])
+                if fingerprint:
+                    await db.set_file_fingerprints([(instance.id, *fingerprint)])
+
+        sha1_to_files = self._project.sha1_to_files
+        for previous in old:
+            if instance.url in sha1_to_files.get(previous.sha1, []):
+                sha1_to_files[previous.sha1].remove(instance.url)
+                if not sha1_to_files[previous.sha1]:
+                    del sha1_to_files[previous.sha1]
+        sha1_to_files[instance.sha1].append(instance.url)
+        commit = DbCommit(instances=[instance])
+        self._project.ui.commits.append(commit)
+        # other clients receive the new sha1 of the instance like for a batch
+        self._project.on.sync.emitCommit(commit)
+        db.on_import_instances.emit([instance])
+        return instance
+
+    async def close(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        for imported in self._pending:
+            imported.future.cancel()
+        self._pending = []
+        await asyncio.gather(*self._flush_tasks, return_exceptions=True)
@@ -1,5 +1,7 @@
 import asyncio
 import atexit
+import hashlib
+import logging
 import os
 from collections import defaultdict
 from concurrent.futures import ThreadPoolExecutor
@@ -8,6 +10,8 @@ from typing import List, Any
 
 from showinfm import show_in_file_manager
 
+from panoptic.core.project.import_pool import ImportPool
+from panoptic.core.project.import_sink import ImportSink
 from panoptic.core.project.project_paths import ProjectPaths
 from panoptic.core.project_db.db_connection import DbConnection
 from panoptic.core.exporter import Exporter
@@ -18,20 +22,31 @@ from panoptic.core.project.project_actions import ProjectActions
 from panoptic.core.project_db.project_db import ProjectDb
 from panoptic.core.project.project_events import ProjectEvents
 from panoptic.core.project.project_ui import ProjectUi
+from panoptic.core.task.build_vector_index_task import BuildVectorIndexTask
 from panoptic.core.task.generate_atlas_task import GenerateAtlasTask
 from panoptic.core.task.import_folder_task import ImportFolderTask
 from panoptic.core.task.import_image_task import ImportImageTask
 from panoptic.core.task.import_instance_task import ImportInstanceTask
 from panoptic.core.task.load_plugin_task import LoadPluginTask
+from panoptic.core.task.task import Task
 from panoptic.core.task.task_queue import TaskQueue
-from panoptic.models import ProjectSettings, PluginKey, DbCommit, ProjectState, TaskState
+from panoptic.models import ProjectSettings, PluginKey, DbCommit, ProjectState, TaskState, Instance
 
 nb_workers = 8
 folder_import_seq = 1
+# tasks saved in the project DB and created again if the project stops before they finished
+restorable_tasks = {t.__name__: t for t in [ImportFolderTask, ImportInstanceTask, ImportImageTask, GenerateAtlasTask,
+                                             BuildVectorIndexTask]}
 
 image_data_folder = 'image_data'
 atlas_folder = 'atlas'
 
+def get_image_version(settings: ProjectSettings):
+    sizes = [settings.image_small_size, settings.image_medium_size, settings.image_large_size,
+             settings.save_image_small, settings.save_image_medium, settings.save_image_large, settings.save_file_raw]
+    return hashlib.sha1(str(sizes).encode()).hexdigest()[:10]
+
+
 def get_executor():
     executor = ThreadPoolExecutor(max_workers=nb_workers)
     atexit.register(executor.shutdown)
@@ -44,6 +59,8 @@ class Project:
         self.name = name
         self._load_task = None
         self.executor = get_executor()
+        self.import_pool = ImportPool(self.executor)
+        self.import_sink = ImportSink(self)
         self.is_loaded = False
         self.base_path = folder_path
         self.paths = ProjectPaths(Path(folder_path))
@@ -56,8 +73,11 @@ class Project:
         self.importer = Importer(project=self)
         self.exporter = Exporter(project=self)
         self.sha1_to_files: dict[str, list[str]] = defaultdict(list)
+        self.atlas_lock = asyncio.Lock()
 
         self.settings = ProjectSettings()
+        # changes with the thumbnail settings, part of the image urls and ETags
+        self.image_version = get_image_version(self.settings)
 
         self.plugin_loaded = False
         self.plugins: List[APlugin] = []
@@ -70,15 +90,24 @@ class Project:
 
     async def start(self):
         self.paths.create_paths()
-        conn = DbConnection(self.base_path)
+        # the read pool is opened once the settings are known
+        conn = DbConnection(self.base_path, readers=0)
         await conn.start()
         self.db = ProjectDb(conn, self)
+        await self._load_settings()
+        await conn.set_readers(self.settings.db_readers)
+        self.import_pool.set_settings(self.settings)
+        self._set_task_limits(self.settings)
+        await self.db.start()
+        self.db.images.cache.set_budget(self.settings.image_cache_size * 1024 * 1024)
         self.ui = ProjectUi(self.db)
 
         self.db.on_import_instance.redirect(self.on.import_instance)
+        self.db.on_import_instances.register(self._emit_imported_instances)
 
+        restored = await self.task_queue.restore(restorable_tasks)
         # avoid blocking response for UI on longer loads
-        self._load_task = asyncio.create_task(self._parallel_load())
+        self._load_task = asyncio.create_task(self._parallel_load(restored))
 
 
         for key in self.plugin_keys:
@@ -100,9 +129,25 @@ class Project:
     async def wait_full_start(self):
         await self._load_task
 
-    async def _parallel_load(self):
-        await self._load_settings()
+    async def _parallel_load(self, restored: list[Task]):
+        global folder_import_seq
         await self._load_sha1_to_files()
+        # the unfinished tasks of the last run need the files of the project
+        if restored:
+            # new imports don't share the counters of the restored ones
+            folder_import_seq = max(folder_import_seq, max(getattr(t, 'seq', 0) for t in restored) + 1)
+            logging.info(f'Restoring {len(restored)} unfinished tasks')
+        for task in restored:
+            task.on_restore(restored)
+        for task in restored:
+            self.task_queue.add_task(task)
+        await self.db.images.warm_up()
+
+    async def _emit_imported_instances(self, instances: list[Instance]):
+        # import batches are given to the per instance callbacks in a single event task
+        for instance in instances:
+            for callback in self.on.import_instance.callbacks:
+                await callback(instance)
 
     async def redirect_on_import(self, x):
         self.on.import_instance.emit(x)
@@ -110,9 +155,12 @@ class Project:
     async def close(self):
         self.is_loaded = False
         self.base_path = ''
+        self.import_pool.shutdown()
         try:
-            await self.db.close()
+            # the running tasks are stopped before the DB they write to is closed
             await self.task_queue.close()
+            await self.import_sink.close()
+            await self.db.close()
             await self.plugin_watcher.stop()
         except Exception:
             pass
@@ -128,19 +176,34 @@ class Project:
     async def plugins_info(self):
         return [p.get_description() for p in self.plugins]
 
-    async def import_folder(self, folder: str):
+    async def import_folder(self, folder: str, rescan: bool = False):
         global folder_import_seq
         seq = folder_import_seq
         folder_import_seq += 1
 
-        task = ImportFolderTask(seq=seq, folder=folder)
+        task = ImportFolderTask(seq=seq, folder=folder, rescan=rescan)
         self.task_queue.add_task(task)
 
+    def build_vector_index(self, type_id: int):
+        self.task_queue.add_task(BuildVectorIndexTask(type_id))
+
     async def delete_folder(self, folder_id: int):
         res = await self.db.delete_folder(folder_id)
         self.on.delete_folder.emit(res)
         return res
 
+    async def delete_instances(self, ids: list[int]):
+        instances = await self.db.get_instances(ids=ids)
+        res = await self.db.delete_instances(ids)
+        for instance in instances:
+            files = self.sha1_to_files.get(instance.sha1, [])
+            if instance.url in files:
+                files.remove(instance.url)
+            if not files:
+                self.sha1_to_files.pop(instance.sha1, None)
+        self.on.delete_folder.emit(res)
+        return res
+
     async def set_plugin_params(self, plugin_name: str, params: Any):
         plugin = [p for p in self.plugins if p.name == plugin_name]
         if not plugin:
@@ -151,6 +214,11 @@ class Project:
 
     async def _load_settings(self):
         self.settings = await self.db.get_project_settings()
+        self.image_version = get_image_version(self.settings)
+
+    def _set_task_limits(self, settings: ProjectSettings):
+        for kind in ('ImportInstanceTask', 'ImportImageTask'):
+            self.task_queue.set_limit(kind, settings.import_tasks)
 
     async def _load_sha1_to_files(self):
         async for row in self.db.stream_instance_sha1_and_url():
@@ -216,8 +284,15 @@ class Project:
         if delete_raw:
             await self.db.delete_raw_images()
 
+        if settings.db_readers != self.settings.db_readers:
+            await self.db.set_db_readers(settings.db_readers)
+        self.db.images.cache.set_budget(settings.image_cache_size * 1024 * 1024)
+
         await self.db.set_project_settings(settings)
         self.settings = settings
+        self.image_version = get_image_version(settings)
+        self.import_pool.set_settings(settings)
+        self._set_task_limits(settings)
 
         if re_import_images:
             sha1s = list(self.sha1_to_files.keys())
@@ -244,7 +319,8 @@ class Project:
             path=self.base_path,
             tasks=tasks,
             plugins=plugins,
-            settings=self.settings)
+            settings=self.settings,
+            image_version=self.image_version)
 
     def add_plugin(self, plugin: APlugin):
         self.plugins.append(plugin)
@@ -1,6 +1,6 @@
 from typing import Callable, Awaitable
 
-from panoptic.models import Instance, DeleteFolderConfirm, DbUpdate, ProjectState, SyncData, DbCommit, Folder, \
+from panoptic.models import Instance, DeleteFolderConfirm, FolderChanges, DbUpdate, ProjectState, SyncData, DbCommit, Folder, \
     PropertyGroup, VectorType, TaskState, ProjectSettings, Map, ImageAtlas
 from panoptic.utils import EventListener
 
@@ -13,6 +13,14 @@ class ImportInstanceEvent(EventListener):
         super().emit(event)
 
 
+class ImportInstancesEvent(EventListener):
+    def register(self, callback: Callable[[list[Instance]], Awaitable[None]]):
+        super().register(callback)
+
+    def emit(self, event: list[Instance]):
+        super().emit(event)
+
+
 class DeletedFolderEvent(EventListener):
     def register(self, callback: Callable[[DeleteFolderConfirm], Awaitable[None]]):
         super().register(callback)
@@ -21,6 +29,14 @@ class DeletedFolderEvent(EventListener):
         super().emit(event)
 
 
+class FolderRescanEvent(EventListener):
+    def register(self, callback: Callable[[FolderChanges], Awaitable[None]]):
+        super().register(callback)
+
+    def emit(self, event: FolderChanges):
+        super().emit(event)
+
+
 class DbUpdateEvent(EventListener):
     def register(self, callback: Callable[[DbUpdate], Awaitable[None]]):
         super().register(callback)
@@ -72,4 +88,5 @@ class ProjectEvents:
     def __init__(self, project_id: int):
         self.import_instance = ImportInstanceEvent()
         self.delete_folder = DeletedFolderEvent()
+        self.rescan_folder = FolderRescanEvent()
         self.sync = SyncEvent(project_id=project_id)
@@ -6,15 +6,36 @@ class ProjectPaths:
         self.root = root
         self.image_data = root / "image_data"
         self.atlas = self.image_data / "atlas"
+        self.packs = self.image_data / "packs"
+        self.vectors = root / "vectors"
 
     def create_paths(self):
         if not self.image_data.exists():
             self.image_data.mkdir()
         if not self.atlas.exists():
             self.atlas.mkdir()
+        if not self.packs.exists():
+            self.packs.mkdir()
+        if not self.vectors.exists():
+            self.vectors.mkdir()
 
     def get_atlas_path(self, atlas_id: int) -> Path:
         return self.atlas / str(atlas_id)
 
     def get_atlas_sheet_path(self, atlas_id: int, sheet_nb: int) -> Path:
-        return self.get_atlas_path(atlas_id) / f'atlas_{sheet_nb}.png'
\ No newline at end of file
+        return self.get_atlas_path(atlas_id) / f'atlas_{sheet_nb}.png'
+
+    def get_pack_path(self, kind: str, pack_nb: int) -> Path:
+        return self.packs / f'{kind}_{pack_nb}.pack'
+
+    def get_pack_index_path(self, kind: str) -> Path:
+        return self.packs / f'{kind}.index'
+
+    def get_vector_matrix_path(self, type_id: int) -> Path:
+        return self.vectors / f'{type_id}.npy'
+
+    def get_vector_index_path(self, type_id: int) -> Path:
+        return self.vectors / f'{type_id}.sha1'
+
+    def get_vector_ann_path(self, type_id: int) -> Path:
+        return self.vectors / f'{type_id}.ivf.npz'
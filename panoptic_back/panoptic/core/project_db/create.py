@@ -287,6 +287,30 @@ def create_atlas_table():
     return query
 
 
+def create_file_fingerprints_table():
+    # no foreign key: instances are written with INSERT OR REPLACE and a cascade would drop the fingerprint
+    query = """
+    CREATE TABLE file_fingerprints (
+        instance_id INTEGER PRIMARY KEY,
+        size INTEGER NOT NULL,
+        mtime_ns INTEGER NOT NULL,
+        inode INTEGER NOT NULL
+    );
+    """
+    return query
+
+
+def create_pending_tasks_table():
+    query = """
+    CREATE TABLE pending_tasks (
+        id INTEGER PRIMARY KEY,
+        kind TEXT NOT NULL,
+        params JSON NOT NULL
+    );
+    """
+    return query
+
+
 tables = {
     'panoptic': create_panoptic_table(),
     'folders': create_folders_table(),
@@ -305,5 +329,7 @@ tables = {
     'property_group': create_property_group_table(),
     'maps': create_map_table(),
     'atlas': create_atlas_table(),
-    'id_counter': create_id_counter_table()
+    'id_counter': create_id_counter_table(),
+    'file_fingerprints': create_file_fingerprints_table(),
+    'pending_tasks': create_pending_tasks_table()
 }
@@ -1,15 +1,18 @@
 # Connexion à la DB SQLite
 from __future__ import annotations
 
-import asyncio
 import io
 import json
 from typing import List
 
+import numpy as np
+
 from pypika import Table, PostgreSQLQuery, Order, functions
 
-from panoptic.core.project_db.db_connection import DbConnection, db_lock
-from panoptic.core.project_db.utils import auto_dict, decode_if_json
+from panoptic.core.project_db.db_connection import DbConnection
+from panoptic.core.project_db.id_allocator import IdAllocator
+from panoptic.core.project_db.vector_precision import default_precision, to_blobs
+from panoptic.core.project_db.utils import auto_dict, decode_if_json, group_keys_by_property
 from panoptic.models import Instance, Vector, VectorDescription, InstanceProperty, ImageProperty, \
     InstancePropertyKey, ImagePropertyKey, PropertyType, PropertyMode, PropertyGroup, VectorType, Map, ImageAtlas
 from panoptic.models import Tag, Property, Folder
@@ -23,14 +26,13 @@ class Db:
             raise Exception('DbConnection is not started. Execute await conn.start() before')
         self.conn = conn
 
-        self._last_instance_id = 0
-        self._last_property_id = 0
-        self._last_tag_id = 0
-
-        self.property_group_id_lock = asyncio.Lock()
+        self._instance_ids = IdAllocator(conn, 'instance', 'instances')
+        self._property_ids = IdAllocator(conn, 'property', 'properties')
+        self._tag_ids = IdAllocator(conn, 'tag', 'tags')
+        self._property_group_ids = IdAllocator(conn, 'property_group', 'property_group')
 
     async def close(self):
-        await self.conn.conn.close()
+        await self.conn.close()
 
     def get_project_path(self):
         return self.conn.folder_path
@@ -39,44 +41,17 @@ class Db:
     # ====================== IDs ==========================
     # =====================================================
 
-    @db_lock
     async def get_new_instance_ids(self, nb: int):
-        last_id = self._last_instance_id
-
-        query = "SELECT id FROM instances ORDER BY id DESC LIMIT 1"
-        cursor = await self.conn.execute_query(query)
-        res = await cursor.fetchone()
-        if res:
-            last_id = res[0]
-        ids = [last_id + i + 1 for i in range(nb)]
-        self._last_instance_id = ids[-1]
-        return ids
+        return await self._instance_ids.get_new_ids(nb)
 
-    @db_lock
     async def get_new_property_ids(self, nb: int):
-        last_id = self._last_property_id
+        return await self._property_ids.get_new_ids(nb)
 
-        query = "SELECT id FROM properties ORDER BY id DESC LIMIT 1"
-        cursor = await self.conn.execute_query(query)
-        res = await cursor.fetchone()
-        if res:
-            last_id = res[0]
-        ids = [last_id + i + 1 for i in range(nb)]
-        self._last_property_id = ids[-1]
-        return ids
-
-    @db_lock
     async def get_new_tag_ids(self, nb: int):
-        last_id = self._last_tag_id
+        return await self._tag_ids.get_new_ids(nb)
 
-        query = "SELECT id FROM tags ORDER BY id DESC LIMIT 1"
-        cursor = await self.conn.execute_query(query)
-        res = await cursor.fetchone()
-        if res:
-            last_id = res[0]
-        ids = [last_id + i + 1 for i in range(nb)]
-        self._last_tag_id = ids[-1]
-        return ids
+    async def get_new_property_group_ids(self, nb: int):
+        return await self._property_group_ids.get_new_ids(nb)
 
     # =====================================================
     # =================== Properties ======================
@@ -108,7 +83,7 @@ class Db:
         query = Query.from_(table).select('*')
         if ids:
             query = query.where(table.id.isin(ids))
-        cursor = await self.conn.execute_query(query.get_sql())
+        cursor = await self.conn.execute_read(query.get_sql())
         rows = await cursor.fetchall()
         if rows:
             properties = [Property(row[0], row[1], PropertyType(row[2]), PropertyMode(row[3]), row[4]) for row in rows]
@@ -121,7 +96,7 @@ class Db:
                 FROM properties
                 WHERE id = ?
             """
-        cursor = await self.conn.execute_query(query, (property_id,))
+        cursor = await self.conn.execute_read(query, (property_id,))
         row = await cursor.fetchone()
         if row:
             return Property(**auto_dict(row, cursor))
@@ -138,14 +113,14 @@ class Db:
 
     async def get_instance_values_count(self):
         query = "SELECT count(*) FROM instance_property_values;"
-        cursor = await self.conn.execute_query(query)
+        cursor = await self.conn.execute_read(query)
         row = await cursor.fetchone()
         if row:
             return row[0]
 
     async def get_image_values_count(self):
         query = "SELECT count(*) FROM image_property_values;"
-        cursor = await self.conn.execute_query(query)
+        cursor = await self.conn.execute_read(query)
         row = await cursor.fetchone()
         if row:
             return row[0]
@@ -161,23 +136,20 @@ class Db:
         if instance_ids:
             query = query.where(values.instance_id.isin(instance_ids))
 
-        cursor = await self.conn.execute_query(query.get_sql())
+        cursor = await self.conn.execute_read(query.get_sql())
         res = [InstanceProperty(**auto_dict(instance, cursor)) for instance in await cursor.fetchall()]
         return res
 
     async def get_instance_property_values_from_keys(self, keys: list[InstancePropertyKey]) \
             -> list[InstanceProperty]:
-
-        chunk_size = 500
+        # one query per property, the ids are passed as a json array and probed on the primary key
+        query = """
+            SELECT * FROM instance_property_values
+            WHERE property_id = ? AND instance_id IN (SELECT value FROM json_each(?))
+        """
         res = []
-        query = 'SELECT * FROM instance_property_values WHERE '
-        chunked_keys = [keys[i:i + chunk_size] for i in range(0, len(keys), chunk_size)]
-
-        for chunk in chunked_keys:
-            conditions = ' OR '.join(['(property_id = ? AND instance_id = ?)'] * len(chunk))
-            full_query = query + conditions
-            params = [p for k in chunk for p in (k.property_id, k.instance_id)]
-            cursor = await self.conn.execute_query(full_query, tuple(params))
+        for property_id, ids in group_keys_by_property(keys, 'instance_id').items():
+            cursor = await self.conn.execute_read(query, (property_id, json.dumps(ids)))
             res.extend([InstanceProperty(**auto_dict(value, cursor)) for value in await cursor.fetchall()])
         return res
 
@@ -188,12 +160,7 @@ class Db:
             ORDER BY property_id, instance_id
         """
 
-        cursor = await self.conn.execute_query(query)
-
-        while True:
-            rows = await cursor.fetchmany(chunk_size)
-            if not rows:
-                break
+        async for rows in self.conn.stream_read(query, chunk_size=chunk_size):
             yield rows
 
     async def stream_image_property_values_raw(self, chunk_size: int):
@@ -203,23 +170,18 @@ class Db:
             ORDER BY property_id, sha1
         """
 
-        cursor = await self.conn.execute_query(query)
-
-        while True:
-            rows = await cursor.fetchmany(chunk_size)
-            if not rows:
-                break
+        async for rows in self.conn.stream_read(query, chunk_size=chunk_size):
             yield rows
 
     async def get_image_values_raw(self):
         query = "SELECT property_id, sha1, value FROM image_property_values;"
-        cursor = await self.conn.execute_query(query)
+        cursor = await self.conn.execute_read(query)
         rows = await cursor.fetchall()
         return rows
 
     async def get_instance_values_raw(self):
         query = "SELECT property_id, instance_id, value FROM instance_property_values;"
-        cursor = await self.conn.execute_query(query)
+        cursor = await self.conn.execute_read(query)
         rows = await cursor.fetchall()
         return rows
 
@@ -234,22 +196,19 @@ class Db:
         if sha1s:
             query = query.where(values.sha1.isin(sha1s))
 
-        cursor = await self.conn.execute_query(query.get_sql())
+        cursor = await self.conn.execute_read(query.get_sql())
         res = [ImageProperty(**auto_dict(image, cursor)) for image in await cursor.fetchall()]
         return res
 
     async def get_image_property_values_from_keys(self, keys: list[ImagePropertyKey]) \
             -> list[ImageProperty]:
-        chunk_size = 500
+        query = """
+            SELECT * FROM image_property_values
+            WHERE property_id = ? AND sha1 IN (SELECT value FROM json_each(?))
+        """
         res = []
-        query = 'SELECT * FROM image_property_values WHERE '
-        chunked_keys = [keys[i:i + chunk_size] for i in range(0, len(keys), chunk_size)]
-
-        for chunk in chunked_keys:
-            conditions = ' OR '.join(['(property_id = ? AND sha1 = ?)'] * len(chunk))
-            full_query = query + conditions
-            params = [p for k in chunk for p in (k.property_id, k.sha1)]
-            cursor = await self.conn.execute_query(full_query, tuple(params))
+        for property_id, sha1s in group_keys_by_property(keys, 'sha1').items():
+            cursor = await self.conn.execute_read(query, (property_id, json.dumps(sha1s)))
             res.extend([ImageProperty(**auto_dict(value, cursor)) for value in await cursor.fetchall()])
         return res
 
@@ -260,7 +219,7 @@ class Db:
         ORDER BY rowid ASC
         LIMIT ?;
         """
-        cursor = await self.conn.execute_query(query, (position, chunk_size))
+        cursor = await self.conn.execute_read(query, (position, chunk_size))
         rows = await cursor.fetchall()
         if rows:
             return [InstanceProperty(**auto_dict(row, cursor)) for row in rows]
@@ -273,7 +232,7 @@ class Db:
         ORDER BY rowid ASC
         LIMIT ?;
         """
-        cursor = await self.conn.execute_query(query, (position, chunk_size))
+        cursor = await self.conn.execute_read(query, (position, chunk_size))
         rows = await cursor.fetchall()
         if rows:
             return [ImageProperty(**auto_dict(row, cursor)) for row in rows]
@@ -290,13 +249,21 @@ class Db:
         return values
 
     async def delete_instance_property_values(self, values: list[InstancePropertyKey]):
-        query = "DELETE FROM instance_property_values WHERE property_id = ? AND instance_id = ?"
-        await self.conn.execute_query_many(query, [(v.property_id, v.instance_id) for v in values])
+        query = """
+            DELETE FROM instance_property_values
+            WHERE property_id = ? AND instance_id IN (SELECT value FROM json_each(?))
+        """
+        groups = group_keys_by_property(values, 'instance_id')
+        await self.conn.execute_query_many(query, [(p, json.dumps(ids)) for p, ids in groups.items()])
         return True
 
     async def delete_image_property_values(self, values: list[ImagePropertyKey]):
-        query = "DELETE FROM image_property_values WHERE property_id = ? AND sha1 = ?"
-        await self.conn.execute_query_many(query, [(v.property_id, v.sha1) for v in values])
+        query = """
+            DELETE FROM image_property_values
+            WHERE property_id = ? AND sha1 IN (SELECT value FROM json_each(?))
+        """
+        groups = group_keys_by_property(values, 'sha1')
+        await self.conn.execute_query_many(query, [(p, json.dumps(sha1s)) for p, sha1s in groups.items()])
         return True
 
     async def count_instance_values(self, instance_ids: list[int]):
@@ -304,12 +271,17 @@ class Db:
         query = Query.from_(values).select('instance_id', functions.Count('*'))
         query = query.where(values.instance_id.isin(instance_ids))
         query = query.groupby(values.instance_id)
-        cursor = await self.conn.execute_query(query.get_sql())
+        cursor = await self.conn.execute_read(query.get_sql())
         rows = await cursor.fetchall()
         res = {r[0]: r[1] for r in rows}
         # print(res)
         return res
 
+    async def move_image_values(self, sha1s: list[tuple[str, str]]):
+        # (old, new) pairs, the values already set on the new sha1 are kept
+        query = "UPDATE OR IGNORE image_property_values SET sha1 = ? WHERE sha1 = ?"
+        await self.conn.execute_query_many(query, [(new, old) for old, new in sha1s])
+
     async def delete_image_values(self, sha1s: list[str]):
         query = "DELETE FROM image_property_values WHERE sha1 = ?"
         await self.conn.execute_query_many(query, [(sha1,) for sha1 in sha1s])
@@ -333,7 +305,7 @@ class Db:
 
     async def get_tag_by_id(self, tag_id):
         query = "SELECT * FROM tags WHERE id = ?"
-        cursor = await self.conn.execute_query(query, (tag_id,))
+        cursor = await self.conn.execute_read(query, (tag_id,))
         row = await cursor.fetchone()
         if not row:
             return
@@ -358,13 +330,13 @@ class Db:
         if prop:
             query += "WHERE property_id = ?"
             params = (prop,)
-        cursor = await self.conn.execute_query(query, params)
+        cursor = await self.conn.execute_read(query, params)
         return [Tag(**auto_dict(row, cursor)) for row in await cursor.fetchall()]
 
     async def get_tags_by_ids(self, ids: list[int]):
         table = Table('tags')
         query = Query.from_(table).select('*').where(table.id.isin(ids))
-        cursor = await self.conn.execute_query(query.get_sql())
+        cursor = await self.conn.execute_read(query.get_sql())
         rows = await cursor.fetchall()
         if rows:
             tags = [Tag(**auto_dict(row, cursor)) for row in rows]
@@ -380,86 +352,27 @@ class Db:
     # ==================== Images =========================
     # =====================================================
 
-    async def import_image(self, sha1: str, small: bytes, medium: bytes, large: bytes):
-        query = "INSERT OR REPLACE INTO images (sha1, small, medium, large) VALUES (?, ?, ?, ?)"
-        await self.conn.execute_query(query, (sha1, small, medium, large))
-        return sha1, small, medium, large
-
-    async def import_raw_image(self, sha1: str, mime_type: str, data: bytes):
-        query = "INSERT OR REPLACE INTO raw_images (sha1, mime_type, data) VALUES (?, ?, ?)"
-        await self.conn.execute_query(query, (sha1, mime_type, data))
-
-    async def get_small_image(self, sha1: str):
-        query = "SELECT small FROM images WHERE sha1=?"
-        cursor = await self.conn.execute_query(query, (sha1,))
-        row = await cursor.fetchone()
-        if not row:
-            return row
-        return row[0]
-
-    async def get_medium_image(self, sha1: str):
-        query = "SELECT medium FROM images WHERE sha1=?"
-        cursor = await self.conn.execute_query(query, (sha1,))
-        row = await cursor.fetchone()
-        if not row:
-            return row
-        return row[0]
-
-    async def get_large_image(self, sha1: str):
-        query = "SELECT large FROM images WHERE sha1=?"
-        cursor = await self.conn.execute_query(query, (sha1,))
-        row = await cursor.fetchone()
-        if not row:
-            return row
-        return row[0]
-
-    async def get_raw_image(self, sha1: str):
-        query = "SELECT mime_type, data FROM raw_images WHERE sha1=?"
-        cursor = await self.conn.execute_query(query, (sha1,))
-        row = await cursor.fetchone()
-        if not row:
-            return row
-        return row[0], row[1]
-
-    async def has_image(self, sha1: str):
-        query = "SELECT sha1 FROM images WHERE sha1=?"
-        cursor = await self.conn.execute_query(query, (sha1,))
-        row = await cursor.fetchone()
-        if not row:
-            return False
-        return True
-
-    async def has_raw_image(self, sha1: str):
-        query = "SELECT sha1 FROM raw_images WHERE sha1=?"
-        cursor = await self.conn.execute_query(query, (sha1,))
+    async def has_image_blobs(self):
+        query = "SELECT EXISTS(SELECT 1 FROM images) OR EXISTS(SELECT 1 FROM raw_images)"
+        cursor = await self.conn.execute_read(query)
         row = await cursor.fetchone()
-        if not row:
-            return False
-        return True
-
-    async def delete_large_images(self):
-        query = "UPDATE images SET large = NULL"
-        await self.conn.execute_query(query)
+        return bool(row[0])
 
-    async def delete_medium_images(self):
-        query = "UPDATE images SET medium = NULL"
-        await self.conn.execute_query(query)
-
-    async def delete_small_images(self):
-        query = "UPDATE images SET small = NULL"
-        await self.conn.execute_query(query)
+    async def stream_image_blobs(self, chunk_size: int):
+        query = "SELECT sha1, small, medium, large FROM images"
+        async for rows in self.conn.stream_read(query, chunk_size=chunk_size):
+            yield rows
 
-    async def delete_images(self, sha1s: list[str]):
-        query = "DELETE FROM images WHERE sha1 = ?"
-        await self.conn.execute_query_many(query, [(sha1,) for sha1 in sha1s])
+    async def stream_raw_image_blobs(self, chunk_size: int):
+        query = "SELECT sha1, mime_type, data FROM raw_images"
+        async for rows in self.conn.stream_read(query, chunk_size=chunk_size):
+            yield rows
 
-    async def delete_raw_images(self, sha1s: list[str] = None):
-        if sha1s is None:
-            query = 'DELETE FROM raw_images'
-            await self.conn.execute_query(query)
-        else:
-            query = "DELETE FROM raw_images WHERE sha1 = ?"
-            await self.conn.execute_query_many(query, [(sha1,) for sha1 in sha1s])
+    async def delete_image_blobs(self):
+        # no VACUUM, it would rewrite the whole DB on open. The freed pages are reused by later writes
+        async with self.conn.transaction():
+            await self.conn.execute_query("DELETE FROM images")
+            await self.conn.execute_query("DELETE FROM raw_images")
 
     # =====================================================
     # ================= Instances =========================
@@ -467,7 +380,7 @@ class Db:
 
     async def get_instances_count(self):
         query = "SELECT count(*) FROM instances;"
-        cursor = await self.conn.execute_query(query)
+        cursor = await self.conn.execute_read(query)
         row = await cursor.fetchone()
         if row:
             return row[0]
@@ -497,7 +410,7 @@ class Db:
         if last:
             query = query.orderby(img_table.id, order=Order.desc).limit(last)
 
-        cursor = await self.conn.execute_query(query.get_sql())
+        cursor = await self.conn.execute_read(query.get_sql())
         instance = [Instance(*instance) for instance in await cursor.fetchall()]
         return instance
 
@@ -508,7 +421,7 @@ class Db:
         ORDER BY rowid ASC
         LIMIT ?;
         """
-        cursor = await self.conn.execute_query(query, (position, chunk_size))
+        cursor = await self.conn.execute_read(query, (position, chunk_size))
         rows = await cursor.fetchall()
         if rows:
             return [Instance(*row) for row in rows]
@@ -516,7 +429,7 @@ class Db:
 
     async def get_instance_sha1_and_url(self):
         query = "SELECT sha1, url FROM instances"
-        cursor = await self.conn.execute_query(query)
+        cursor = await self.conn.execute_read(query)
         rows = await cursor.fetchall()
         if rows:
             return rows
@@ -527,15 +440,51 @@ class Db:
         query = Query.from_(table).select('*').where(table.folder_id == folder_id)
         query = query.where(table.name == name).where(table.extension == extension).limit(1)
 
-        cursor = await self.conn.execute_query(query.get_sql())
+        cursor = await self.conn.execute_read(query.get_sql())
         res = await cursor.fetchone()
         if res:
             return Instance(*res)
         return False
 
+    async def stream_folder_instances(self, folder_ids: list[int], chunk_size: int):
+        # the folder ids are passed as a json array and probed on idx_folder_id
+        query = "SELECT * FROM instances WHERE folder_id IN (SELECT value FROM json_each(?))"
+        async for rows in self.conn.stream_read(query, (json.dumps(folder_ids),), chunk_size=chunk_size):
+            yield [Instance(*row) for row in rows]
+
+    async def update_instance_files(self, instances: list[Instance]):
+        # an UPDATE keeps the instance values, INSERT OR REPLACE would cascade their deletion
+        query = "UPDATE instances SET sha1 = ?, width = ?, height = ?, ahash = ? WHERE id = ?"
+        await self.conn.execute_query_many(query, [(i.sha1, i.width, i.height, i.ahash, i.id) for i in instances])
+
+    async def delete_instances(self, ids: list[int]):
+        async with self.conn.transaction():
+            await self.conn.execute_query("DELETE FROM instances WHERE id IN (SELECT value FROM json_each(?))",
+                                          (json.dumps(ids),))
+            await self.conn.execute_query("DELETE FROM file_fingerprints "
+                                          "WHERE instance_id IN (SELECT value FROM json_each(?))", (json.dumps(ids),))
+
+    async def get_used_sha1s(self, sha1s: list[str]) -> set[str]:
+        query = "SELECT DISTINCT sha1 FROM instances WHERE sha1 IN (SELECT value FROM json_each(?))"
+        cursor = await self.conn.execute_read(query, (json.dumps(sha1s),))
+        return {row[0] for row in await cursor.fetchall()}
+
+    async def import_file_fingerprints(self, fingerprints: list[tuple[int, int, int, int]]):
+        query = "INSERT OR REPLACE INTO file_fingerprints (instance_id, size, mtime_ns, inode) VALUES (?, ?, ?, ?)"
+        await self.conn.execute_query_many(query, fingerprints)
+
+    async def stream_folder_fingerprints(self, folder_ids: list[int], chunk_size: int):
+        query = """
+            SELECT f.instance_id, f.size, f.mtime_ns, f.inode FROM file_fingerprints f
+            JOIN instances i ON i.id = f.instance_id
+            WHERE i.folder_id IN (SELECT value FROM json_each(?))
+        """
+        async for rows in self.conn.stream_read(query, (json.dumps(folder_ids),), chunk_size=chunk_size):
+            yield rows
+
     async def get_all_instances_ids(self):
         query = 'SELECT id FROM instances'
-        cursor = await self.conn.execute_query(query)
+        cursor = await self.conn.execute_read(query)
         res = await cursor.fetchall()
         if res:
             return {r[0] for r in res}
@@ -544,7 +493,7 @@ class Db:
 
     async def get_all_instance_sha1s(self):
         query = 'SELECT sha1 FROM instances'
-        cursor = await self.conn.execute_query(query)
+        cursor = await self.conn.execute_read(query)
         res = await cursor.fetchall()
         if res:
             return {r[0] for r in res}
@@ -555,7 +504,7 @@ class Db:
         table = Table('instances')
         query = Query.from_(table).select('id', 'sha1').where(table.id.isin(ids))
 
-        cursor = await self.conn.execute_query(query.get_sql())
+        cursor = await self.conn.execute_read(query.get_sql())
         rows = await cursor.fetchall()
 
         if rows:
@@ -567,7 +516,7 @@ class Db:
         table = Table('instances')
         query = Query.from_(table).select('id', 'url').where(table.id.isin(ids))
 
-        cursor = await self.conn.execute_query(query.get_sql())
+        cursor = await self.conn.execute_read(query.get_sql())
         rows = await cursor.fetchall()
 
         if rows:
@@ -584,7 +533,7 @@ class Db:
             .groupby(table.sha1)
         )
 
-        cursor = await self.conn.execute_query(query.get_sql())
+        cursor = await self.conn.execute_read(query.get_sql())
         rows = await cursor.fetchall()
 
         if rows:
@@ -601,7 +550,7 @@ class Db:
             .groupby(table.url)
         )
 
-        cursor = await self.conn.execute_query(query.get_sql())
+        cursor = await self.conn.execute_read(query.get_sql())
         rows = await cursor.fetchall()
 
         if rows:
@@ -615,7 +564,7 @@ class Db:
 
     async def get_distinct_sha1_count(self):
         query = "SELECT count(DISTINCT sha1) FROM instances"
-        cursor = await self.conn.execute_query(query)
+        cursor = await self.conn.execute_read(query)
         res = await cursor.fetchall()
         if res:
             return res[0][0]
@@ -634,6 +583,34 @@ class Db:
         folder = Folder(**auto_dict(row, cursor))
         return folder
 
+    async def add_folders(self, folders: list[tuple[str, str, str | None]]) -> dict[str, int]:
+        """
+        Inserts a folder tree given as (path, name, parent path), parents first, in one statement.
+        The ids are given here so the children can reference their parent. Returns the ids by path
+        """
+        paths = [f[0] for f in folders]
+        async with self.conn.transaction():
+            query = "SELECT path, id FROM folders WHERE path IN (SELECT value FROM json_each(?))"
+            cursor = await self.conn.execute_query(query, (json.dumps(paths),))
+            ids = {path: id_ for path, id_ in await cursor.fetchall()}
+            # the AUTOINCREMENT sequence so the ids of deleted folders are not given again
+            query = "SELECT max(coalesce((SELECT seq FROM sqlite_sequence WHERE name = 'folders'), 0), " \
+                    "coalesce((SELECT max(id) FROM folders), 0))"
+            cursor = await self.conn.execute_query(query)
+            next_id = (await cursor.fetchone())[0]
+
+            rows = []
+            for path, name, parent in folders:
+                if path in ids:
+                    continue
+                next_id += 1
+                ids[path] = next_id
+                rows.append((next_id, path, name, ids[parent] if parent is not None else None))
+            if rows:
+                query = 'INSERT INTO folders (id, path, name, parent) VALUES (?, ?, ?, ?)'
+                await self.conn.execute_query_many(query, rows)
+        return ids
+
     async def import_folder(self, id_: int, path: str, name: str, parent: int = None):
         query = 'INSERT INTO folders (id, path, name, parent) VALUES (?, ?, ?, ?) ON CONFLICT(path) DO NOTHING'
         await self.conn.execute_query(query, (id_, path, name, parent))
@@ -644,13 +621,13 @@ class Db:
 
     async def get_folders(self) -> List[Folder]:
         query = "SELECT * from folders"
-        cursor = await self.conn.execute_query(query)
+        cursor = await self.conn.execute_read(query)
         return [Folder(**auto_dict(row, cursor)) for row in await cursor.fetchall()]
 
     async def get_folder(self, folder_id: int):
         table = Table('folders')
         query = Query.from_(table).select('*').where(table.id == folder_id)
-        cursor = await self.conn.execute_query(query.get_sql())
+        cursor = await self.conn.execute_read(query.get_sql())
         row = await cursor.fetchone()
 
         return Folder(**auto_dict(row, cursor))
@@ -658,7 +635,7 @@ class Db:
     async def get_folder_by_path(self, path: str):
         table = Table('folders')
         query = Query.from_(table).select('*').where(table.path == path)
-        cursor = await self.conn.execute_query(query.get_sql())
+        cursor = await self.conn.execute_read(query.get_sql())
         row = await cursor.fetchone()
         if row:
             return Folder(**auto_dict(row, cursor))
@@ -669,6 +646,10 @@ class Db:
         await self.conn.execute_query(query, (folder_id,))
         return folder_id
 
+    async def delete_folders(self, folder_ids: list[int]):
+        query = "DELETE FROM folders WHERE id IN (SELECT value FROM json_each(?))"
+        await self.conn.execute_query(query, (json.dumps(folder_ids),))
+
     # =====================================================
     # ================== Vectors ==========================
     # =====================================================
@@ -681,31 +662,46 @@ class Db:
         vector_type.id = res.lastrowid
         return vector_type
 
-    async def add_vector(self, vector: Vector):
+    async def add_vector(self, vector: Vector, precision: str = default_precision):
         query = f"""
             INSERT OR REPLACE INTO vectors (type_id, sha1, data)
             VALUES (?, ?, ?);
         """
-        await self.conn.execute_query(query, (vector.type_id, vector.sha1, vector.data))
+        data = to_blobs(vector.data, precision)[0]
+        await self.conn.execute_query(query, (vector.type_id, vector.sha1, data))
         return vector
 
+    async def add_vectors(self, type_id: int, sha1s: list[str], matrix: np.ndarray,
+                          precision: str = default_precision):
+        query = """
+            INSERT OR REPLACE INTO vectors (type_id, sha1, data)
+            VALUES (?, ?, ?);
+        """
+        blobs = to_blobs(matrix, precision)
+        await self.conn.execute_query_many(query, [(type_id, sha1, blob) for sha1, blob in zip(sha1s, blobs)])
+
     async def get_vectors(self, type_id: int, sha1s: List[str] = None):
         t = Table('vectors')
         query = Query.from_(t).select('type_id', 'sha1', 'data')
         query = query.where(t.type_id == type_id)
         if sha1s:
             query = query.where(t.sha1.isin(sha1s))
-        cursor = await self.conn.execute_query(query.get_sql())
+        cursor = await self.conn.execute_read(query.get_sql())
         rows = await cursor.fetchall()
         res = [Vector(*row) for row in rows]
         return res
 
+    async def stream_vectors(self, type_id: int, chunk_size: int):
+        query = "SELECT sha1, data FROM vectors WHERE type_id = ?"
+        async for rows in self.conn.stream_read(query, (type_id,), chunk_size=chunk_size):
+            yield rows
+
     async def get_vector_types(self, source: str = None):
         t = Table('vector_type')
         query = Query.from_(t).select('*')
         if source:
             query = query.where(t.source == source)
-        cursor = await self.conn.execute_query(query.get_sql())
+        cursor = await self.conn.execute_read(query.get_sql())
         rows = await cursor.fetchall()
         if rows:
             return [VectorType(**auto_dict(r, cursor)) for r in rows]
@@ -721,7 +717,7 @@ class Db:
         query = Query.from_(t).select('type_id', 'sha1')
         query = query.where(t.type_id == type_id)
         query = query.where(t.sha1 == sha1)
-        cursor = await self.conn.execute_query(query.get_sql())
+        cursor = await self.conn.execute_read(query.get_sql())
         rows = await cursor.fetchall()
         if rows:
             return True
@@ -729,7 +725,7 @@ class Db:
 
     async def get_vector_stats(self):
         query = "SELECT type_id, count(sha1) FROM vectors GROUP BY type_id"
-        cursor = await self.conn.execute_query(query)
+        cursor = await self.conn.execute_read(query)
         rows = await cursor.fetchall()
         if rows:
             return {r[0]: r[1] for r in rows}
@@ -758,13 +754,30 @@ class Db:
         query = "DELETE FROM vectors WHERE sha1 = ?"
         await self.conn.execute_query_many(query, [(sha1,) for sha1 in sha1s])
 
+    # =====================================================
+    # ================== Tasks ============================
+    # =====================================================
+
+    async def get_pending_tasks(self):
+        cursor = await self.conn.execute_read("SELECT id, kind, params FROM pending_tasks ORDER BY id")
+        return await cursor.fetchall()
+
+    async def update_pending_tasks(self, tasks: list[tuple[int, str, str]], deleted: list[int]):
+        async with self.conn.transaction():
+            if deleted:
+                await self.conn.execute_query("DELETE FROM pending_tasks WHERE id IN (SELECT value FROM json_each(?))",
+                                              (json.dumps(deleted),))
+            if tasks:
+                await self.conn.execute_query_many("INSERT OR REPLACE INTO pending_tasks (id, kind, params) "
+                                                   "VALUES (?, ?, ?)", tasks)
+
     # =====================================================
     # ================== Plugins ==========================
     # =====================================================
 
     async def get_plugin_data(self, key: str):
         query = "SELECT * FROM plugin_data WHERE key=?"
-        cursor = await self.conn.execute_query(query, (key,))
+        cursor = await self.conn.execute_read(query, (key,))
         row = await cursor.fetchone()
         if row:
             return json.loads(row[1])
@@ -781,7 +794,7 @@ class Db:
 
     async def get_ui_data(self, key: str):
         query = "SELECT * FROM ui_data WHERE key=?"
-        cursor = await self.conn.execute_query(query, (key,))
+        cursor = await self.conn.execute_read(query, (key,))
         row = await cursor.fetchone()
         if row:
             return json.loads(row[1])
@@ -789,7 +802,7 @@ class Db:
 
     async def get_all_ui_data(self):
         query = "SELECT * FROM ui_data"
-        cursor = await self.conn.execute_query(query)
+        cursor = await self.conn.execute_read(query)
         rows = await cursor.fetchall()
         if rows:
             return {r[0]: json.loads(r[1]) for r in rows}
@@ -802,7 +815,7 @@ class Db:
 
     async def get_project_param(self, key: str):
         query = f'SELECT value FROM project WHERE key="{key}";'
-        cursor = await self.conn.execute_query(query)
+        cursor = await self.conn.execute_read(query)
         row = await cursor.fetchone()
         if row:
             return decode_if_json(row[0])
@@ -822,7 +835,7 @@ class Db:
 
     async def get_property_groups(self):
         query = "SELECT * FROM property_group"
-        cursor = await self.conn.execute_query(query)
+        cursor = await self.conn.execute_read(query)
         rows = await cursor.fetchall()
         if rows:
             return [PropertyGroup(*row) for row in rows]
@@ -843,7 +856,7 @@ class Db:
 
     async def get_map(self, map_id: int):
         query = "SELECT * FROM maps WHERE id=?"
-        cursor = await self.conn.execute_query(query, (map_id,))
+        cursor = await self.conn.execute_read(query, (map_id,))
         row = await cursor.fetchone()
         if row:
             return Map(row[0], row[1], row[2], row[3], row[4], json.loads(row[5]))
@@ -851,7 +864,7 @@ class Db:
 
     async def list_maps(self):
         query = "SELECT id, source, name, key, count FROM maps"
-        cursor = await self.conn.execute_query(query)
+        cursor = await self.conn.execute_read(query)
         rows = await cursor.fetchall()
         if rows:
             return [Map(r[0], r[1], r[2], r[3], r[4]) for r in rows]
@@ -871,23 +884,9 @@ class Db:
     # ==================== ID COUNTERS ====================
     # =====================================================
 
-    async def _get_id_counter_helper(self, counter_name: str, nb: int):
-        query = f"SELECT next FROM id_counter WHERE name='{counter_name}';"
-        cursor = await self.conn.execute_query(query)
-        row = await cursor.fetchone()
-        next_id = row[0]
-
-        update = "INSERT OR REPLACE INTO id_counter VALUES (?,?)"
-        await self.conn.execute_query(update, (counter_name, next_id + nb))
-        return [next_id + i for i in range(nb)]
-
-    async def get_new_property_group_ids(self, nb: int):
-        async with self.property_group_id_lock:
-            return await self._get_id_counter_helper('property_group', nb)
-
     async def get_instance_values_instance_ids(self):
         query = f"SELECT DISTINCT instance_id FROM instance_property_values"
-        cursor = await self.conn.execute_query(query)
+        cursor = await self.conn.execute_read(query)
         rows = await cursor.fetchall()
         return [r[0] for r in rows]
 
@@ -909,7 +908,7 @@ class Db:
 
     async def get_atlas(self, atlas_id: int):
         query = "SELECT id, atlas_nb, width, height, cell_width, cell_height, sha1_mapping FROM atlas WHERE id=?"
-        cursor = await self.conn.execute_query(query, (atlas_id,))
+        cursor = await self.conn.execute_read(query, (atlas_id,))
         row = await cursor.fetchone()
         if not row:
             return None
@@ -2,6 +2,9 @@ import asyncio
 import logging
 import os
 import sqlite3
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import Callable
 
 import aiosqlite
 import numpy as np
@@ -12,27 +15,62 @@ from panoptic.core.project_db.migrations.v4 import v4_sql
 from panoptic.core.project_db.migrations.v5 import v5_sql
 from panoptic.core.project_db.migrations.v6 import v6_sql
 from panoptic.core.project_db.migrations.v7 import v7_sql
+from panoptic.core.project_db.vector_precision import from_blob
 
 aiosqlite.register_adapter(np.array, lambda arr: arr.tobytes())
-aiosqlite.register_converter("array", lambda arr: np.frombuffer(arr, dtype='float32'))
+aiosqlite.register_converter("array", from_blob)
 
-DB_LOCK = asyncio.Lock()
+# number of read-only connections opened next to the writer
+nb_readers = 4
 
 
-def db_lock(func):
-    async def wrapper(*args, **kwargs):
-        async with DB_LOCK:
-            return await func(*args, **kwargs)
+class ReadCursor:
+    """
+    Rows of a finished read query with the awaitable fetch api of an aiosqlite Cursor
+    """
+    def __init__(self, rows: list, description):
+        self.description = description
+        self._rows = rows
+        self._position = 0
 
-    return wrapper
+    async def fetchone(self):
+        if self._position >= len(self._rows):
+            return None
+        row = self._rows[self._position]
+        self._position += 1
+        return row
+
+    async def fetchmany(self, size: int):
+        rows = self._rows[self._position:self._position + size]
+        self._position += len(rows)
+        return rows
+
+    async def fetchall(self):
+        rows = self._rows[self._position:]
+        self._position = len(self._rows)
+        return rows
 
 
 class DbConnection:
-    def __init__(self, path):
+    """
+    One writer connection and a pool of read-only connections on the project DB.
+    The DB is opened in WAL mode so readers never wait on the writer (and the other way around).
+    Only the write path (execute_query / execute_query_many) commits.
+    Inside transaction() the writes of the owning task are committed once at the end,
+    and its reads are routed to the writer so they see the uncommitted changes.
+    """
+    def __init__(self, path, readers: int = nb_readers):
         self.folder_path = path
         self.db_path = os.path.join(path, "panoptic.db")
         self.is_loaded = False
         self.conn: aiosqlite.Connection | None = None
+        self.nb_readers = readers
+        self.readers: list[aiosqlite.Connection] = []
+        self._free_readers: asyncio.Queue[aiosqlite.Connection] = asyncio.Queue()
+        self._write_lock = asyncio.Lock()
+        self._transaction_task: asyncio.Task | None = None
+        # called after a transaction or a savepoint is rolled back, to drop state kept in memory
+        self.on_rollback: list[Callable[[], None]] = []
 
     async def start(self):
         """
@@ -41,8 +79,9 @@ class DbConnection:
         """
         # create connection
         self.conn = await aiosqlite.connect(self.db_path, detect_types=sqlite3.PARSE_DECLTYPES)
-        # use foreign_keys checks
-        async with self.conn.executescript('PRAGMA foreign_keys = 1') as cursor:
+        # WAL lets the read connections work while the writer commits, use foreign_keys checks
+        async with self.conn.executescript('PRAGMA journal_mode = WAL; PRAGMA synchronous = NORMAL; '
+                                           'PRAGMA foreign_keys = 1') as cursor:
             await self.conn.commit()
 
         # check if the db is empty or has missing tables
@@ -59,8 +98,32 @@ class DbConnection:
         if int(db_version) != software_db_version:
             logging.warning(f'DB Version ({db_version}) doesnt match Software DB Version ({software_db_version})')
             await self.update_version(int(db_version), software_db_version)
+
+        await self.set_readers(self.nb_readers)
         self.is_loaded = True
 
+    async def set_readers(self, nb: int):
+        """
+        Opens or closes read-only connections until the pool has nb of them
+        """
+        self.nb_readers = nb
+        uri = Path(self.db_path).absolute().as_uri() + '?mode=ro'
+        while len(self.readers) < nb:
+            reader = await aiosqlite.connect(uri, uri=True, detect_types=sqlite3.PARSE_DECLTYPES)
+            self.readers.append(reader)
+            self._free_readers.put_nowait(reader)
+        while len(self.readers) > nb:
+            # waits for a borrowed reader to be given back
+            reader = await self._free_readers.get()
+            self.readers.remove(reader)
+            await reader.close()
+
+    async def close(self):
+        for reader in self.readers:
+            await reader.close()
+        self.readers.clear()
+        await self.conn.close()
+
     async def update_version(self, db_version: int, target_version: int):
         if db_version < 3:
             await self.conn.executescript(v3_sql)
@@ -76,20 +139,111 @@ class DbConnection:
         await self.set_param(DB_VERSION, str(target_version))
         logging.warning(f'Correctly updated to Software DB Version ({target_version})')
 
-    async def execute_query(self, query: str, parameters: tuple = None):
+    def in_transaction(self):
+        return self._transaction_task is not None and self._transaction_task is asyncio.current_task()
+
+    @asynccontextmanager
+    async def transaction(self):
+        """
+        Group all writes of the current task in one transaction committed (or rolled back) at the end
+        Other writers wait for the transaction to finish. Reentrant for the owning task
+        """
+        if self.in_transaction():
+            yield
+            return
+        async with self._write_lock:
+            self._transaction_task = asyncio.current_task()
+            try:
+                await self.conn.execute('BEGIN IMMEDIATE')
+                try:
+                    yield
+                    await self.conn.commit()
+                except BaseException:
+                    await self.conn.rollback()
+                    self._rolled_back()
+                    raise
+            finally:
+                self._transaction_task = None
+
+    @asynccontextmanager
+    async def savepoint(self, name: str):
+        """
+        Nested rollback point inside a transaction
+        """
+        await self.conn.execute(f'SAVEPOINT {name}')
+        try:
+            yield
+        except BaseException:
+            await self.conn.execute(f'ROLLBACK TO {name}')
+            await self.conn.execute(f'RELEASE {name}')
+            self._rolled_back()
+            raise
+        await self.conn.execute(f'RELEASE {name}')
+
+    def _rolled_back(self):
+        for callback in self.on_rollback:
+            callback()
+
+    async def _execute(self, query: str, parameters: tuple = None):
         cursor = await self.conn.cursor()
         if parameters:
             await cursor.execute(query, parameters)
         else:
             await cursor.execute(query)
-        await self.conn.commit()
         return cursor
 
+    async def execute_query(self, query: str, parameters: tuple = None):
+        if self.in_transaction():
+            return await self._execute(query, parameters)
+        async with self._write_lock:
+            cursor = await self._execute(query, parameters)
+            await self.conn.commit()
+            return cursor
+
     async def execute_query_many(self, query, data: list):
-        cursor = await self.conn.cursor()
-        await cursor.executemany(query, data)
-        await self.conn.commit()
-        return cursor
+        if self.in_transaction():
+            return await self.conn.executemany(query, data)
+        async with self._write_lock:
+            cursor = await self.conn.executemany(query, data)
+            await self.conn.commit()
+            return cursor
+
+    @asynccontextmanager
+    async def reader(self):
+        """
+        Borrow a connection of the read pool. Uses the writer inside a transaction or if the pool is not opened.
+        A reader is never shared while borrowed: an unfinished statement would pin its snapshot
+        """
+        if not self.readers or self.in_transaction():
+            yield self.conn
+            return
+        conn = await self._free_readers.get()
+        try:
+            yield conn
+        finally:
+            self._free_readers.put_nowait(conn)
+
+    async def execute_read(self, query: str, parameters: tuple = None):
+        """
+        Execute a read only query on the read pool and fetch all rows. Never commits
+        """
+        async with self.reader() as conn:
+            async with conn.execute(query, parameters) as cursor:
+                rows = await cursor.fetchall()
+                return ReadCursor(rows, cursor.description)
+
+    async def stream_read(self, query: str, parameters: tuple = None, chunk_size: int = 10_000):
+        """
+        Execute a read only query on the read pool and yield rows by chunks
+        The reader stays borrowed until the stream is exhausted
+        """
+        async with self.reader() as conn:
+            async with conn.execute(query, parameters) as cursor:
+                while True:
+                    rows = await cursor.fetchmany(chunk_size)
+                    if not rows:
+                        break
+                    yield rows
 
     async def _table_exists(self, table_name: str):
         # Use the sqlite_master table to check if the table exists
@@ -0,0 +1,73 @@
+from __future__ import annotations
+
+import asyncio
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from panoptic.core.project_db.db_connection import DbConnection
+
+# number of ids reserved in the id_counter table at once
+id_block_size = 1000
+
+
+class IdAllocator:
+    """
+    Hands out new ids of one table from memory.
+    The high-water mark is read once, then ids are reserved by blocks in the id_counter table
+    so an id handed out before a restart is never given again
+    """
+    def __init__(self, conn: DbConnection, counter: str, table: str, block_size: int = id_block_size):
+        self._conn = conn
+        self.counter = counter
+        self.table = table
+        self.block_size = block_size
+
+        self._next: int | None = None
+        self._reserved = 0
+        self._load_lock = asyncio.Lock()
+        conn.on_rollback.append(self.reset_reservation)
+
+    def reset_reservation(self):
+        """
+        The reservation may have been rolled back with the transaction, the next call reserves again
+        """
+        self._reserved = 0
+
+    async def _load(self):
+        async with self._load_lock:
+            if self._next is not None:
+                return
+            cursor = await self._conn.execute_read(f'SELECT max(id) FROM {self.table}')
+            row = await cursor.fetchone()
+            last_id = row[0] if row and row[0] is not None else 0
+
+            cursor = await self._conn.execute_read('SELECT next FROM id_counter WHERE name = ?', (self.counter,))
+            row = await cursor.fetchone()
+            counter_next = int(row[0]) if row else 1
+
+            self._next = max(last_id + 1, counter_next)
+            self._reserved = self._next
+
+    async def get_new_ids(self, nb: int) -> list[int]:
+        if self._next is None:
+            await self._load()
+
+        # taken synchronously so concurrent callers never share ids
+        first = self._next
+        self._next += nb
+        if self._next > self._reserved:
+            await self._reserve(self._next + self.block_size)
+        return list(range(first, first + nb))
+
+    async def _reserve(self, reserved: int):
+        """
+        Every caller past the reservation writes its own one and waits for it before using its ids.
+        A lock is not used, the writer task calls this inside its transaction
+        and would wait on a caller that waits on the writer
+        """
+        query = """
+            INSERT INTO id_counter (name, next) VALUES (?, ?)
+            ON CONFLICT(name) DO UPDATE SET next = max(next, excluded.next)
+        """
+        await self._conn.execute_query(query, (self.counter, reserved))
+        self._reserved = max(self._reserved, reserved)
@@ -0,0 +1,58 @@
+from collections import OrderedDict
+
+# default memory budget of the thumbnail cache of a project, in bytes
+image_cache_budget = 256 * 1024 * 1024
+
+
+class ImageCache:
+    """
+    LRU cache of thumbnail bytes keyed by (kind, sha1), bounded by the total size of the cached images
+    """
+    def __init__(self, budget: int = image_cache_budget):
+        self.budget = budget
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._images: OrderedDict[tuple[str, str], bytes] = OrderedDict()
+
+    def __len__(self):
+        return len(self._images)
+
+    def get(self, kind: str, sha1: str) -> bytes | None:
+        image = self._images.get((kind, sha1))
+        if image is None:
+            self.misses += 1
+            return None
+        self._images.move_to_end((kind, sha1))
+        self.hits += 1
+        return image
+
+    def put(self, kind: str, sha1: str, image: bytes):
+        if len(image) > self.budget:
+            return
+        self.remove(kind, sha1)
+        self._images[(kind, sha1)] = image
+        self.size += len(image)
+        self._evict()
+
+    def remove(self, kind: str, sha1: str):
+        image = self._images.pop((kind, sha1), None)
+        if image is not None:
+            self.size -= len(image)
+
+    def remove_kind(self, kind: str):
+        for key in [k for k in self._images if k[0] == kind]:
+            self.remove(*key)
+
+    def set_budget(self, budget: int):
+        self.budget = budget
+        self._evict()
+
+    def _evict(self):
+        while self.size > self.budget:
+            _, image = self._images.popitem(last=False)
+            self.size -= len(image)
+
+    def get_stats(self):
+        return {'budget': self.budget, 'size': self.size, 'count': len(self._images),
+                'hits': self.hits, 'misses': self.misses}
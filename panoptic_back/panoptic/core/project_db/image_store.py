@@ -0,0 +1,339 @@
+from __future__ import annotations
+
+import asyncio
+import mmap
+import os
+from typing import TYPE_CHECKING, Callable
+
+import numpy as np
+
+from panoptic.core.project_db.image_cache import ImageCache
+
+if TYPE_CHECKING:
+    from panoptic.core.project.project_paths import ProjectPaths
+
+# a new pack file is started once the current one grows past this size
+pack_max_size = 1 << 30
+
+image_kinds = ('small', 'medium', 'large', 'raw')
+# bit of each kind in the availability bitmap
+kind_bits = {kind: 1 << i for i, kind in enumerate(image_kinds)}
+# kinds loaded in the cache on project open, until the budget is filled
+warm_up_kinds = ['small', 'medium']
+
+# one record of a pack index file. The last record of a sha1 wins, pack = -1 marks a deleted image
+# the sha1 is a raw V20 field, an S20 field would drop its trailing null bytes
+index_dtype = np.dtype([('sha1', 'V20'), ('pack', '<i4'), ('size', '<i4'), ('offset', '<i8')])
+location_dtype = np.dtype([('pack', '<i4'), ('size', '<i4'), ('offset', '<i8')])
+
+
+def _empty_locations(size: int):
+    locations = np.zeros(size, dtype=location_dtype)
+    locations['pack'] = -1
+    return locations
+
+
+class ImagePack:
+    """
+    Append-only pack files of one image kind and the offset index of their images.
+    Data is always flushed to the pack before its index record so a record never points past the data
+    """
+    def __init__(self, paths: ProjectPaths, kind: str):
+        self.paths = paths
+        self.kind = kind
+        self.locations = _empty_locations(0)
+
+        self._pack_nb = 0
+        self._pack_size = 0
+        self._writer = None
+        self._index = None
+        self._maps: dict[int, mmap.mmap] = {}
+
+    def load(self, get_row: Callable[[str], int]):
+        index_path = self.paths.get_pack_index_path(self.kind)
+        records = np.zeros(0, dtype=index_dtype)
+        if index_path.exists():
+            # drop a record cut in half by a crash
+            nb_records = index_path.stat().st_size // index_dtype.itemsize
+            os.truncate(index_path, nb_records * index_dtype.itemsize)
+            records = np.fromfile(index_path, dtype=index_dtype)
+
+        pack_sizes = {}
+        while self.paths.get_pack_path(self.kind, len(pack_sizes)).exists():
+            pack_sizes[len(pack_sizes)] = self.paths.get_pack_path(self.kind, len(pack_sizes)).stat().st_size
+        if pack_sizes:
+            self._pack_nb = len(pack_sizes) - 1
+            self._pack_size = pack_sizes[self._pack_nb]
+
+        rows = np.fromiter((get_row(bytes(sha1).hex()) for sha1 in records['sha1']), dtype=np.int64, count=len(records))
+        self.ensure_capacity(int(rows.max()) + 1 if len(rows) else 0)
+        # repeated rows keep the last record
+        ends = records['offset'] + records['size']
+        max_ends = np.array([pack_sizes.get(int(p), 0) for p in records['pack']], dtype=np.int64)
+        valid = (records['pack'] < 0) | (ends <= max_ends)
+        for field in location_dtype.names:
+            self.locations[field][rows[valid]] = records[field][valid]
+
+        self._open_writers()
+
+    def ensure_capacity(self, size: int):
+        if len(self.locations) >= size:
+            return
+        locations = _empty_locations(max(size, len(self.locations) * 2, 1024))
+        locations[:len(self.locations)] = self.locations
+        self.locations = locations
+
+    def _open_writers(self):
+        self._writer = open(self.paths.get_pack_path(self.kind, self._pack_nb), 'ab')
+        self._index = open(self.paths.get_pack_index_path(self.kind), 'ab')
+
+    def close(self):
+        if self._writer:
+            self._writer.close()
+            self._index.close()
+            self._writer = self._index = None
+        for map_ in self._maps.values():
+            try:
+                map_.close()
+            except BufferError:
+                # a response still holds a view on it, it is closed once released
+                pass
+        self._maps.clear()
+
+    def write(self, images: list[tuple[str, bytes]]):
+        """
+        Appends the images to the pack and their records to the index. Blocking, run it in an executor
+        """
+        records = np.zeros(len(images), dtype=index_dtype)
+        for i, (sha1, data) in enumerate(images):
+            if self._pack_size >= pack_max_size:
+                self._writer.close()
+                self._pack_nb += 1
+                self._pack_size = 0
+                self._writer = open(self.paths.get_pack_path(self.kind, self._pack_nb), 'ab')
+            records[i] = (bytes.fromhex(sha1), self._pack_nb, len(data), self._pack_size)
+            self._writer.write(data)
+            self._pack_size += len(data)
+        self._writer.flush()
+        self._index.write(records.tobytes())
+        self._index.flush()
+        return records
+
+    def write_deleted(self, sha1s: list[str]):
+        records = np.zeros(len(sha1s), dtype=index_dtype)
+        records['sha1'] = [bytes.fromhex(sha1) for sha1 in sha1s]
+        records['pack'] = -1
+        self._index.write(records.tobytes())
+        self._index.flush()
+
+    def clear(self):
+        self.close()
+        for path in self.paths.packs.glob(f'{self.kind}_*.pack'):
+            try:
+                path.unlink()
+            except OSError:
+                # still mapped on windows, it is truncated instead
+                open(path, 'wb').close()
+        self.paths.get_pack_index_path(self.kind).unlink(missing_ok=True)
+        self.locations = _empty_locations(len(self.locations))
+        self._pack_nb = 0
+        self._pack_size = 0
+        self._open_writers()
+
+    def has(self, row: int):
+        return row < len(self.locations) and self.locations['pack'][row] >= 0
+
+    def get(self, row: int) -> memoryview | None:
+        """
+        Zero-copy view on the image bytes in the mapped pack file
+        """
+        if not self.has(row):
+            return None
+        pack, size, offset = (int(v) for v in self.locations[row])
+        if size == 0:
+            return memoryview(b'')
+        map_ = self._maps.get(pack)
+        if map_ is None or offset + size > len(map_):
+            map_ = self._map(pack)
+        return memoryview(map_)[offset:offset + size]
+
+    def _map(self, pack: int):
+        # the previous map of a growing pack is left to the views still using it
+        with open(self.paths.get_pack_path(self.kind, pack), 'rb') as file:
+            map_ = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._maps[pack] = map_
+        return map_
+
+
+class ImageStore:
+    """
+    Thumbnails and raw files of a project, addressed by sha1 and stored in pack files under image_data/packs.
+    The whole offset index is kept in memory so serving an image never touches the DB.
+    Thumbnails are cached in memory and an availability bitmap tells which kinds of a sha1 are not empty
+    """
+    def __init__(self, paths: ProjectPaths):
+        self.paths = paths
+        self.packs = {kind: ImagePack(paths, kind) for kind in image_kinds}
+        self.cache = ImageCache()
+        self.available = np.zeros(0, dtype=np.uint8)
+        self._rows: dict[str, int] = {}
+        self._write_lock = asyncio.Lock()
+
+    def _get_row(self, sha1: str):
+        row = self._rows.get(sha1)
+        if row is None:
+            row = self._rows[sha1] = len(self._rows)
+        return row
+
+    def _load(self):
+        for pack in self.packs.values():
+            pack.load(self._get_row)
+        self._ensure_available()
+        for kind, pack in self.packs.items():
+            self._update_available(kind, np.arange(min(len(pack.locations), len(self.available))))
+
+    def _ensure_available(self):
+        if len(self.available) >= len(self._rows):
+            return
+        available = np.zeros(max(len(self._rows), len(self.available) * 2, 1024), dtype=np.uint8)
+        available[:len(self.available)] = self.available
+        self.available = available
+
+    def _update_available(self, kind: str, rows):
+        locations = self.packs[kind].locations[rows]
+        present = (locations['pack'] >= 0) & (locations['size'] > 0)
+        bit = np.uint8(kind_bits[kind])
+        self.available[rows] = np.where(present, self.available[rows] | bit, self.available[rows] & ~bit)
+
+    async def start(self):
+        await asyncio.get_running_loop().run_in_executor(None, self._load)
+
+    async def close(self):
+        async with self._write_lock:
+            for pack in self.packs.values():
+                pack.close()
+
+    async def _write(self, kind: str, images: list[tuple[str, bytes]]):
+        pack = self.packs[kind]
+        records = await asyncio.get_running_loop().run_in_executor(None, pack.write, images)
+        rows = [self._get_row(sha1) for sha1, _ in images]
+        pack.ensure_capacity(len(self._rows))
+        for field in location_dtype.names:
+            pack.locations[field][rows] = records[field]
+        self._ensure_available()
+        self._update_available(kind, rows)
+        for sha1, _ in images:
+            self.cache.remove(kind, sha1)
+
+    async def import_images(self, images: list[tuple[str, bytes, bytes, bytes]]):
+        """
+        Stores (sha1, small, medium, large) thumbnails, an empty thumbnail is stored as existing but empty
+        """
+        async with self._write_lock:
+            for i, kind in enumerate(['small', 'medium', 'large']):
+                await self._write(kind, [(image[0], image[i + 1] or b'') for image in images])
+
+    async def import_raw_images(self, images: list[tuple[str, str, bytes]]):
+        """
+        Stores (sha1, mime_type, data) files, the mime type is written in front of the data
+        """
+        async with self._write_lock:
+            entries = []
+            for sha1, mime_type, data in images:
+                mime = (mime_type or '').encode()
+                entries.append((sha1, bytes([len(mime)]) + mime + (data or b'')))
+            await self._write('raw', entries)
+
+    def get_image(self, kind: str, sha1: str, cached: bool = True) -> bytes | memoryview | None:
+        """
+        With cached=False the image is read from its pack and not put in the cache, for bulk reads that would
+        evict the thumbnails being displayed
+        """
+        cached = cached and kind != 'raw'
+        if cached:
+            image = self.cache.get(kind, sha1)
+            if image is not None:
+                return image
+        row = self._rows.get(sha1)
+        if row is None:
+            return None
+        image = self.packs[kind].get(row)
+        if image and cached:
+            self.cache.put(kind, sha1, bytes(image))
+        return image
+
+    def available_kinds(self, sha1: str) -> int:
+        """
+        Bitmask of the kinds of kind_bits stored and not empty for this sha1
+        """
+        row = self._rows.get(sha1)
+        if row is None or row >= len(self.available):
+            return 0
+        return int(self.available[row])
+
+    def _read_warm_up(self, kind: str, budget: int, sha1s: list[str]):
+        pack = self.packs[kind]
+        locations = pack.locations[:len(sha1s)]
+        rows = np.flatnonzero((locations['pack'] >= 0) & (locations['size'] > 0))
+        # read the packs sequentially
+        rows = rows[np.lexsort((locations['offset'][rows], locations['pack'][rows]))]
+        images = []
+        for row in rows:
+            if budget <= 0:
+                break
+            image = bytes(pack.get(int(row)))
+            budget -= len(image)
+            images.append((sha1s[row], image))
+        return images
+
+    async def warm_up(self):
+        """
+        Loads the thumbnails in the cache until its budget is filled
+        """
+        loop = asyncio.get_running_loop()
+        for kind in warm_up_kinds:
+            budget = self.cache.budget - self.cache.size
+            if budget <= 0:
+                return
+            # rows are given in insertion order, the list maps a row to its sha1
+            images = await loop.run_in_executor(None, self._read_warm_up, kind, budget, list(self._rows))
+            for sha1, image in images:
+                self.cache.put(kind, sha1, image)
+
+    def get_raw_image(self, sha1: str) -> tuple[str, memoryview] | None:
+        data = self.get_image('raw', sha1)
+        if data is None:
+            return None
+        mime_end = data[0] + 1
+        return bytes(data[1:mime_end]).decode(), data[mime_end:]
+
+    def has_image(self, sha1: str):
+        row = self._rows.get(sha1)
+        return row is not None and any(self.packs[kind].has(row) for kind in ['small', 'medium', 'large'])
+
+    def has_raw_image(self, sha1: str):
+        row = self._rows.get(sha1)
+        return row is not None and self.packs['raw'].has(row)
+
+    async def delete_images(self, kinds: list[str], sha1s: list[str] = None):
+        """
+        Deletes the images of the given sha1s or all the images of each kind
+        """
+        loop = asyncio.get_running_loop()
+        async with self._write_lock:
+            for kind in kinds:
+                pack = self.packs[kind]
+                if sha1s is None:
+                    await loop.run_in_executor(None, pack.clear)
+                    self.available &= np.uint8(~kind_bits[kind] & 0xFF)
+                    self.cache.remove_kind(kind)
+                    continue
+                rows = [self._rows[sha1] for sha1 in sha1s if sha1 in self._rows]
+                if not rows:
+                    continue
+                await loop.run_in_executor(None, pack.write_deleted, [sha1 for sha1 in sha1s if sha1 in self._rows])
+                pack.ensure_capacity(len(self._rows))
+                pack.locations['pack'][rows] = -1
+                self._update_available(kind, rows)
+                for sha1 in sha1s:
+                    self.cache.remove(kind, sha1)
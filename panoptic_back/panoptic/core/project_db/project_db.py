@@ -1,17 +1,24 @@
 from __future__ import annotations
 
 import asyncio
+import logging
 from math import floor
 from random import randint
-from typing import Any, TYPE_CHECKING
+from typing import Any, AsyncIterable, TYPE_CHECKING
+
+import numpy as np
 
 if TYPE_CHECKING:
     from panoptic.core.project.project import Project
 
 from panoptic.core.project_db.db import Db
 from panoptic.core.project_db.db_connection import DbConnection
+from panoptic.core.project_db.image_store import ImageStore, image_kinds
+from panoptic.core.project_db.vector_precision import default_precision, get_precision, dequantize
+from panoptic.core.project_db.vector_search import VectorSearch
+from panoptic.core.project_db.vector_store import VectorStore
 from panoptic.core.project_db.utils import safe_update_tag_parents, verify_tag_color
-from panoptic.core.project.project_events import ImportInstanceEvent, DbUpdateEvent
+from panoptic.core.project.project_events import ImportInstanceEvent, DbUpdateEvent, ImportInstancesEvent
 from panoptic.core.project.undo_queue import UndoQueue
 from panoptic.models import Property, PropertyType, InstanceProperty, Instance, Tag, Vector, VectorDescription, \
     ProjectVectorDescriptions, PropertyMode, DbCommit, ImageProperty, DeleteFolderConfirm, ImagePropertyKey, \
@@ -20,6 +27,15 @@ from panoptic.models.computed_properties import computed_properties
 from panoptic.utils import convert_to_instance_values, get_computed_values, clean_and_separate_values, separate_ids, \
     get_model_params_description
 
+# max number of pending commits applied in the same transaction
+commit_batch_size = 64
+# number of images moved at once from the DB blobs to the image store
+image_migration_chunk_size = 500
+# number of instances read at once when loading the file index of an import
+file_index_chunk_size = 10_000
+# number of vectors read at once when a vector matrix is built from the DB
+vector_chunk_size = 10_000
+
 
 class ProjectDb:
     def __init__(self, conn: DbConnection, project: Project):
@@ -27,12 +43,77 @@ class ProjectDb:
         self._fake_id_counter = -100
         self.undo_queue = UndoQueue(self)
         self.on_import_instance = ImportInstanceEvent()
+        self.on_import_instances = ImportInstancesEvent()
         self.on_db_update = DbUpdateEvent()
         self._project = project
+        self.images = ImageStore(project.paths)
+        self.vectors = VectorStore(project.paths)
+        self.vector_search = VectorSearch(self.vectors)
+
+        self._pending_commits: asyncio.Queue[tuple[DbCommit, asyncio.Future]] = asyncio.Queue()
+        self._commit_writer: asyncio.Task | None = None
+        self._writing_batch: list[tuple[DbCommit, asyncio.Future]] = []
+
+    async def start(self):
+        await self.images.start()
+        await self._migrate_image_blobs()
+        await self._load_vector_matrices()
+        await self.vector_search.start()
 
     async def close(self):
+        if self._commit_writer and not self._commit_writer.done():
+            # let the writer apply the commits already queued before stopping it
+            await self._pending_commits.join()
+            self._commit_writer.cancel()
+            await asyncio.gather(self._commit_writer, return_exceptions=True)
+        pending = self._writing_batch
+        while not self._pending_commits.empty():
+            pending.append(self._pending_commits.get_nowait())
+        for _, future in pending:
+            if not future.done():
+                future.cancel()
+        await self.images.close()
+        await self.vector_search.close()
         await self._db.close()
 
+    async def _load_vector_matrices(self):
+        """
+        Builds again from the vectors table the matrices of a project opened for the first time or stopped by a crash
+        """
+        precisions = await self._get_vector_precisions()
+        for type_id in await self.vectors.start(await self._db.get_vector_stats(), precisions):
+            logging.info(f'Building the vector matrix of VectorType {type_id}')
+            await self._build_vector_matrix(type_id)
+
+    async def _build_vector_matrix(self, type_id: int):
+        """
+        Writes the matrix of the type again from the vectors table
+        """
+        await self.vectors.clear(type_id)
+        try:
+            async for rows in self._db.stream_vectors(type_id, vector_chunk_size):
+                await self.vectors.write(type_id, [r[0] for r in rows], np.stack([r[1] for r in rows]))
+        except ValueError as e:
+            # vectors of different sizes, the matrix is built again at next start
+            logging.error(e)
+            await self.vectors.clear(type_id)
+
+    async def _get_vector_precisions(self):
+        precisions = {}
+        for vector_type in await self._db.get_vector_types():
+            try:
+                precisions[vector_type.id] = get_precision(vector_type.params)
+            except ValueError as e:
+                logging.error(f'VectorType {vector_type.id}: {e}')
+                precisions[vector_type.id] = default_precision
+        return precisions
+
+    async def _get_vector_precision(self, type_id: int):
+        if type_id not in self.vectors.precisions:
+            for known_id, precision in (await self._get_vector_precisions()).items():
+                self.vectors.set_precision(known_id, precision)
+        return self.vectors.get_precision(type_id)
+
     def _get_fake_id(self):
         self._fake_id_counter -= 1
         return self._fake_id_counter
@@ -55,17 +136,88 @@ class ProjectDb:
     async def has_file(self, folder_id: int, name: str, extension: str):
         return await self._db.has_file(folder_id, name, extension)
 
+    async def get_file_index(self, folder_ids: list[int]) -> dict[tuple[int, str, str], Instance]:
+        """
+        Instances of the folders keyed by (folder_id, name, extension), to check a folder scan in one pass
+        """
+        index = {}
+        async for instances in self._db.stream_folder_instances(folder_ids, file_index_chunk_size):
+            for instance in instances:
+                index[(instance.folder_id, instance.name, instance.extension)] = instance
+        return index
+
+    async def get_file_fingerprints(self, folder_ids: list[int]) -> dict[int, tuple[int, int, int]]:
+        """
+        (size, mtime_ns, inode) of the instance files of the folders, keyed by instance id
+        """
+        res = {}
+        async for rows in self._db.stream_folder_fingerprints(folder_ids, file_index_chunk_size):
+            for instance_id, size, mtime_ns, inode in rows:
+                res[instance_id] = (size, mtime_ns, inode)
+        return res
+
+    def transaction(self):
+        """
+        Groups the DB writes of the current task in one transaction, see DbConnection.transaction
+        """
+        return self._db.conn.transaction()
+
+    async def set_file_fingerprints(self, fingerprints: list[tuple[int, int, int, int]]):
+        await self._db.import_file_fingerprints(fingerprints)
+
+    async def update_instance_files(self, instances: list[Instance]):
+        """
+        Gives new content to the instances of modified files, their ids and instance values are kept.
+        The image values follow the file to its new sha1 if the old one is not used anymore
+        """
+        if not instances:
+            return
+        old = {i.id: i.sha1 for i in await self._db.get_instances(ids=[i.id for i in instances])}
+        await self._db.update_instance_files(instances)
+        changed = {(old[i.id], i.sha1) for i in instances if i.id in old and old[i.id] != i.sha1}
+        unused = await self._get_unused_sha1s({sha1 for sha1, _ in changed})
+        await self._db.move_image_values([(sha1, new) for sha1, new in changed if sha1 in unused])
+        await self._delete_sha1s(unused)
+
+    async def delete_instances(self, ids: list[int]):
+        """
+        Deletes the instances of removed files, and the images of the sha1s not used anymore
+        """
+        sha1s = {i.sha1 for i in await self._db.get_instances(ids=ids)} if ids else set()
+        await self._db.delete_instances(ids)
+        deleted_sha1s = await self._get_unused_sha1s(sha1s)
+        await self._delete_sha1s(deleted_sha1s)
+
+        res = DeleteFolderConfirm(deleted_folders=[], deleted_instances=ids, deleted_sha1s=list(deleted_sha1s))
+        self.on_db_update.emit(DbUpdate(type_=UpdateType.FOLDERS, data=res))
+        self._project.on.sync.emitFoldersDelete()
+        return res
+
+    async def _get_unused_sha1s(self, sha1s: set[str]):
+        if not sha1s:
+            return set()
+        return sha1s - await self._db.get_used_sha1s(list(sha1s))
+
+    async def _delete_sha1s(self, sha1s: set[str]):
+        if not sha1s:
+            return
+        sha1s = list(sha1s)
+        await self.images.delete_images(list(image_kinds), sha1s)
+        await self._db.delete_image_values(sha1s)
+        await self._db.delete_vectors(sha1s)
+        await self.vectors.delete(sha1s)
+
     async def delete_small_images(self):
-        return await self._db.delete_small_images()
+        return await self.images.delete_images(['small'])
 
     async def delete_medium_images(self):
-        return await self._db.delete_medium_images()
+        return await self.images.delete_images(['medium'])
 
     async def delete_large_images(self):
-        return await self._db.delete_large_images()
+        return await self.images.delete_images(['large'])
 
     async def delete_raw_images(self):
-        return await self._db.delete_raw_images()
+        return await self.images.delete_images(['raw'])
 
     async def delete_property(self, prop_id: int):
         return await self._db.delete_property(prop_id)
@@ -177,28 +329,42 @@ class ProjectDb:
     # =====================================================
 
     async def import_image(self, sha1: str, small: bytes, medium: bytes, large: bytes):
-        return await self._db.import_image(sha1, small, medium, large)
+        await self.images.import_images([(sha1, small, medium, large)])
+        return sha1, small, medium, large
 
     async def import_raw_image(self, sha1: str, mime_type: str, data: bytes):
-        return await self._db.import_raw_image(sha1, mime_type, data)
+        return await self.images.import_raw_images([(sha1, mime_type, data)])
 
     async def get_small_image(self, sha1: str):
-        return await self._db.get_small_image(sha1)
+        return self.images.get_image('small', sha1)
 
     async def get_medium_image(self, sha1: str):
-        return await self._db.get_medium_image(sha1)
+        return self.images.get_image('medium', sha1)
 
     async def get_large_image(self, sha1: str):
-        return await self._db.get_large_image(sha1)
+        return self.images.get_image('large', sha1)
 
     async def has_image(self, sha1: str):
-        return await self._db.has_image(sha1)
+        return self.images.has_image(sha1)
 
     async def get_raw_image(self, sha1: str):
-        return await self._db.get_raw_image(sha1)
+        return self.images.get_raw_image(sha1)
 
     async def has_raw_image(self, sha1: str):
-        return await self._db.has_raw_image(sha1)
+        return self.images.has_raw_image(sha1)
+
+    async def _migrate_image_blobs(self):
+        """
+        Moves the thumbnails and raw files of older projects from the DB to the image store
+        The blobs are deleted in one transaction once both tables are copied, an interrupted migration starts over
+        """
+        if not await self._db.has_image_blobs():
+            return
+        async for rows in self._db.stream_image_blobs(chunk_size=image_migration_chunk_size):
+            await self.images.import_images(rows)
+        async for rows in self._db.stream_raw_image_blobs(chunk_size=image_migration_chunk_size):
+            await self.images.import_raw_images(rows)
+        await self._db.delete_image_blobs()
 
     # =====================================================
     # =================== Instances =======================
@@ -230,6 +396,9 @@ class ProjectDb:
         res = await self._db.count_instance_values(instance_ids)
         return set([i for i in instance_ids if i not in res])
 
+    async def get_all_instance_sha1s(self) -> set[str]:
+        return await self._db.get_all_instance_sha1s()
+
     async def get_all_instances_ids(self):
         return await self._db.get_all_instances_ids()
 
@@ -372,17 +541,36 @@ class ProjectDb:
 
         return updated_tags, updated_instance_values, updated_image_values, empty_instance_values, empty_image_values
 
+    # =========== Tasks ===========
+    async def get_pending_tasks(self) -> list[tuple[int, str, str]]:
+        return await self._db.get_pending_tasks()
+
+    async def update_pending_tasks(self, tasks: list[tuple[int, str, str]], deleted: list[int]):
+        """
+        Saves the new tasks of the queue and deletes the finished ones in one transaction
+        """
+        await self._db.update_pending_tasks(tasks, deleted)
+
     # =========== Folders ===========
     async def add_folder(self, path: str, name: str, parent: int = None):
         res = await self._db.add_folder(path, name, parent)
         return res
 
+    async def add_folders(self, folders: list[tuple[str, str, str | None]]) -> dict[str, int]:
+        return await self._db.add_folders(folders)
+
     async def get_folders(self):
         return await self._db.get_folders()
 
     async def get_folder(self, folder_id: int):
         return await self._db.get_folder(folder_id)
 
+    async def delete_empty_folders(self, folder_ids: list[int]):
+        """
+        Removes folders whose instances were already deleted, like the folders of a rescan that left the disk
+        """
+        await self._db.delete_folders(folder_ids)
+
     async def delete_folder(self, folder_id: int):
         old_folders = {f.id for f in await self._db.get_folders()}
         old_ids = await self._db.get_all_instances_ids()
@@ -398,10 +586,10 @@ class ProjectDb:
         deleted_ids = list(old_ids - now_ids)
         deleted_sha1s = list(old_sha1s - now_sha1s)
 
-        await self._db.delete_images(deleted_sha1s)
-        await self._db.delete_raw_images(deleted_sha1s)
+        await self.images.delete_images(list(image_kinds), deleted_sha1s)
         await self._db.delete_image_values(deleted_sha1s)
         await self._db.delete_vectors(deleted_sha1s)
+        await self.vectors.delete(deleted_sha1s)
 
         res = DeleteFolderConfirm(deleted_folders=deleted_folders, deleted_instances=deleted_ids,
                                   deleted_sha1s=deleted_sha1s)
@@ -422,13 +610,17 @@ class ProjectDb:
         if not vec:
             return False
         res = await self._db.delete_vector_type(id_)
+        await self.vectors.delete_type(id_)
+        await self.vector_search.delete_type(id_)
         plugin = next(p for p in self._project.plugins if p.name == vec.source)
         await plugin.load_vector_types()
         self._project.on.sync.emitVectorTypes(await self.get_vector_types())
         return res
 
     async def add_vector_type(self, vec: VectorType):
+        precision = get_precision(vec.params)
         res = await self._db.add_vector_type(vec)
+        self.vectors.set_precision(res.id, precision)
         plugin = next(p for p in self._project.plugins if p.name == vec.source)
         await plugin.load_vector_types()
         self._project.on.sync.emitVectorTypes(await self.get_vector_types())
@@ -438,7 +630,69 @@ class ProjectDb:
         return VectorType(id=self._get_fake_id(), source=source, params=params)
 
     async def add_vector(self, vector: Vector):
-        return await self._db.add_vector(vector)
+        # the matrix checks the size of the vector before it is in the DB
+        precision = await self._get_vector_precision(vector.type_id)
+        await self.vectors.write(vector.type_id, [vector.sha1], vector.data)
+        res = await self._db.add_vector(vector, precision)
+        await self.vector_search.add(vector.type_id, [vector.sha1])
+        return res
+
+    async def add_vectors(self, type_id: int, sha1s: list[str], matrix: np.ndarray):
+        """
+        Adds one vector per sha1, the rows of a 2-D array, in one transaction then one write of the matrix.
+        The matrix is only written once the rows are committed, it is built again from the table if that fails
+        """
+        matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+        if matrix.ndim != 2 or len(matrix) != len(sha1s):
+            raise ValueError(f'Expected a matrix of {len(sha1s)} rows, got shape {matrix.shape}')
+        if not sha1s:
+            return 0
+        precision = await self._get_vector_precision(type_id)
+        dim = self.vectors.get_dim(type_id)
+        if dim and matrix.shape[1] != dim:
+            raise ValueError(f'Vectors of size {matrix.shape[1]} given to VectorType {type_id} of size {dim}')
+        async with self.transaction():
+            await self._db.add_vectors(type_id, sha1s, matrix, precision)
+        try:
+            await self.vectors.write(type_id, sha1s, matrix)
+        except Exception:
+            # the table is the reference, the matrix doesn't keep a part of the batch
+            await self._build_vector_matrix(type_id)
+            await self.vector_search.reassign(type_id)
+            raise
+        await self.vector_search.add(type_id, sha1s)
+        return len(sha1s)
+
+    async def add_vectors_stream(self, type_id: int, batches: AsyncIterable[tuple[list[str], np.ndarray]]):
+        """
+        Adds the (sha1s, matrix) batches of an async iterator. A batch is written while the next one is computed.
+        Returns the number of vectors added
+        """
+        count = 0
+        writing: asyncio.Task | None = None
+        try:
+            async for sha1s, matrix in batches:
+                if writing is not None:
+                    count += await writing
+                writing = asyncio.create_task(self.add_vectors(type_id, sha1s, matrix))
+            if writing is not None:
+                count += await writing
+        except BaseException:
+            # the batch being written is not left half done
+            if writing is not None and not writing.done():
+                await asyncio.shield(writing)
+            raise
+        return count
+
+    async def get_vector_matrix(self, type_id: int) -> tuple[list[str], np.ndarray]:
+        """
+        sha1 of each row and a read-only view on the float32 vector matrix of the type, without copy.
+        A type stored with a reduced precision gives a dequantized copy
+        """
+        sha1s, matrix = await self.vectors.get_matrix(type_id)
+        if matrix.dtype != np.float32:
+            matrix = await asyncio.get_running_loop().run_in_executor(None, dequantize, matrix)
+        return sha1s, matrix
 
     async def vector_exist(self, vec_id: int, sha1: str) -> bool:
         return await self._db.vector_exist(vec_id, sha1)
@@ -470,11 +724,52 @@ class ProjectDb:
         return res
 
     async def apply_commit(self, commit: DbCommit):
-        inverse = await self._apply_commit(commit)
+        if self._db.conn.in_transaction():
+            inverse = await self._apply_commit(commit)
+        else:
+            future = asyncio.get_running_loop().create_future()
+            self._pending_commits.put_nowait((commit, future))
+            if self._commit_writer is None or self._commit_writer.done():
+                self._commit_writer = asyncio.create_task(self._write_commits())
+            inverse = await future
         self.on_db_update.emit(DbUpdate(type_=UpdateType.COMMIT, data=commit))
         self._project.on.sync.emitCommit(commit)
         return inverse
 
+    async def _write_commits(self):
+        """
+        Group commit writer. Applies the pending commits of all callers by batches, one transaction per batch.
+        Each commit gets its own savepoint so a failing commit doesn't roll back the rest of the batch
+        and each caller receives its own inverse
+        """
+        while True:
+            batch = [await self._pending_commits.get()]
+            while len(batch) < commit_batch_size and not self._pending_commits.empty():
+                batch.append(self._pending_commits.get_nowait())
+            self._writing_batch = batch
+
+            results: list[DbCommit | Exception] = []
+            try:
+                async with self._db.conn.transaction():
+                    for i, (commit, _) in enumerate(batch):
+                        try:
+                            async with self._db.conn.savepoint(f'commit_{i}'):
+                                results.append(await self._apply_commit(commit))
+                        except Exception as e:
+                            results.append(e)
+            except Exception as e:
+                results = [e] * len(batch)
+
+            for (_, future), res in zip(batch, results):
+                self._pending_commits.task_done()
+                if future.done():
+                    continue
+                if isinstance(res, Exception):
+                    future.set_exception(res)
+                else:
+                    future.set_result(res)
+            self._writing_batch = []
+
     async def _apply_commit(self, commit: DbCommit):
         inverse = DbCommit()
         inverse.timestamp = commit.timestamp
@@ -671,7 +966,7 @@ class ProjectDb:
             ORDER BY rowid ASC
             LIMIT ?;
             """
-            cursor = await self._db.conn.execute_query(query, (position, chunk_size))
+            cursor = await self._db.conn.execute_read(query, (position, chunk_size))
             rows = await cursor.fetchall()
 
             if not rows:
@@ -722,6 +1017,9 @@ class ProjectDb:
                 setattr(settings, name, db_value)
         return settings
 
+    async def set_db_readers(self, nb: int):
+        await self._db.conn.set_readers(nb)
+
     async def get_vector_stats(self):
         count = await self._db.get_vector_stats()
         sha1_count = await self._db.get_distinct_sha1_count()
@@ -1,4 +1,5 @@
 import json
+from collections import defaultdict
 from json import JSONDecodeError
 from random import randint
 
@@ -17,6 +18,17 @@ def decode_if_json(value):
         return value
 
 
+def group_keys_by_property(keys: list, key_field: str) -> dict[int, list]:
+    """
+    Group InstancePropertyKey / ImagePropertyKey by property_id
+    Used to send the keys as one json array per property instead of chained OR conditions
+    """
+    groups = defaultdict(list)
+    for key in keys:
+        groups[key.property_id].append(getattr(key, key_field))
+    return groups
+
+
 def find_path(tag_index: dict[int, Tag], source: int, target: int):
     if source == 0:
         return False
@@ -0,0 +1,164 @@
+from __future__ import annotations
+
+import os
+from pathlib import Path
+
+import numpy as np
+
+from panoptic.core.project_db.vector_precision import directions
+
+# number of lists of the index of n vectors, ivf_lists_per_sqrt * sqrt(n) up to ivf_max_lists
+ivf_lists_per_sqrt = 4
+ivf_max_lists = 1024
+# vectors sampled per list to train the centroids
+ivf_train_per_list = 64
+ivf_train_iterations = 15
+# lists scanned for each query by default
+ivf_nprobe = 16
+# rows given their list at once
+assign_block_size = 32_768
+# vectors with a smaller norm are left as they are instead of normalized
+min_norm = 1e-12
+
+
+def normalize(vectors: np.ndarray):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, min_norm)
+
+
+def top_k(scores: np.ndarray, k: int):
+    """
+    Indices of the k best scores, best first
+    """
+    if len(scores) > k:
+        best = np.argpartition(-scores, k - 1)[:k]
+    else:
+        best = np.arange(len(scores))
+    return best[np.argsort(-scores[best], kind='stable')]
+
+
+class IvfIndex:
+    """
+    Inverted file index of a vector matrix. The rows are split into lists by spherical k-means and a query only
+    scans the rows of the lists whose centroids are the closest to it
+    """
+    def __init__(self, centroids: np.ndarray, assign: np.ndarray):
+        self.centroids = centroids
+        # list of each row of the matrix, -1 for a row without list
+        self.assign = assign
+        self.lists = self._make_lists(assign, len(centroids))
+
+    @staticmethod
+    def _make_lists(assign: np.ndarray, nb_lists: int):
+        order = np.argsort(assign, kind='stable')
+        bounds = np.searchsorted(assign[order], np.arange(nb_lists + 1))
+        return [order[bounds[i]:bounds[i + 1]] for i in range(nb_lists)]
+
+    @staticmethod
+    def nb_lists(size: int):
+        return max(1, min(ivf_max_lists, int(ivf_lists_per_sqrt * np.sqrt(size))))
+
+    @classmethod
+    def train(cls, matrix: np.ndarray, seed: int = 0) -> IvfIndex:
+        """
+        k-means on a sample of the matrix then every row is put in the list of its closest centroid. Blocking
+        """
+        rng = np.random.default_rng(seed)
+        nb_lists = cls.nb_lists(len(matrix))
+        sample_size = min(len(matrix), nb_lists * ivf_train_per_list)
+        sample = normalize(directions(matrix[np.sort(rng.choice(len(matrix), sample_size, replace=False))]))
+        centroids = sample[rng.choice(len(sample), nb_lists, replace=False)]
+        for _ in range(ivf_train_iterations):
+            labels = np.argmax(sample @ centroids.T, axis=1)
+            order = np.argsort(labels, kind='stable')
+            used, starts = np.unique(labels[order], return_index=True)
+            sums = np.add.reduceat(sample[order], starts, axis=0)
+            # an empty list takes a random vector of the sample
+            centroids = sample[rng.choice(len(sample), nb_lists)]
+            centroids[used] = normalize(sums)
+        return cls(centroids, cls._assign(centroids, matrix))
+
+    @staticmethod
+    def _assign(centroids: np.ndarray, vectors: np.ndarray):
+        # the norm of a row doesn't change its closest centroid
+        labels = np.zeros(len(vectors), dtype=np.int32)
+        for start in range(0, len(vectors), assign_block_size):
+            block = directions(vectors[start:start + assign_block_size])
+            labels[start:start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+        return labels
+
+    def add(self, rows: np.ndarray, vectors: np.ndarray):
+        """
+        Puts new or replaced rows in the list of their closest centroid
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        if not len(rows):
+            return
+        if rows.max() >= len(self.assign):
+            assign = np.full(int(rows.max()) + 1, -1, dtype=np.int32)
+            assign[:len(self.assign)] = self.assign
+            self.assign = assign
+        labels = self._assign(self.centroids, vectors)
+        moved = self.assign[rows] >= 0
+        for old in np.unique(self.assign[rows[moved]]):
+            self.lists[old] = self.lists[old][~np.isin(self.lists[old], rows)]
+        self.assign[rows] = labels
+        for label in np.unique(labels):
+            self.lists[label] = np.concatenate([self.lists[label], rows[labels == label]])
+
+    def remap(self, keep: np.ndarray):
+        """
+        Follows the compaction of the matrix, keep holds the old rows still in the matrix in their new order
+        """
+        mapping = np.full(max(len(self.assign), int(keep.max()) + 1 if len(keep) else 0), -1, dtype=np.int64)
+        mapping[keep] = np.arange(len(keep))
+        assign = np.full(len(mapping), -1, dtype=np.int32)
+        assign[:len(self.assign)] = self.assign
+        self.assign = assign[keep]
+        lists = [mapping[rows] for rows in self.lists]
+        self.lists = [rows[rows >= 0] for rows in lists]
+
+    def search(self, matrix: np.ndarray, queries: np.ndarray, k: int, nprobe: int = ivf_nprobe):
+        """
+        Rows of the k vectors closest to each normalized query by cosine similarity, best first, and their scores
+        """
+        nprobe = min(nprobe, len(self.centroids))
+        probes = np.argpartition(-(queries @ self.centroids.T), nprobe - 1, axis=1)[:, :nprobe]
+        res = []
+        for query, probe in zip(queries, probes):
+            rows = np.sort(np.concatenate([self.lists[p] for p in probe]))
+            rows = rows[rows < len(matrix)]
+            vectors = directions(matrix[rows])
+            scores = (vectors @ query) / np.maximum(np.linalg.norm(vectors, axis=1), min_norm)
+            best = top_k(scores, k)
+            res.append((rows[best], scores[best]))
+        return res
+
+    def save(self, path: Path, sha1s: list[str | None]):
+        """
+        The lists are saved by sha1 so they can be loaded on a matrix built again
+        """
+        size = min(len(sha1s), len(self.assign))
+        keys = np.frombuffer(b''.join(bytes.fromhex(sha1) if sha1 else bytes(20) for sha1 in sha1s[:size]),
+                             dtype='V20')
+        tmp = path.with_name(path.name + '.tmp')
+        with open(tmp, 'wb') as file:
+            np.savez(file, centroids=self.centroids, sha1s=keys, assign=self.assign[:size])
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path: Path, rows: dict[str, int], size: int) -> IvfIndex:
+        """
+        The rows of the matrix that were not in the saved index have no list
+        """
+        with np.load(path) as data:
+            centroids = data['centroids']
+            keys = data['sha1s']
+            saved = data['assign']
+        assign = np.full(size, -1, dtype=np.int32)
+        for key, label in zip(keys, saved):
+            row = rows.get(bytes(key).hex())
+            if row is not None:
+                assign[row] = label
+        return cls(centroids, assign)
@@ -0,0 +1,104 @@
+from __future__ import annotations
+
+from typing import Any
+
+import numpy as np
+
+# dtype of the stored vectors for each precision a VectorType can ask with params['precision']
+precisions = {
+    'float32': np.dtype('<f4'),
+    'float16': np.dtype('<f2'),
+    # rounded to max(|v|) / 127, the float32 scale of the vector is kept in the first bytes of its row
+    'int8': np.dtype('i1'),
+}
+default_precision = 'float32'
+# bytes of the scale in front of an int8 vector
+scale_size = 4
+# prefix of the reduced precision blobs of the vectors table, float32 blobs have none. It reads as a float32 NaN
+# that no stored vector starts with
+blob_magic = {
+    'float16': b'\x16\x00\xc0\x7f',
+    'int8': b'\x08\x00\xc0\x7f',
+}
+
+
+def get_precision(params: Any) -> str:
+    """
+    Storage precision of a VectorType from its params, float32 if it doesn't ask for one
+    """
+    precision = params.get('precision', default_precision) if isinstance(params, dict) else default_precision
+    if precision not in precisions:
+        raise ValueError(f'Unknown vector precision {precision}, expected one of {list(precisions)}')
+    return precision
+
+
+def get_dtype_precision(dtype: np.dtype) -> str:
+    return next(p for p, d in precisions.items() if d == dtype)
+
+
+def row_width(precision: str, dim: int):
+    """
+    Columns of the stored matrix for vectors of size dim
+    """
+    return dim + scale_size if precision == 'int8' else dim
+
+
+def quantize(vectors: np.ndarray, precision: str) -> np.ndarray:
+    """
+    Stored form of a float32 matrix
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if precision == 'float32':
+        return vectors
+    if precision == 'float16':
+        return vectors.astype(np.float16)
+    scales = (np.abs(vectors).max(axis=1, initial=0) / 127).astype('<f4')
+    stored = np.empty((len(vectors), vectors.shape[1] + scale_size), dtype=np.int8)
+    stored[:, :scale_size] = scales.view(np.int8).reshape(-1, scale_size)
+    # a null vector keeps a null scale
+    stored[:, scale_size:] = np.clip(np.rint(vectors / np.where(scales > 0, scales, 1)[:, None]), -127, 127)
+    return stored
+
+
+def dequantize(stored: np.ndarray) -> np.ndarray:
+    """
+    float32 matrix of stored vectors, without copy when they are float32
+    """
+    if stored.dtype == np.float32:
+        return stored
+    if stored.dtype == np.float16:
+        return stored.astype(np.float32)
+    scales = np.ascontiguousarray(stored[:, :scale_size]).view('<f4')
+    return stored[:, scale_size:].astype(np.float32) * scales
+
+
+def directions(stored: np.ndarray) -> np.ndarray:
+    """
+    float32 vectors with the direction of the stored ones, enough for cosine similarities. The int8 vectors keep
+    their values and skip the product by their scale
+    """
+    if stored.dtype == np.int8:
+        return stored[:, scale_size:].astype(np.float32)
+    return dequantize(stored)
+
+
+def to_blobs(vectors: np.ndarray, precision: str) -> list:
+    """
+    Values of the data column of the vectors table for the rows of a matrix
+    """
+    stored = np.ascontiguousarray(quantize(np.atleast_2d(vectors), precision))
+    if precision == 'float32':
+        return list(stored)
+    magic = blob_magic[precision]
+    return [magic + row.tobytes() for row in stored]
+
+
+def from_blob(blob: bytes) -> np.ndarray:
+    """
+    float32 vector of a blob of the vectors table
+    """
+    for precision, magic in blob_magic.items():
+        if blob[:len(magic)] == magic:
+            stored = np.frombuffer(blob, dtype=precisions[precision], offset=len(magic))
+            return dequantize(stored.reshape(1, -1))[0]
+    return np.frombuffer(blob, dtype='float32')
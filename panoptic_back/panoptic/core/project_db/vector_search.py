@@ -0,0 +1,217 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+from dataclasses import dataclass
+from typing import Awaitable, Callable
+
+import numpy as np
+
+from panoptic.core.project_db.vector_index import IvfIndex, normalize, min_norm
+from panoptic.core.project_db.vector_precision import directions
+from panoptic.core.project_db.vector_store import VectorStore
+
+# rows of the matrix multiplied at once with the queries
+search_block_size = 32_768
+
+
+@dataclass(slots=True)
+class SearchBlocks:
+    version: int
+    sha1s: list[str]
+    rows: dict[str, int]
+    # (start row, view on the stored rows, inverse of their norms)
+    blocks: list[tuple[int, np.ndarray, np.ndarray]]
+
+
+def _merge_top_k(scores: np.ndarray, rows: np.ndarray, k: int):
+    """
+    Keeps the k best columns of each line, unordered
+    """
+    if scores.shape[1] <= k:
+        return scores, rows
+    best = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    return np.take_along_axis(scores, best, 1), np.take_along_axis(rows, best, 1)
+
+
+def search_blocks(blocks: list[tuple[int, np.ndarray, np.ndarray]], queries: np.ndarray, k: int):
+    """
+    Rows of the k vectors closest to each normalized query by cosine similarity, best first, and their scores.
+    The blocks of a reduced precision matrix are converted to float32 one at a time
+    """
+    best_scores = np.zeros((len(queries), 0), dtype=np.float32)
+    best_rows = np.zeros((len(queries), 0), dtype=np.int64)
+    for start, block, inverse_norms in blocks:
+        scores = (queries @ directions(block).T) * inverse_norms
+        block_scores, block_rows = _merge_top_k(scores, np.broadcast_to(np.arange(len(block)), scores.shape), k)
+        best_scores, best_rows = _merge_top_k(np.concatenate([best_scores, block_scores], axis=1),
+                                              np.concatenate([best_rows, block_rows + start], axis=1), k)
+    order = np.argsort(-best_scores, axis=1, kind='stable')
+    return np.take_along_axis(best_rows, order, 1), np.take_along_axis(best_scores, order, 1)
+
+
+class VectorSearch:
+    """
+    k nearest neighbours by cosine similarity over the vector matrices of a VectorStore.
+    The exact search reads the matrix by blocks from its mapping, the inverse norms of the rows are computed once per
+    version of the matrix so the stored vectors are never copied. A VectorType can also have an IvfIndex for
+    approximate searches, kept up to date with the matrix and saved next to it. The searches run in the executor
+    """
+    def __init__(self, store: VectorStore):
+        self.store = store
+        self.indexes: dict[int, IvfIndex] = {}
+        self._blocks: dict[int, SearchBlocks] = {}
+        self._lock = asyncio.Lock()
+        # indexes changed since they were saved
+        self._dirty: set[int] = set()
+        store.compact_listeners.append(self._compacted)
+
+    def _compacted(self, type_id: int, keep: np.ndarray):
+        index = self.indexes.get(type_id)
+        if index is not None:
+            index.remap(keep)
+            self._dirty.add(type_id)
+
+    def _load_indexes(self):
+        for path in self.store.paths.vectors.glob('*.ivf.npz'):
+            type_id = int(path.name.split('.')[0])
+            matrix = self.store.matrices.get(type_id)
+            if matrix is None or not matrix.count:
+                path.unlink()
+                continue
+            try:
+                index = IvfIndex.load(path, matrix.rows, matrix.size)
+            except (OSError, ValueError, KeyError) as e:
+                logging.error(f'Could not load the vector index of VectorType {type_id}: {e}')
+                path.unlink()
+                continue
+            # vectors added after the index was last saved
+            missing = [row for row in np.flatnonzero(index.assign < 0) if matrix.sha1s[row] is not None]
+            if missing:
+                index.add(np.array(missing), matrix.read(missing))
+                self._dirty.add(type_id)
+            self.indexes[type_id] = index
+
+    def _save_indexes(self, type_ids: list[int]):
+        for type_id in type_ids:
+            if type_id in self.indexes:
+                self.indexes[type_id].save(self.store.paths.get_vector_ann_path(type_id),
+                                           self.store.matrices[type_id].sha1s)
+
+    async def start(self):
+        await self.store.run(self._load_indexes)
+
+    async def close(self):
+        dirty, self._dirty = list(self._dirty), set()
+        await self.store.run(self._save_indexes, dirty)
+
+    async def build_index(self, type_id: int, run_async: Callable[..., Awaitable]):
+        """
+        Trains a new IvfIndex on the matrix with run_async, then replaces the previous one
+        """
+        _, matrix = await self.store.get_matrix(type_id)
+        if not len(matrix):
+            return None
+        compactions = self.store.get_compactions(type_id)
+        index = await run_async(IvfIndex.train, matrix)
+        await self.store.run(self._set_index, type_id, index, len(matrix), compactions)
+        return index
+
+    def _set_index(self, type_id: int, index: IvfIndex, trained_size: int, compactions: int):
+        matrix = self.store.matrices.get(type_id)
+        if matrix is None or not matrix.count:
+            return
+        # the vectors added while the index was trained are given a list
+        if matrix.compactions != compactions:
+            index = IvfIndex(index.centroids, np.zeros(0, dtype=np.int32))
+            trained_size = 0
+        added = np.arange(trained_size, matrix.size)
+        index.add(added, matrix.read(added))
+        self.indexes[type_id] = index
+        self._dirty.discard(type_id)
+        self._save_indexes([type_id])
+
+    async def reassign(self, type_id: int):
+        """
+        Gives all the vectors of the matrix to the lists of the index again, its rows changed when it was built again
+        """
+        index = self.indexes.get(type_id)
+        if index is not None:
+            empty = IvfIndex(index.centroids, np.zeros(0, dtype=np.int32))
+            await self.store.run(self._set_index, type_id, empty, 0, self.store.get_compactions(type_id))
+
+    def _add(self, type_id: int, sha1s: list[str]):
+        rows = [row for row in self.store.get_rows(type_id, sha1s) if row is not None]
+        self.indexes[type_id].add(np.array(rows), self.store.matrices[type_id].read(rows))
+        self._dirty.add(type_id)
+
+    async def add(self, type_id: int, sha1s: list[str]):
+        """
+        Puts the vectors written for these sha1s in the index of the type, if it has one
+        """
+        if type_id in self.indexes:
+            await self.store.run(self._add, type_id, sha1s)
+
+    async def delete_type(self, type_id: int):
+        self.indexes.pop(type_id, None)
+        self._blocks.pop(type_id, None)
+        self._dirty.discard(type_id)
+        self.store.paths.get_vector_ann_path(type_id).unlink(missing_ok=True)
+
+    @staticmethod
+    def _prepare(matrix: np.ndarray):
+        blocks = []
+        for start in range(0, len(matrix), search_block_size):
+            block = matrix[start:start + search_block_size]
+            norms = np.linalg.norm(directions(block), axis=1)
+            blocks.append((start, block, (1 / np.maximum(norms, min_norm)).astype(np.float32)))
+        return blocks
+
+    async def get_blocks(self, type_id: int) -> SearchBlocks:
+        async with self._lock:
+            cached = self._blocks.get(type_id)
+            if cached is not None and cached.version == self.store.get_version(type_id):
+                return cached
+            sha1s, matrix = await self.store.get_matrix(type_id)
+            version = self.store.get_version(type_id)
+            blocks = await asyncio.get_running_loop().run_in_executor(None, self._prepare, matrix)
+            rows = {sha1: row for row, sha1 in enumerate(sha1s)}
+            self._blocks[type_id] = SearchBlocks(version, sha1s, rows, blocks)
+            return self._blocks[type_id]
+
+    async def search(self, type_id: int, queries: np.ndarray, k: int, nprobe: int | None = None) \
+            -> list[list[tuple[str, float]]]:
+        """
+        The k closest sha1s of each query vector with their cosine similarity, best first.
+        With nprobe the search is approximate and scans nprobe lists of the index, if the type has one
+        """
+        loop = asyncio.get_running_loop()
+        if not len(queries):
+            return []
+        queries = normalize(queries)
+        index = self.indexes.get(type_id)
+        if nprobe is not None and index is not None:
+            sha1s, matrix = await self.store.get_matrix(type_id)
+            res = await loop.run_in_executor(None, index.search, matrix, queries, k, nprobe)
+            return [[(sha1s[row], float(score)) for row, score in zip(rows, scores)] for rows, scores in res]
+
+        blocks = await self.get_blocks(type_id)
+        if not blocks.blocks:
+            return [[] for _ in range(len(queries))]
+        rows, scores = await loop.run_in_executor(None, search_blocks, blocks.blocks, queries, k)
+        return [[(blocks.sha1s[row], float(score)) for row, score in zip(r, s)] for r, s in zip(rows, scores)]
+
+    async def search_sha1s(self, type_id: int, sha1s: list[str], k: int, nprobe: int | None = None) \
+            -> list[list[tuple[str, float]]]:
+        """
+        The k sha1s closest to each sha1, without itself. A sha1 without vector has no result
+        """
+        known = [sha1 for sha1, row in zip(sha1s, self.store.get_rows(type_id, sha1s)) if row is not None]
+        if not known:
+            return [[] for _ in sha1s]
+        queries = await self.store.run(self._read, type_id, known)
+        results = dict(zip(known, await self.search(type_id, queries, k + 1, nprobe)))
+        return [[r for r in results[sha1] if r[0] != sha1][:k] if sha1 in results else [] for sha1 in sha1s]
+
+    def _read(self, type_id: int, sha1s: list[str]):
+        return self.store.matrices[type_id].read(self.store.get_rows(type_id, sha1s))
@@ -0,0 +1,317 @@
+from __future__ import annotations
+
+import asyncio
+import os
+from typing import TYPE_CHECKING, Callable
+
+import numpy as np
+
+from panoptic.core.project_db.vector_precision import default_precision, precisions, get_dtype_precision, row_width, \
+    quantize, dequantize
+
+if TYPE_CHECKING:
+    from panoptic.core.project.project_paths import ProjectPaths
+
+# size of the .npy header, enough for any shape so the header is rewritten in place when rows are appended
+header_size = 128
+# a matrix is compacted once this share of its rows are deleted
+compact_ratio = 0.25
+# number of rows copied at once when a matrix is compacted
+compact_chunk_size = 10_000
+# index record of a deleted row
+deleted_record = bytes(20)
+
+
+class VectorMatrix:
+    """
+    Vectors of one VectorType in a .npy file mapped with numpy.memmap, and the sha1 of each row in an index file.
+    New sha1s are appended, known ones are replaced in place and deleted rows are blanked in the index until
+    the matrix is compacted. Data is always flushed before the index and the index before the header.
+    The vectors are stored with the precision of the matrix, given by the dtype of the file
+    """
+    def __init__(self, paths: ProjectPaths, type_id: int, precision: str = default_precision):
+        self.paths = paths
+        self.type_id = type_id
+        self.precision = precision
+        self.dim = 0
+        # rows in the file, deleted ones included
+        self.size = 0
+        self.deleted = 0
+        # sha1 of each row, None for a deleted row
+        self.sha1s: list[str | None] = []
+        self.rows: dict[str, int] = {}
+        # changes with the content, to know when what was computed from the matrix is outdated
+        self.version = 0
+        self.compactions = 0
+        # called with the kept rows, in their order, when the matrix is compacted
+        self.on_compact: Callable[[np.ndarray], None] | None = None
+        self._map: np.memmap | None = None
+
+    @property
+    def count(self):
+        return self.size - self.deleted
+
+    @property
+    def dtype(self):
+        return precisions[self.precision]
+
+    @property
+    def width(self):
+        return row_width(self.precision, self.dim)
+
+    def load(self):
+        matrix_path = self.paths.get_vector_matrix_path(self.type_id)
+        index_path = self.paths.get_vector_index_path(self.type_id)
+        if not matrix_path.exists() or not index_path.exists():
+            return
+        with open(matrix_path, 'rb') as file:
+            np.lib.format.read_magic(file)
+            shape, _, dtype = np.lib.format.read_array_header_1_0(file)
+        self.precision = get_dtype_precision(dtype)
+        self.dim = shape[1] - row_width(self.precision, 0)
+        records = np.fromfile(index_path, dtype='V20')
+        # rows cut by a crash are dropped
+        file_rows = (matrix_path.stat().st_size - header_size) // (self.width * self.dtype.itemsize)
+        self.size = min(shape[0], len(records), file_rows)
+        self.sha1s = [None if bytes(r) == deleted_record else bytes(r).hex() for r in records[:self.size]]
+        self.rows = {sha1: row for row, sha1 in enumerate(self.sha1s) if sha1 is not None}
+        self.deleted = self.size - len(self.rows)
+        self._remap()
+
+    def _remap(self):
+        self.version += 1
+        if self.size == 0:
+            self._map = None
+            return
+        path = self.paths.get_vector_matrix_path(self.type_id)
+        self._map = np.memmap(path, dtype=self.dtype, mode='r+', offset=header_size, shape=(self.size, self.width))
+
+    def _write_header(self, file, rows: int):
+        file.seek(0)
+        np.lib.format.write_array_header_1_0(file, {'descr': np.lib.format.dtype_to_descr(self.dtype),
+                                                    'fortran_order': False, 'shape': (rows, self.width)})
+        assert file.tell() == header_size
+
+    def _create(self, dim: int):
+        self.dim = dim
+        with open(self.paths.get_vector_matrix_path(self.type_id), 'wb') as file:
+            self._write_header(file, 0)
+        open(self.paths.get_vector_index_path(self.type_id), 'wb').close()
+
+    def write(self, sha1s: list[str], vectors: np.ndarray):
+        """
+        Writes one vector per sha1. Blocking, run it in an executor
+        """
+        if not sha1s:
+            return
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(len(sha1s), -1)
+        if self.dim == 0:
+            self._create(vectors.shape[1])
+        if vectors.shape[1] != self.dim:
+            raise ValueError(f'Vectors of size {vectors.shape[1]} given to VectorType {self.type_id} '
+                             f'of size {self.dim}')
+        vectors = quantize(vectors, self.precision)
+
+        # the last vector of a sha1 wins
+        new: dict[str, int] = {}
+        replaced: dict[int, int] = {}
+        for i, sha1 in enumerate(sha1s):
+            row = self.rows.get(sha1)
+            if row is None:
+                new[sha1] = i
+            else:
+                replaced[row] = i
+        if replaced:
+            self._map[list(replaced)] = vectors[list(replaced.values())]
+            self._map.flush()
+            self.version += 1
+        if not new:
+            return
+
+        with open(self.paths.get_vector_matrix_path(self.type_id), 'r+b') as file:
+            file.seek(header_size + self.size * self.width * self.dtype.itemsize)
+            file.write(np.ascontiguousarray(vectors[list(new.values())]).tobytes())
+            file.flush()
+            with open(self.paths.get_vector_index_path(self.type_id), 'ab') as index:
+                index.write(b''.join(bytes.fromhex(sha1) for sha1 in new))
+            self._write_header(file, self.size + len(new))
+        for sha1 in new:
+            self.rows[sha1] = self.size
+            self.sha1s.append(sha1)
+            self.size += 1
+        self._remap()
+
+    def delete(self, sha1s: list[str]):
+        rows = [self.rows.pop(sha1) for sha1 in sha1s if sha1 in self.rows]
+        if not rows:
+            return
+        with open(self.paths.get_vector_index_path(self.type_id), 'r+b') as index:
+            for row in sorted(rows):
+                index.seek(row * len(deleted_record))
+                index.write(deleted_record)
+                self.sha1s[row] = None
+        self.deleted += len(rows)
+        self.version += 1
+        if self.deleted > self.size * compact_ratio:
+            self.compact()
+
+    def compact(self):
+        """
+        Rewrites the matrix and its index without the deleted rows. The views given before keep the old file
+        """
+        if not self.deleted:
+            return
+        keep = np.array([row for row, sha1 in enumerate(self.sha1s) if sha1 is not None], dtype=np.int64)
+        matrix_path = self.paths.get_vector_matrix_path(self.type_id)
+        index_path = self.paths.get_vector_index_path(self.type_id)
+        matrix_tmp = matrix_path.with_name(matrix_path.name + '.tmp')
+        index_tmp = index_path.with_name(index_path.name + '.tmp')
+        with open(matrix_tmp, 'wb') as file:
+            self._write_header(file, len(keep))
+            for start in range(0, len(keep), compact_chunk_size):
+                file.write(np.ascontiguousarray(self._map[keep[start:start + compact_chunk_size]]).tobytes())
+        sha1s = [self.sha1s[row] for row in keep]
+        with open(index_tmp, 'wb') as index:
+            index.write(b''.join(bytes.fromhex(sha1) for sha1 in sha1s))
+        os.replace(matrix_tmp, matrix_path)
+        os.replace(index_tmp, index_path)
+
+        self.sha1s = sha1s
+        self.rows = {sha1: row for row, sha1 in enumerate(sha1s)}
+        self.size = len(sha1s)
+        self.deleted = 0
+        self.compactions += 1
+        self._remap()
+        if self.on_compact:
+            self.on_compact(keep)
+
+    def clear(self):
+        self._map = None
+        self.version += 1
+        self.paths.get_vector_matrix_path(self.type_id).unlink(missing_ok=True)
+        self.paths.get_vector_index_path(self.type_id).unlink(missing_ok=True)
+        self.dim = self.size = self.deleted = 0
+        self.sha1s = []
+        self.rows = {}
+
+    def read(self, rows) -> np.ndarray:
+        """
+        float32 copy of the vectors of the rows
+        """
+        if not len(rows):
+            return np.zeros((0, self.dim), dtype=np.float32)
+        return np.asarray(dequantize(self._map[rows]))
+
+    def view(self) -> tuple[list[str], np.ndarray]:
+        """
+        sha1 of each row and a read-only view on the mapped matrix, without copy. Compacts the matrix first.
+        The rows are in the stored precision, see vector_precision.dequantize
+        """
+        self.compact()
+        if self._map is None:
+            return [], np.zeros((0, self.width), dtype=self.dtype)
+        view = self._map.view(np.ndarray)
+        view.flags.writeable = False
+        return list(self.sha1s), view
+
+
+class VectorStore:
+    """
+    Vectors of a project as one contiguous matrix per VectorType under the vectors folder, next to the vectors
+    table of the DB that stays the reference. A matrix that doesn't match the table or the precision of its type
+    at start is built again
+    """
+    def __init__(self, paths: ProjectPaths):
+        self.paths = paths
+        self.matrices: dict[int, VectorMatrix] = {}
+        # precision of the types, the ones missing are float32
+        self.precisions: dict[int, str] = {}
+        # called with the type id and the kept rows when a matrix is compacted, from the executor
+        self.compact_listeners: list[Callable[[int, np.ndarray], None]] = []
+        self._write_lock = asyncio.Lock()
+
+    def _get(self, type_id: int):
+        if type_id not in self.matrices:
+            matrix = self.matrices[type_id] = VectorMatrix(self.paths, type_id, self.get_precision(type_id))
+            matrix.on_compact = lambda keep: self._compacted(type_id, keep)
+        return self.matrices[type_id]
+
+    def _compacted(self, type_id: int, keep: np.ndarray):
+        for listener in self.compact_listeners:
+            listener(type_id, keep)
+
+    def _load(self, counts: dict[int, int]):
+        type_ids = {int(path.stem) for path in self.paths.vectors.glob('*.npy')} | set(counts)
+        for type_id in type_ids:
+            matrix = self._get(type_id)
+            matrix.load()
+            if not matrix.size:
+                matrix.precision = self.get_precision(type_id)
+        return [type_id for type_id in type_ids if self.matrices[type_id].count != counts.get(type_id, 0)
+                or self.matrices[type_id].size and self.matrices[type_id].precision != self.get_precision(type_id)]
+
+    async def start(self, counts: dict[int, int], precisions: dict[int, str] = None) -> list[int]:
+        """
+        Loads the matrices. Returns the types whose matrix doesn't have the number of vectors of the DB or is not
+        stored with the precision of its type
+        """
+        self.precisions.update(precisions or {})
+        return await asyncio.get_running_loop().run_in_executor(None, self._load, counts)
+
+    def get_precision(self, type_id: int):
+        return self.precisions.get(type_id, default_precision)
+
+    def set_precision(self, type_id: int, precision: str):
+        """
+        Precision of the next vectors of the type. An existing matrix keeps its own until it is cleared
+        """
+        self.precisions[type_id] = precision
+        matrix = self.matrices.get(type_id)
+        if matrix is not None and not matrix.size:
+            matrix.precision = precision
+
+    async def run(self, function, *args):
+        """
+        Runs function in the executor while no matrix is changed
+        """
+        async with self._write_lock:
+            return await asyncio.get_running_loop().run_in_executor(None, function, *args)
+
+    async def write(self, type_id: int, sha1s: list[str], vectors: np.ndarray):
+        await self.run(self._get(type_id).write, sha1s, vectors)
+
+    async def delete(self, sha1s: list[str]):
+        """
+        Deletes the vectors of the sha1s in all the matrices
+        """
+        for matrix in list(self.matrices.values()):
+            await self.run(matrix.delete, sha1s)
+
+    async def clear(self, type_id: int):
+        matrix = self._get(type_id)
+        await self.run(matrix.clear)
+        matrix.precision = self.get_precision(type_id)
+
+    async def delete_type(self, type_id: int):
+        await self.clear(type_id)
+        del self.matrices[type_id]
+        self.precisions.pop(type_id, None)
+
+    async def get_matrix(self, type_id: int) -> tuple[list[str], np.ndarray]:
+        return await self.run(self._get(type_id).view)
+
+    def get_version(self, type_id: int):
+        return self._get(type_id).version
+
+    def get_dim(self, type_id: int):
+        """
+        Size of the vectors of the type, 0 while it has no matrix
+        """
+        return self._get(type_id).dim
+
+    def get_compactions(self, type_id: int):
+        return self._get(type_id).compactions
+
+    def get_rows(self, type_id: int, sha1s: list[str]) -> list[int | None]:
+        rows = self._get(type_id).rows
+        return [rows.get(sha1) for sha1 in sha1s]
@@ -0,0 +1,18 @@
+from panoptic.core.task.task import Task
+
+
+class BuildVectorIndexTask(Task):
+    """
+    Trains the approximate nearest neighbour index of a VectorType, it replaces the previous one once built
+    """
+    def __init__(self, type_id: int):
+        super().__init__()
+        self.type_id = type_id
+        self.name = 'Build Vector Index'
+        self.key += '-' + str(type_id)
+
+    def get_params(self):
+        return {'type_id': self.type_id}
+
+    async def run(self):
+        await self._project.db.vector_search.build_index(self.type_id, self.run_async)
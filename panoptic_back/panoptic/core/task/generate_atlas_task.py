@@ -1,3 +1,4 @@
+import asyncio
 from io import BytesIO
 
 from PIL import Image
@@ -5,96 +6,128 @@ from PIL import Image
 from panoptic.core.task.task import Task
 from panoptic.models import ImageAtlas
 
+atlas_width = 2048
+atlas_height = 2048
+cell_width = 64
+cell_height = 64
+# number of images decoded and resized by one executor job
+atlas_chunk_size = 256
+
+
+def render_cells(blobs: list[tuple[str, bytes | None]]) -> list[tuple[str, Image.Image | None]]:
+    """
+    Decodes the small thumbnails and resizes them to fit a cell
+    """
+    res = []
+    for sha1, blob in blobs:
+        try:
+            img = Image.open(BytesIO(blob)).convert("RGBA")
+            img.load()
+            img.thumbnail((cell_width, cell_height), Image.Resampling.LANCZOS)
+            res.append((sha1, img))
+        except Exception as e:
+            print(f"Error processing image {sha1}: {e}")
+            res.append((sha1, None))
+    return res
+
+
+def paste_cells(sheet: Image.Image | None, cells: list[tuple[int, Image.Image]], cells_per_row: int):
+    if sheet is None:
+        sheet = Image.new('RGBA', (atlas_width, atlas_height), (0, 0, 0, 0))
+    for cell_index, img in cells:
+        row = cell_index // cells_per_row
+        col = cell_index % cells_per_row
+        # centered in its cell
+        img_width, img_height = img.size
+        x_offset = col * cell_width + (cell_width - img_width) // 2
+        y_offset = row * cell_height + (cell_height - img_height) // 2
+        sheet.paste(img, (x_offset, y_offset), img)
+    return sheet
+
 
 class GenerateAtlasTask(Task):
+    """
+    Adds the sha1s missing from the atlas after the last used cell.
+    Only the sheets receiving new cells are loaded, drawn and saved again
+    """
     def __init__(self):
         super().__init__()
 
+    def get_params(self):
+        return {}
+
     async def run(self):
-        instances = await self._project.db.get_instances()
-        sha1s = list({i.sha1 for i in instances})
-        sha1_mapping: dict[str, tuple[int, int]] = {}
+        # a second build waits for the first one and only adds what is still missing
+        async with self._project.atlas_lock:
+            await self._update_atlas()
 
+    async def _update_atlas(self):
         atlas_id = 0
-        atlas_width = 2048
-        atlas_height = 2048
-        cell_width = 64
-        cell_height = 64
-
-        # Calculate how many cells fit in the atlas
         cells_per_row = atlas_width // cell_width
-        cells_per_col = atlas_height // cell_height
-        cells_per_sheet = cells_per_row * cells_per_col
-
-        sheets: list[Image.Image] = []
-        current_sheet: Image.Image | None = None
-        current_cell_index = 0
-        current_sheet_index = 0
-
-        for sha1 in sha1s:
-            img_blob = await self._project.db.get_small_image(sha1)
-
-            # Create new sheet if needed
-            if current_sheet is None or current_cell_index >= cells_per_sheet:
-                if current_sheet is not None:
-                    sheets.append(current_sheet)
-                    current_sheet_index += 1
-
-                current_sheet = Image.new('RGBA', (atlas_width, atlas_height), (0, 0, 0, 0))
-                current_cell_index = 0
-
-            # Calculate cell position from index
-            row = current_cell_index // cells_per_row
-            col = current_cell_index % cells_per_row
-            cell_x = col * cell_width
-            cell_y = row * cell_height
-
-            try:
-                # Load and process the image
-                img_stream = BytesIO(img_blob)
-                img = Image.open(img_stream).convert("RGBA")
-                img.load()
-
-                # Resize image to fit within cell while maintaining aspect ratio
-                img.thumbnail((cell_width, cell_height), Image.Resampling.LANCZOS)
-
-                # Calculate centering offset
-                img_width, img_height = img.size
-                x_offset = cell_x + (cell_width - img_width) // 2
-                y_offset = cell_y + (cell_height - img_height) // 2
-
-                # Paste the image centered in its cell
-                current_sheet.paste(img, (x_offset, y_offset), img)
-
-                # Record the mapping (sheet number, cell index)
-                sha1_mapping[sha1] = (current_sheet_index, current_cell_index)
-
-            except Exception as e:
-                print(f"Error processing image {sha1}: {e}")
-                # Still advance the cell index even on error
-
-            current_cell_index += 1
-
-        # Add the final sheet
-        if current_sheet is not None:
-            sheets.append(current_sheet)
-
-        atlas = ImageAtlas(atlas_id, len(sheets), atlas_width, atlas_height, cell_width, cell_height, sha1_mapping)
-        await self.save_sheets(atlas, sheets)
+        cells_per_sheet = cells_per_row * (atlas_height // cell_height)
+
+        sha1s = await self._project.db.get_all_instance_sha1s()
+        atlas = await self._load_atlas(atlas_id)
+        mapping = {sha1: cell for sha1, cell in atlas.sha1_mapping.items() if sha1 in sha1s}
+        next_cell = max((s * cells_per_sheet + c + 1 for s, c in atlas.sha1_mapping.values()), default=0)
+
+        new_sha1s = sorted(sha1s - mapping.keys())
+        if not new_sha1s and len(mapping) == len(atlas.sha1_mapping):
+            return
+
+        # the thumbnails are read in one pass, outside the cache, then rendered in parallel in the executor
+        images = self._project.db.images
+        blobs = [(sha1, images.get_image('small', sha1, cached=False)) for sha1 in new_sha1s]
+        blobs = [(sha1, bytes(blob) if blob else None) for sha1, blob in blobs]
+        chunks = [blobs[i:i + atlas_chunk_size] for i in range(0, len(blobs), atlas_chunk_size)]
+        rendered = await asyncio.gather(*[self.run_async(render_cells, chunk) for chunk in chunks])
+
+        new_cells: dict[int, list[tuple[int, Image.Image]]] = {}
+        for sha1, img in (cell for chunk in rendered for cell in chunk):
+            # a failed image takes no cell, it is tried again by the next build
+            if img is None:
+                continue
+            sheet_nb, cell_index = divmod(next_cell, cells_per_sheet)
+            next_cell += 1
+            mapping[sha1] = (sheet_nb, cell_index)
+            new_cells.setdefault(sheet_nb, []).append((cell_index, img))
+
+        if not new_cells and len(mapping) == len(atlas.sha1_mapping):
+            return
+        drawn_sheets = atlas.atlas_nb
+        atlas.atlas_nb = max(atlas.atlas_nb, max(new_cells, default=-1) + 1)
+        atlas.sha1_mapping = mapping
+        await asyncio.gather(*[self._update_sheet(atlas, sheet_nb, sheet_nb < drawn_sheets, cells, cells_per_row)
+                               for sheet_nb, cells in new_cells.items()])
         await self._project.db.import_atlas(atlas)
 
-
-    async def save_sheets(self, atlas: ImageAtlas, sheets: list[Image.Image]):
-        if not self._project.paths.get_atlas_path(atlas.id).exists():
-            self._project.paths.get_atlas_path(atlas.id).mkdir()
-        for i, sheet in enumerate(sheets):
-            path = self._project.paths.get_atlas_sheet_path(atlas.id, i)
-            await self._project.run_async(sheet.save, path, format="PNG", optimize=True)
-
-
-
-
-
-
-
-
+    async def _load_atlas(self, atlas_id: int) -> ImageAtlas:
+        atlas = await self._project.db.get_atlas(atlas_id)
+        paths = self._project.paths
+        if atlas and (atlas.width, atlas.height, atlas.cell_width, atlas.cell_height) == \
+                (atlas_width, atlas_height, cell_width, cell_height) and \
+                all(paths.get_atlas_sheet_path(atlas_id, i).exists() for i in range(atlas.atlas_nb)):
+            return atlas
+        # missing or with another geometry, everything is drawn again
+        return ImageAtlas(atlas_id, 0, atlas_width, atlas_height, cell_width, cell_height, {})
+
+    async def _update_sheet(self, atlas: ImageAtlas, sheet_nb: int, drawn: bool,
+                            cells: list[tuple[int, Image.Image]], cells_per_row: int):
+        path = self._project.paths.get_atlas_sheet_path(atlas.id, sheet_nb)
+        if not path.parent.exists():
+            path.parent.mkdir()
+        sheet = None
+        if drawn:
+            sheet = await self.run_async(self._open_sheet, path)
+        sheet = await self.run_async(paste_cells, sheet, cells, cells_per_row)
+        await self.run_async(self._save_sheet, sheet, path)
+
+    @staticmethod
+    def _open_sheet(path):
+        sheet = Image.open(path)
+        sheet.load()
+        return sheet.convert('RGBA')
+
+    @staticmethod
+    def _save_sheet(sheet: Image.Image, path):
+        sheet.save(path, format="PNG", optimize=True)
@@ -4,70 +4,205 @@ from typing import List
 
 from panoptic.core.task.import_instance_task import ImportInstanceTask
 from panoptic.core.task.task import Task
+from panoptic.models import FolderChanges, Instance
+
+
+# extensions of the files imported from a folder
+image_extensions = ('.png', '.jpg', '.jpeg', '.gif', '.webp', '.tif', '.tiff')
+# the scan gives the files by chunks of whole directories holding at least this number of files
+scan_chunk_size = 2000
+# the scan waits while this number of ImportInstanceTask are waiting in the queue
+import_backlog = 5000
 
 
 class ImportFolderTask(Task):
-    def __init__(self, seq: int, folder: str):
+    """
+    Scans a folder and queues an ImportInstanceTask for the new and modified files.
+    A file is modified when its (size, mtime_ns, inode) fingerprint changed since it was imported.
+    A rescan also removes the instances of the deleted files and the folders removed from the disk, and does not
+    emit the unchanged ones again.
+    The tree is scanned by chunks and the scan waits for the queued imports, the memory used doesn't grow with it
+    """
+    def __init__(self, seq: int, folder: str, rescan: bool = False):
         super().__init__(priority=True)
         self.folder = os.path.normpath(folder)
         self.seq = seq
+        self.rescan = rescan
         self.name = 'Import Folder'
         self.key += '-' + str(seq)
+        # (folder_id, name, extension) of the files that have a restored ImportInstanceTask of this import
+        self._restored_files: set[tuple[int, str, str]] = set()
+
+    def get_params(self):
+        return {'seq': self.seq, 'folder': self.folder, 'rescan': self.rescan}
+
+    def on_restore(self, restored: list[Task]):
+        # the scan starts again from the top, the files already queued before the restart are not queued twice
+        self._restored_files = {self._file_key(t.file, t.folder_id) for t in restored
+                                if isinstance(t, ImportInstanceTask) and t.seq == self.seq}
 
     async def run(self):
-        # Gather all image files from folder
-        all_images = await self.run_async(self._get_all_images, self.folder)
+        db = self._project.db
+        changes = FolderChanges(self.folder)
+        seen_folders = set()
+        known_folders = {f.id for f in await db.get_folders()}
+
+        async for files in self._scan_chunks():
+            # the queued imports are consumed before more are created
+            await self._project.task_queue.wait_backlog('ImportInstanceTask', import_backlog)
+            chunk_folders = await self._import_chunk(files, changes)
+            seen_folders.update(chunk_folders)
+            # the tree is sent again only when the chunk created folders. A new folder always has the new folder
+            # of some chunk file under it
+            if not known_folders.issuperset(chunk_folders):
+                known_folders.update(chunk_folders)
+                self._project.on.sync.emitFolders(await db.get_folders())
 
-        # Compute folder structure
-        folder_node, file_to_folder_id = await self._compute_folder_structure(self.folder, all_images)
+        if self.rescan:
+            # the folders without images anymore, or removed from the disk
+            gone = {f.id: f.path for f in await self._get_folders() if f.id not in seen_folders}
+            deleted = list((await db.get_file_index(list(gone))).values()) if gone else []
+            await self._delete(deleted, changes)
+            removed = [i for i, path in gone.items() if not os.path.isdir(path)]
+            if removed:
+                await db.delete_empty_folders(removed)
+                self._project.on.sync.emitFolders(await db.get_folders())
+            self._project.on.rescan_folder.emit(changes)
 
-        # Create and queue individual import tasks
-        tasks = [ImportInstanceTask(seq=self.seq, file=file, folder_id=file_to_folder_id[file])
-                 for file in all_images]
+    async def _scan_chunks(self):
+        """
+        Walks the folder tree in the executor and yields the image files with their fingerprint by chunks
+        """
+        stack = [self.folder]
+        while stack:
+            files = await self.run_async(self._scan_directories, stack, scan_chunk_size)
+            if files:
+                yield files
 
-        for task in tasks:
-            self._project.task_queue.add_task(task)
+    async def _import_chunk(self, files: dict[str, tuple[int, int, int]], changes: FolderChanges):
+        """
+        Queues the imports of the new and modified files of whole directories. Returns the ids of their folders
+        """
+        db = self._project.db
+        root_id, file_to_folder_id = await self._compute_folder_structure(self.folder, list(files))
+
+        # The files already in the project are found with one index loaded for the chunk
+        folder_ids = list(set(file_to_folder_id.values()))
+        index = await db.get_file_index(folder_ids)
+        fingerprints = await db.get_file_fingerprints(folder_ids)
+        file_keys = {self._file_key(file, file_to_folder_id[file]): file for file in files}
+        new_keys = file_keys.keys() - index.keys()
+
+        tasks = []
+        known = []
+        first_fingerprints = []
+        for key, file in file_keys.items():
+            if key in self._restored_files:
+                continue
+            fingerprint = files[file]
+            if key in new_keys:
+                changes.added.append(file)
+                tasks.append(ImportInstanceTask(self.seq, file, key[0], fingerprint))
+                continue
+            instance = index[key]
+            previous = fingerprints.get(instance.id)
+            if previous is None:
+                # imported before the fingerprints were stored, taken as unchanged
+                first_fingerprints.append((instance.id, *fingerprint))
+            elif previous != fingerprint:
+                changes.modified.append(file)
+                tasks.append(ImportInstanceTask(self.seq, file, key[0], fingerprint, instance.id))
+                continue
+            if not self.rescan:
+                known.append(instance)
 
-        # Emit folders update
-        self._project.on.sync.emitFolders(await self._project.db.get_folders())
+        if first_fingerprints:
+            await db.set_file_fingerprints(first_fingerprints)
+
+        # Queue individual import tasks
+        self._project.task_queue.add_tasks(tasks)
+
+        if known:
+            db.on_import_instances.emit(known)
+
+        if self.rescan:
+            # the chunk has all the files of its directories
+            await self._delete([index[key] for key in index.keys() - file_keys.keys()], changes)
+        return folder_ids
+
+    async def _delete(self, instances: list[Instance], changes: FolderChanges):
+        if not instances:
+            return
+        changes.deleted.extend(i.url for i in instances)
+        await self._project.delete_instances([i.id for i in instances])
+
+    async def on_cancel(self):
+        # the files already queued are not imported either
+        self._project.task_queue.cancel(f'ImportInstanceTask-{self.seq}')
+
+    async def _get_folders(self):
+        """
+        The scanned folder and all its sub folders in the project, even the ones removed from the disk
+        """
+        prefix = self.folder + '/'
+        return [f for f in await self._project.db.get_folders() if f.path == self.folder or f.path.startswith(prefix)]
 
     async def _compute_folder_structure(self, root_path, all_files: List[str]):
+        """
+        The folder tree is computed in memory from the file paths then inserted at once.
+        Returns the id of the root folder and the folder id of each file
+        """
         offset = len(root_path)
         root, root_name = os.path.split(root_path)
-        root_folder = await self._project.db.add_folder(root_path, root_name)
-        file_to_folder_id = {}
+        # path -> (name, parent path), parents before their children
+        folders = {root_path: (root_name, None)}
+        file_to_path = {}
         for file in all_files:
             path, name = os.path.split(file)
             if offset == len(path):
-                file_to_folder_id[file] = root_folder.id
+                file_to_path[file] = root_path
                 continue
             path = path[offset + 1:]
-            parts = Path(path).parts
-            current_folder = root_folder
-            for part in parts:
-                if part not in current_folder.children:
-                    child = await self._project.db.add_folder(current_folder.path + '/' + part, part, current_folder.id)
-                    current_folder.children[part] = child
-                else:
-                    child = current_folder.children[part]
-                file_to_folder_id[file] = child.id
-                current_folder = child
-        return root_folder, file_to_folder_id
+            parent = root_path
+            for part in Path(path).parts:
+                folder_path = parent + '/' + part
+                if folder_path not in folders:
+                    folders[folder_path] = (part, parent)
+                parent = folder_path
+            file_to_path[file] = parent
+        ids = await self._project.db.add_folders([(path, name, parent) for path, (name, parent) in folders.items()])
+        return ids[root_path], {file: ids[path] for file, path in file_to_path.items()}
+
+    @staticmethod
+    def _file_key(file: str, folder_id: int):
+        name = file.split(os.sep)[-1]
+        return folder_id, name, name.split('.')[-1]
 
     @staticmethod
-    def _get_all_images(folder: str) -> List[str]:
-        """Get all files from folder tree (run in executor to avoid blocking)"""
-        all_files = [os.path.join(path, name)
-                for path, subdirs, files in os.walk(folder)
-                for name in files]
-
-        all_images = [i for i in all_files if
-                      i.lower().endswith('.png') or i.lower().endswith('.jpg') or
-                      i.lower().endswith('.jpeg') or i.lower().endswith('.gif') or
-                      i.lower().endswith('.webp') or i.lower().endswith('.tif') or
-                      i.lower().endswith('.tiff')]   #AJOUT SUPPORT TIFF
-
-        return all_images
+    def _scan_directories(stack: list[str], size: int) -> dict[str, tuple[int, int, int]]:
+        """
+        Scans the directories of the stack until size image files were found, the sub directories are pushed on it.
+        Returns the (size, mtime_ns, inode) of the files (run in executor to avoid blocking)
+        """
+        res = {}
+        while stack and len(res) < size:
+            path = stack.pop()
+            try:
+                entries = os.scandir(path)
+            except OSError:
+                continue
+            with entries:
+                for entry in entries:
+                    try:
+                        # like os.walk, the symbolic links to folders are not followed
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                        elif entry.name.lower().endswith(image_extensions) and entry.is_file():
+                            stat = entry.stat()
+                            res[entry.path] = (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+                    except OSError:
+                        continue
+        return res
 
     async def run_if_last(self):
         """Called when this is the last ImportFolderTask in the queue"""
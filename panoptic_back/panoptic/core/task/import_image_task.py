@@ -3,7 +3,7 @@ import io
 from PIL import Image
 
 from panoptic.core.task.generate_atlas_task import GenerateAtlasTask
-from panoptic.core.task.import_instance_task import format_to_mime
+from panoptic.core.task.import_instance_task import format_to_mime, fast_decode
 from panoptic.models import ProjectSettings
 
 from panoptic.core.task.task import Task
@@ -15,10 +15,13 @@ class ImportImageTask(Task):
         self.sha1 = sha1
         self.name = 'Import Image Miniature'
 
+    def get_params(self):
+        return {'sha1': self.sha1}
+
     async def run(self):
         image_file = self._project.sha1_to_files[self.sha1][0]
-        large, medium, small, raw, mime_type = await self.run_async(self._import_image, image_file,
-                                                                    self._project.settings)
+        large, medium, small, raw, mime_type = await self._project.import_pool.run(self._import_image,
+                                                                                     image_file)
         await self._project.db.import_image(self.sha1, small, medium, large)
         if raw:
             await self._project.db.import_raw_image(self.sha1, mime_type, raw)
@@ -44,13 +47,16 @@ class ImportImageTask(Task):
             image.save(raw_buffer, format=image.format)
             raw_bytes = raw_buffer.getvalue()
 
-        image = image.convert('RGB')
-
         small_size = settings.image_small_size
         medium_size = settings.image_medium_size
         large_size = settings.image_large_size
 
-
+        if settings.fast_decode:
+            # the large thumbnail can be as large as the smallest side of the image
+            largest = min(width, height, large_size) if settings.save_image_large else \
+                medium_size if settings.save_image_medium else small_size
+            image = fast_decode(image, largest)
+        image = image.convert('RGB')
 
         if settings.save_image_large and ((width > large_size or height > large_size) or ((width < large_size or height < large_size) and (width > medium_size or height > medium_size))):
             large_size = min(width, height, large_size)
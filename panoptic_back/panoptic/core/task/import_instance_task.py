@@ -7,7 +7,7 @@ from imagehash import average_hash
 
 from panoptic.core.task.generate_atlas_task import GenerateAtlasTask
 from panoptic.core.task.task import Task
-from panoptic.models import DbCommit, Instance, ProjectSettings
+from panoptic.models import Instance, ProjectSettings
 
 # PIL format to MIME type mapping
 format_to_mime = {
@@ -19,51 +19,90 @@ format_to_mime = {
     'TIFF': 'image/tiff',
     'ICO': 'image/vnd.microsoft.icon'
 }
+# modes Image.reduce can average directly, the others are converted to RGB first
+reduce_modes = {'L', 'LA', 'RGB', 'RGBA'}
+
+
+def reduce_factor(image_size: tuple[int, int], size: int):
+    """
+    Largest power of two keeping the longest side of the image at or above size
+    """
+    factor = 1
+    while max(image_size) // (factor * 2) >= size:
+        factor *= 2
+    return factor
+
+
+def fast_decode(image: Image.Image, size: int) -> Image.Image:
+    """
+    Decodes the image at the smallest power of two scale still larger than a thumbnail of size.
+    JPEG files are scaled by libjpeg while decoding (draft), the rest is averaged by blocks (reduce)
+    """
+    factor = reduce_factor(image.size, size)
+    if factor == 1:
+        return image
+    if image.format == 'JPEG':
+        # does nothing if the image was already decoded
+        image.draft('RGB', (image.width // factor, image.height // factor))
+        factor = reduce_factor(image.size, size)
+        if factor == 1:
+            return image
+    if image.mode not in reduce_modes:
+        image = image.convert('RGB')
+    return image.reduce(factor)
+
 
 class ImportInstanceTask(Task):
-    def __init__(self, seq: int, file: str, folder_id: int):
+    """
+    Imports a new file, or gives new content to the instance of a modified file if instance_id is set
+    """
+    def __init__(self, seq: int, file: str, folder_id: int, fingerprint: tuple[int, int, int] | None = None,
+                 instance_id: int = -1):
         super().__init__(priority=True)
         self.file = file
         self.folder_id = folder_id
+        self.fingerprint = fingerprint
+        self.instance_id = instance_id
+        self.seq = seq
         self.name = 'Import Instance'
         self.key += '-' + str(seq)
+        self.producer = f'ImportFolderTask-{seq}'
 
-    async def run(self):
-        db = self._project.db
+    def get_params(self):
+        return {'seq': self.seq, 'file': self.file, 'folder_id': self.folder_id, 'fingerprint': self.fingerprint,
+                'instance_id': self.instance_id}
 
+    async def run(self):
+        # the files already in the project were filtered out by the ImportFolderTask
         name = self.file.split(os.sep)[-1]
         extension = name.split('.')[-1]
         folder_id = self.folder_id
 
-        db_image = await db.has_file(folder_id, name, extension)
-        if db_image:
-            db.on_import_instance.emit(db_image)
-            return db_image
-
-        sha1, width, height, ahash, large, medium, small, raw_file, mime_type = await self.run_async(self._import_image,
-                                                                                                     self.file,
-                                                                                                     self._project.settings)
-        if not await db.has_image(sha1):
-            await db.import_image(sha1, small, medium, large)
-
-        if self._project.settings.save_file_raw:
-            await db.import_raw_image(sha1, mime_type, raw_file)
+        # the server may have stopped after the file was written but before the task was marked as done
+        if self.restored and self.instance_id < 0:
+            db_image = await self._project.db.has_file(folder_id, name, extension)
+            if db_image:
+                return await self._project.import_sink.add(db_image)
 
-        instance = Instance(-1, folder_id, name, extension, sha1, self.file, height, width, str(ahash))
+        sha1, width, height, ahash, large, medium, small, raw_file, mime_type = \
+            await self._project.import_pool.run(self._import_image, self.file)
+        raw = (mime_type, raw_file) if self._project.settings.save_file_raw else None
 
-        commit = DbCommit(instances=[instance])
-        await self._project.db.apply_commit(commit)
-        self._project.sha1_to_files[sha1].append(self.file)
-        self._project.ui.commits.append(commit)
-        db.on_import_instance.emit(commit.instances[0])
-        return commit.instances[0]
+        instance = Instance(self.instance_id, folder_id, name, extension, sha1, self.file, height, width, str(ahash))
+        if self.instance_id >= 0:
+            return await self._project.import_sink.update(instance, (small, medium, large), raw, self.fingerprint)
+        return await self._project.import_sink.add(instance, (small, medium, large), raw, self.fingerprint)
 
     async def run_if_last(self):
         self._project.task_queue.add_task(GenerateAtlasTask())
 
     @staticmethod
     def _import_image(file_path, settings: ProjectSettings):
-        image = Image.open(file_path)
+        # the sha1 of the file content doesn't depend on the decode or the thumbnail settings
+        with open(file_path, 'rb') as file:
+            data = file.read()
+        sha1_hash = hashlib.sha1(data).hexdigest()
+        image = Image.open(io.BytesIO(data))
         width, height = image.size
 
         format_ = image.format  # e.g., 'JPEG'
@@ -79,6 +118,8 @@ class ImportInstanceTask(Task):
             raw_file = raw_buffer.getvalue()
 
         large_size = settings.image_large_size
+        if settings.fast_decode:
+            image = fast_decode(image, large_size)
         if width > large_size or height > large_size:
             image.thumbnail(size=(large_size, large_size))
         image = image.convert('RGB')
@@ -87,7 +128,6 @@ class ImportInstanceTask(Task):
         image.save(large_io, format='jpeg', quality=30)
         large_bytes = large_io.getvalue()
 
-        sha1_hash = hashlib.sha1(large_bytes).hexdigest()
         ahash = average_hash(image)
 
         medium_size = settings.image_medium_size
@@ -13,6 +13,17 @@ class Task:
         self.has_priority = priority
         self.name = type(self).__name__
         self.key = type(self).__name__
+        # tasks of the same kind share a concurrency limit in the TaskQueue
+        self.kind = type(self).__name__
+        # monotonic time the task was added to the TaskQueue
+        self.queued_at = 0.0
+        # row of the task in the pending_tasks table, and if it was created again from it at start
+        self.checkpoint_id: int | None = None
+        self.restored = False
+        # set when the task was cancelled through the TaskQueue
+        self.cancelled = False
+        # key of the task that queues the tasks of this key, it is cancelled with them
+        self.producer: str | None = None
 
     def set_project(self, project: Project):
         self._project = project
@@ -20,6 +31,12 @@ class Task:
     def get_id(self):
         return self.key
 
+    def get_params(self) -> dict | None:
+        """
+        Arguments to create the task again if the project restarts before it finished. None if it is not saved
+        """
+        return None
+
     async def run_async(self, function, *args):
         """
         Make function awaitable and execute in Executor
@@ -31,3 +48,15 @@ class Task:
 
     async def run_if_last(self):
         pass
+
+    def on_restore(self, restored: list[Task]):
+        """
+        Called on the restored tasks before they are added back to the TaskQueue, with all the restored tasks
+        """
+        pass
+
+    async def on_cancel(self):
+        """
+        Called after the run of the task was cancelled through the TaskQueue
+        """
+        pass
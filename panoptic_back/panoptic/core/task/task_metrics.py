@@ -0,0 +1,176 @@
+import time
+from bisect import bisect_left
+from collections import deque
+
+# upper bounds of the wait and run time histogram buckets, in seconds
+time_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+# lengths of the sliding windows of the throughput, in seconds
+throughput_windows = (10, 60, 300)
+# window used to compute the ETA of the waiting tasks
+eta_window = 60
+
+
+class Histogram:
+    """
+    Counts of the observed values by bucket upper bound, the last bucket is unbounded
+    """
+    def __init__(self, buckets: tuple = time_buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def get_stats(self):
+        return {'buckets': dict(zip([*map(str, self.buckets), '+Inf'], self.counts)),
+                'sum': self.sum, 'count': self.count, 'mean': self.sum / self.count if self.count else 0}
+
+
+class KindMetrics:
+    def __init__(self):
+        self.waiting = 0
+        self.running = 0
+        self.done = 0
+        self.failed = 0
+        self.cancelled = 0
+        self.wait_time = Histogram()
+        self.run_time = Histogram()
+        self.last_finish: float | None = None
+        # end times of the tasks finished in the largest window
+        self._finished: deque[float] = deque()
+
+    def finish(self, now: float):
+        self.last_finish = now
+        self._finished.append(now)
+        limit = now - max(throughput_windows)
+        while self._finished and self._finished[0] < limit:
+            self._finished.popleft()
+
+    def throughput(self, window: int, now: float):
+        """
+        Tasks finished per second over the last window seconds
+        """
+        return sum(1 for t in self._finished if t >= now - window) / window
+
+    def eta(self, now: float):
+        """
+        Seconds to finish the waiting and running tasks at the current throughput, None if nothing finished lately
+        """
+        remain = self.waiting + self.running
+        if not remain:
+            return 0
+        speed = self.throughput(eta_window, now)
+        return remain / speed if speed else None
+
+    def get_stats(self, now: float):
+        return {
+            'waiting': self.waiting,
+            'running': self.running,
+            'done': self.done,
+            'failed': self.failed,
+            'cancelled': self.cancelled,
+            'wait_time': self.wait_time.get_stats(),
+            'run_time': self.run_time.get_stats(),
+            'throughput': {str(w): self.throughput(w, now) for w in throughput_windows},
+            'eta': self.eta(now),
+            'since_last_finish': now - self.last_finish if self.last_finish is not None else None
+        }
+
+
+class TaskMetrics:
+    """
+    Queue wait, run time, throughput, failures and ETA of the tasks of a TaskQueue, by task kind
+    """
+    def __init__(self):
+        self.kinds: dict[str, KindMetrics] = {}
+
+    def _get(self, kind: str):
+        if kind not in self.kinds:
+            self.kinds[kind] = KindMetrics()
+        return self.kinds[kind]
+
+    def added(self, kind: str):
+        self._get(kind).waiting += 1
+
+    def started(self, kind: str, wait: float):
+        metrics = self._get(kind)
+        metrics.waiting -= 1
+        metrics.running += 1
+        metrics.wait_time.observe(wait)
+
+    def dropped(self, kind: str):
+        """
+        A waiting task was cancelled before it started
+        """
+        metrics = self._get(kind)
+        metrics.waiting -= 1
+        metrics.cancelled += 1
+
+    def finished(self, kind: str, duration: float, failed: bool, cancelled: bool = False):
+        metrics = self._get(kind)
+        metrics.running -= 1
+        metrics.done += 1
+        if failed:
+            metrics.failed += 1
+        if cancelled:
+            metrics.cancelled += 1
+        metrics.run_time.observe(duration)
+        metrics.finish(time.monotonic())
+
+    def get_stats(self):
+        now = time.monotonic()
+        return {kind: metrics.get_stats(now) for kind, metrics in self.kinds.items()}
+
+
+def to_prometheus(project_id: int, tasks: dict, image_cache: dict):
+    """
+    Prometheus text exposition of the task metrics and the thumbnail cache stats of a project
+    """
+    lines = []
+    project = f'project="{project_id}"'
+
+    def add(name: str, kind: str, help_: str, samples: list[tuple[str, float]]):
+        lines.append(f'# HELP {name} {help_}')
+        lines.append(f'# TYPE {name} {kind}')
+        lines.extend(f'{name}{{{labels}}} {value}' for labels, value in samples)
+
+    for name, key, help_ in [('panoptic_tasks_waiting', 'waiting', 'Tasks waiting in the queue'),
+                             ('panoptic_tasks_running', 'running', 'Tasks running')]:
+        add(name, 'gauge', help_, [(f'{project},kind="{k}"', s[key]) for k, s in tasks.items()])
+    for name, key, help_ in [('panoptic_tasks_done_total', 'done', 'Tasks finished'),
+                             ('panoptic_tasks_failed_total', 'failed', 'Tasks that raised an exception'),
+                             ('panoptic_tasks_cancelled_total', 'cancelled', 'Tasks cancelled before they finished')]:
+        add(name, 'counter', help_, [(f'{project},kind="{k}"', s[key]) for k, s in tasks.items()])
+
+    for name, key, help_ in [('panoptic_task_wait_seconds', 'wait_time', 'Time spent in the queue'),
+                             ('panoptic_task_run_seconds', 'run_time', 'Time spent running')]:
+        # the buckets are cumulative in the exposition format
+        lines.append(f'# HELP {name} {help_}')
+        lines.append(f'# TYPE {name} histogram')
+        for kind, stats in tasks.items():
+            labels = f'{project},kind="{kind}"'
+            total = 0
+            for bound, count in stats[key]['buckets'].items():
+                total += count
+                lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {total}')
+            lines.append(f'{name}_sum{{{labels}}} {stats[key]["sum"]}')
+            lines.append(f'{name}_count{{{labels}}} {stats[key]["count"]}')
+
+    add('panoptic_task_throughput', 'gauge', 'Tasks finished per second over the window',
+        [(f'{project},kind="{k}",window="{w}"', v) for k, s in tasks.items() for w, v in s['throughput'].items()])
+    add('panoptic_task_eta_seconds', 'gauge', 'Estimated time to finish the waiting tasks',
+        [(f'{project},kind="{k}"', s['eta']) for k, s in tasks.items() if s['eta'] is not None])
+    add('panoptic_task_since_last_finish_seconds', 'gauge', 'Time since a task of the kind last finished',
+        [(f'{project},kind="{k}"', s['since_last_finish']) for k, s in tasks.items()
+         if s['since_last_finish'] is not None])
+
+    add('panoptic_image_cache_bytes', 'gauge', 'Size of the cached thumbnails', [(project, image_cache['size'])])
+    add('panoptic_image_cache_budget_bytes', 'gauge', 'Memory budget of the thumbnail cache',
+        [(project, image_cache['budget'])])
+    add('panoptic_image_cache_hits_total', 'counter', 'Thumbnail cache hits', [(project, image_cache['hits'])])
+    add('panoptic_image_cache_misses_total', 'counter', 'Thumbnail cache misses', [(project, image_cache['misses'])])
+    return '\n'.join(lines) + '\n'
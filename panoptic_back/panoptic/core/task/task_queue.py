@@ -6,111 +6,432 @@ if TYPE_CHECKING:
     from panoptic.core.project.project import Project
 
 import asyncio
+import json
 import logging
 import sys
+import time
 import traceback
-from collections import defaultdict
+from collections import defaultdict, deque
 
 from panoptic.utils import EventListener
 
 from panoptic.core.task.task import Task
+from panoptic.core.task.task_metrics import TaskMetrics
 from panoptic.models import TaskState
 
 logger = logging.getLogger('TaskQueue')
 
+# most tasks of a kind running at once in a project, the other kinds use the default limit of the queue
+task_limits = {
+    'ImportFolderTask': 1,
+    'LoadPluginTask': 1,
+    'GenerateAtlasTask': 1,
+    'BuildVectorIndexTask': 1,
+}
+# share of the task starts given to each priority class while both have tasks waiting
+priority_weight = 4
+normal_weight = 1
+# most tasks running at once over all the projects
+max_running_tasks = 256
+# number of task changes that triggers a write of the pending_tasks table
+checkpoint_batch_size = 1000
+# longest time a task change waits to be written in the pending_tasks table, in seconds
+checkpoint_delay = 1.0
+
+
+def log_exception(e: Exception):
+    exc_type, exc_value, exc_traceback = sys.exc_info()
+    logger.error("".join(traceback.format_exception(exc_type, exc_value, exc_traceback)))
+    logger.error(e)
+
+
+class TaskScheduler:
+    """
+    Starts the waiting tasks of all the project queues when a task is added or finishes, there is no polling.
+    The (queue, priority class) pairs share the starts by stride scheduling: each start moves the pass of the pair
+    by 1 / weight and the runnable pair with the smallest pass goes next
+    """
+    def __init__(self, max_running: int = max_running_tasks):
+        self.max_running = max_running
+        self.running = 0
+        self._queues: list[TaskQueue] = []
+        self._passes: dict[tuple[int, bool], float] = {}
+
+    def register(self, queue: TaskQueue):
+        self._queues.append(queue)
+
+    def unregister(self, queue: TaskQueue):
+        if queue in self._queues:
+            self._queues.remove(queue)
+        for key in [k for k in self._passes if k[0] == id(queue)]:
+            del self._passes[key]
+
+    def finished(self):
+        self.running -= 1
+        self.dispatch()
+
+    def dispatch(self):
+        while self.running < self.max_running:
+            runnable = [(queue, priority) for queue in self._queues for priority in (True, False)
+                        if queue.has_runnable(priority)]
+            if not runnable:
+                return
+            # a pair that was idle starts at the current minimum, it doesn't get the starts it missed
+            current = min(self._passes.values(), default=0)
+            for queue, priority in runnable:
+                self._passes.setdefault((id(queue), priority), current)
+            queue, priority = min(runnable, key=lambda r: self._passes[(id(r[0]), r[1])])
+            weight = priority_weight if priority else normal_weight
+            self._passes[(id(queue), priority)] += 1 / weight
+            self.running += 1
+            queue.start_next(priority)
+            # pairs with nothing waiting are forgotten so the passes stay small
+            for key in [k for k in self._passes if not any(id(q) == k[0] and q.has_waiting(k[1])
+                                                          for q in self._queues)]:
+                del self._passes[key]
+
+
+scheduler = TaskScheduler()
+
 
 class TaskQueue:
     def __init__(self, project: Project, num_workers: int = 1):
         self.project = project
-        self._priority_tasks = project
-        self._priority_tasks = asyncio.Queue()
-        self._tasks = asyncio.Queue()
+        # waiting tasks of each kind, by priority class
+        self._waiting: dict[bool, dict[str, deque[Task]]] = {True: defaultdict(deque), False: defaultdict(deque)}
         self._num_workers = num_workers
-        self._workers: List[asyncio.Task] = []
-        self._working: Dict[int, bool] = {}
+        self._limits: dict[str, int] = dict(task_limits)
+        self._running: dict[str, int] = defaultdict(int)
+        self._waiting_count: dict[str, int] = defaultdict(int)
+        # tasks of the paused keys, they go back in the queue on resume
+        self._paused: dict[str, list[Task]] = {}
+        self._tasks: set[asyncio.Task] = set()
+        # run of each started task, cancelled alone by cancel
+        self._runs: dict[asyncio.Task, Task] = {}
+        # key of the producer of each key that had tasks with one
+        self._producers: dict[str, str] = {}
+        self._backlog_waiters: list[asyncio.Future] = []
+        self._closed = False
+        # tasks are written in the project DB once restore was called
+        self._persist = False
+        self._to_save: dict[int, tuple[Task, dict]] = {}
+        self._to_delete: list[int] = []
+        self._next_checkpoint_id = 1
+        self._checkpoint_timer: asyncio.TimerHandle | None = None
+        self._checkpoint_lock = asyncio.Lock()
+        self._checkpoint_tasks: set[asyncio.Task] = set()
         self.onFinish = asyncio.Event()
+        self.onFinish.set()
 
         self.counters: dict[str, int] = defaultdict(int)
+        self.metrics = TaskMetrics()
 
         self._task_states: Dict[str, TaskState] = {}
 
         self.on_update = EventListener()
 
-        for i in range(num_workers):
-            worker = asyncio.create_task(self._worker(i))
-            self._workers.append(worker)
+        scheduler.register(self)
 
     def get_task_states(self) -> List[TaskState]:
         return list(self._task_states.values())
 
     def empty(self):
-        return self._priority_tasks.empty() and self._tasks.empty()
+        return not any(self._waiting[True].values()) and not any(self._waiting[False].values())
+
+    def set_limit(self, kind: str, limit: int):
+        """
+        Most tasks of this kind running at once in the project
+        """
+        self._limits[kind] = limit
+        scheduler.dispatch()
+
+    def get_limit(self, kind: str):
+        return self._limits.get(kind, self._num_workers)
 
     def add_task(self, task: Task):
-        if task.has_priority:
-            self._priority_tasks.put_nowait(task)
+        self._add(task)
+        self.on_update.emit(self.get_task_states())
+        scheduler.dispatch()
+
+    def add_tasks(self, tasks: list[Task]):
+        """
+        Adds the tasks with a single update of the task states
+        """
+        if not tasks:
+            return
+        for task in tasks:
+            self._add(task)
+        self.on_update.emit(self.get_task_states())
+        scheduler.dispatch()
+
+    def count_waiting(self, kind: str):
+        """
+        Tasks of this kind waiting to start, paused ones included
+        """
+        return self._waiting_count[kind]
+
+    async def wait_backlog(self, kind: str, backlog: int):
+        """
+        Waits until less than backlog tasks of this kind are waiting to start
+        """
+        while self.count_waiting(kind) >= backlog:
+            future = asyncio.get_running_loop().create_future()
+            self._backlog_waiters.append(future)
+            await future
+
+    def _add(self, task: Task):
+        task.queued_at = time.monotonic()
+        if task.key in self._paused:
+            self._paused[task.key].append(task)
         else:
-            self._tasks.put_nowait(task)
+            self._waiting[task.has_priority][task.kind].append(task)
+        self._waiting_count[task.kind] += 1
+        self.metrics.added(task.kind)
+        if task.producer is not None:
+            self._producers[task.key] = task.producer
 
         if task.get_id() not in self._task_states:
             self._task_states[task.get_id()] = TaskState(id=task.get_id(), name=task.name, total=0, remain=0)
 
         state = self._task_states[task.get_id()]
         state.done = False
+        state.paused = task.key in self._paused
         state.total += 1
         state.remain += 1
 
         self.counters[task.key] += 1
+        if not state.paused:
+            self.onFinish.clear()
+        self._save(task)
+
+    def pause(self, key: str):
+        """
+        The waiting tasks of the key and the ones added later don't start until resume, the running ones finish.
+        The queue is finished when only paused tasks are left
+        """
+        if key in self._paused:
+            return
+        self._paused[key] = self._remove_waiting(key)
+        if self.empty() and not any(self._running.values()):
+            self.onFinish.set()
+        self._set_paused_state(key, True)
+
+    def resume(self, key: str):
+        tasks = self._paused.pop(key, None)
+        if tasks is None:
+            return
+        for task in tasks:
+            self._waiting[task.has_priority][task.kind].append(task)
+        if tasks:
+            self.onFinish.clear()
+        self._set_paused_state(key, False)
+        scheduler.dispatch()
+
+    def cancel(self, key: str):
+        """
+        Drops the waiting tasks of the key and cancels the running ones, their executor jobs are abandoned.
+        The producer of the key is cancelled too so it doesn't queue more of them.
+        The batches a cancelled task already gave to the ImportSink are still written
+        """
+        producer = self._producers.pop(key, None)
+        if producer is not None:
+            self.cancel(producer)
+        dropped = self._paused.pop(key, None) or []
+        dropped += self._remove_waiting(key)
+        for task in dropped:
+            task.cancelled = True
+            self._waiting_count[task.kind] -= 1
+            self.metrics.dropped(task.kind)
+            self.counters[task.key] -= 1
+            self._delete(task)
+        for run, task in self._runs.items():
+            # a run that already returned finishes normally
+            if task.key == key and run.cancel():
+                task.cancelled = True
+
+        state = self._task_states.get(key)
+        if state is not None:
+            state.paused = False
+            state.remain -= len(dropped)
+            state.done = state.remain == 0 and state.computing == 0
+        self._wake_backlog()
+        if self.empty() and not any(self._running.values()):
+            self.onFinish.set()
         self.on_update.emit(self.get_task_states())
 
-    async def _worker(self, worker_id: int):
-        while True:
+    def _remove_waiting(self, key: str) -> list[Task]:
+        removed = []
+        for waiting in self._waiting.values():
+            for kind, tasks in list(waiting.items()):
+                if not any(t.key == key for t in tasks):
+                    continue
+                removed.extend(t for t in tasks if t.key == key)
+                waiting[kind] = deque(t for t in tasks if t.key != key)
+        return removed
+
+    def _set_paused_state(self, key: str, paused: bool):
+        if key in self._task_states:
+            self._task_states[key].paused = paused
+            self.on_update.emit(self.get_task_states())
+
+    def _wake_backlog(self):
+        # the producers waiting for room check their backlog again
+        waiters, self._backlog_waiters = self._backlog_waiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    async def restore(self, task_types: dict[str, type[Task]]) -> list[Task]:
+        """
+        Creates again the tasks that were waiting or running when the project last stopped, they keep their row
+        once added back. From now on the tasks added to the queue are saved in the project DB
+        """
+        rows = await self.project.db.get_pending_tasks()
+        self._next_checkpoint_id = max((row[0] for row in rows), default=0) + 1
+        self._persist = True
+        tasks = []
+        for id_, kind, params in rows:
+            if kind not in task_types:
+                self._to_delete.append(id_)
+                continue
+            task = task_types[kind](**json.loads(params))
+            task.checkpoint_id = id_
+            task.restored = True
+            tasks.append(task)
+        if self._to_delete:
+            self._schedule_checkpoint()
+        return tasks
+
+    def _save(self, task: Task):
+        if not self._persist or task.checkpoint_id is not None:
+            return
+        params = task.get_params()
+        if params is None:
+            return
+        task.checkpoint_id = self._next_checkpoint_id
+        self._next_checkpoint_id += 1
+        self._to_save[task.checkpoint_id] = (task, params)
+        self._schedule_checkpoint()
+
+    def _delete(self, task: Task):
+        if task.checkpoint_id is None:
+            return
+        # a task finished before it was written is never written
+        if self._to_save.pop(task.checkpoint_id, None) is None:
+            self._to_delete.append(task.checkpoint_id)
+            self._schedule_checkpoint()
+
+    def _schedule_checkpoint(self):
+        if len(self._to_save) + len(self._to_delete) >= checkpoint_batch_size:
+            self._start_checkpoint()
+        elif self._checkpoint_timer is None:
+            self._checkpoint_timer = asyncio.get_running_loop().call_later(checkpoint_delay, self._start_checkpoint)
+
+    def _start_checkpoint(self):
+        task = asyncio.create_task(self.checkpoint())
+        self._checkpoint_tasks.add(task)
+        task.add_done_callback(self._checkpoint_tasks.discard)
+
+    async def checkpoint(self):
+        """
+        Writes the tasks added and finished since the last checkpoint
+        """
+        if self._checkpoint_timer is not None:
+            self._checkpoint_timer.cancel()
+            self._checkpoint_timer = None
+        to_save, self._to_save = self._to_save, {}
+        to_delete, self._to_delete = self._to_delete, []
+        if not to_save and not to_delete:
+            return
+        rows = [(id_, type(task).__name__, json.dumps(params)) for id_, (task, params) in to_save.items()]
+        # checkpoints are written in order, a delete never goes before the insert of its task
+        async with self._checkpoint_lock:
+            try:
+                await self.project.db.update_pending_tasks(rows, to_delete)
+            except Exception as e:
+                log_exception(e)
+
+    def has_waiting(self, priority: bool):
+        return any(self._waiting[priority].values())
+
+    def has_runnable(self, priority: bool):
+        return not self._closed and any(tasks and self._running[kind] < self.get_limit(kind)
+                                        for kind, tasks in self._waiting[priority].items())
+
+    def start_next(self, priority: bool):
+        """
+        Starts the oldest task of the first kind of the class that is under its limit
+        """
+        waiting = self._waiting[priority]
+        kind = next(k for k, tasks in waiting.items() if tasks and self._running[k] < self.get_limit(k))
+        task = waiting[kind].popleft()
+        # the kind goes at the back of its class, kinds take turns
+        tasks = waiting.pop(kind)
+        if tasks:
+            waiting[kind] = tasks
+        self._running[kind] += 1
+        self._waiting_count[kind] -= 1
+        self._wake_backlog()
+
+        state = self._task_states[task.get_id()]
+        state.remain -= 1
+        state.computing += 1
+        task.set_project(self.project)
+        self.metrics.started(kind, time.monotonic() - task.queued_at)
+        run = asyncio.create_task(task.run())
+        self._runs[run] = task
+        running = asyncio.create_task(self._run(task, state, run))
+        self._tasks.add(running)
+        running.add_done_callback(self._tasks.discard)
+
+    async def _run(self, task: Task, state: TaskState, run: asyncio.Task):
+        start = time.monotonic()
+        failed = False
+        try:
             try:
-                # if nothing to do mark as inactive
-                if self.empty():
-                    self._working[worker_id] = False
-
-                # if we have priority tasks take it
-                if not self._priority_tasks.empty():
-                    task = await self._priority_tasks.get()
-                    state = self._task_states[task.get_id()]
-                    state.remain -= 1
-                # else normal task
-                else:
-                    if self._tasks.empty():
-                        await asyncio.sleep(0.5)  # sleep a bit if no tasks available
-                        continue
-                    task = await self._tasks.get()
-                    state = self._task_states[task.get_id()]
-                    state.remain -= 1
-
-                # set working Flag and execute task
-                self._working[worker_id] = True
-                task.set_project(self.project)
+                await run
+            except asyncio.CancelledError:
+                # the tasks stopped by close are started again at next start
+                if self._closed or not task.cancelled:
+                    raise
+            except Exception as e:
+                failed = True
+                log_exception(e)
+            finally:
+                del self._runs[run]
+            if task.cancelled:
                 try:
-                    state.computing += 1
-                    self.onFinish.clear()
-                    await task.run()
-                    state.computing -= 1
-                    self.counters[task.key] -= 1
+                    await task.on_cancel()
                 except Exception as e:
-                    state.computing -= 1
-                    exc_type, exc_value, exc_traceback = sys.exc_info()
-                    logger.error("".join(traceback.format_exception(exc_type, exc_value, exc_traceback)))
-                    logger.error(e)
-                if state.remain == 0 and state.computing == 0:
-                    state.done = True
-                    self.onFinish.set()
-                if self.counters[task.key] == 0:
+                    log_exception(e)
+            # a failed or cancelled task is not tried again at next start
+            self._delete(task)
+            self.metrics.finished(task.kind, time.monotonic() - start, failed, task.cancelled)
+            state.computing -= 1
+            self.counters[task.key] -= 1
+            if state.remain == 0 and state.computing == 0:
+                state.done = True
+            if self.counters[task.key] == 0:
+                try:
                     await task.run_if_last()
-                self.on_update.emit(self.get_task_states())
-
-            except Exception as e:
-                exc_type, exc_value, exc_traceback = sys.exc_info()
-                logger.error("".join(traceback.format_exception(exc_type, exc_value, exc_traceback)))
-                logger.error(e)
+                except Exception as e:
+                    log_exception(e)
+            self.on_update.emit(self.get_task_states())
+        finally:
+            self._running[task.kind] -= 1
+            if self.empty() and not any(self._running.values()):
+                self.onFinish.set()
+            scheduler.finished()
 
     async def close(self):
-        for worker in self._workers:
-            worker.cancel()
-        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._closed = True
+        scheduler.unregister(self)
+        for task in list(self._tasks):
+            task.cancel()
+        for waiter in self._backlog_waiters:
+            waiter.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        # the waiting and cancelled tasks stay in the DB for the next start
+        await asyncio.gather(*self._checkpoint_tasks, return_exceptions=True)
+        if self._persist:
+            await self.checkpoint()
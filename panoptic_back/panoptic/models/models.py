@@ -350,6 +350,7 @@ class TaskState(BaseModel):
     remain: int
     computing: int = 0
     done: bool = True
+    paused: bool = False
 
 
 @dataclass(slots=True)
@@ -482,6 +483,14 @@ class PropertyId(int):
 
 
 class ProjectSettings(BaseModel):
+    """
+    @db_readers: number of read-only connections on the project DB
+    @image_cache_size: memory budget of the thumbnail cache in MB
+    @import_workers: number of processes decoding the imported images, 0 uses the cpu count
+    @import_tasks: number of files imported at once. Above import_workers so the import batches fill up
+    @fast_decode: decode the imported images at the smallest power of two scale above the largest thumbnail.
+    Faster but the thumbnails differ slightly from a full decode
+    """
     image_small_size: int = 128
     image_medium_size: int = 256
     image_large_size: int = 1024
@@ -492,6 +501,12 @@ class ProjectSettings(BaseModel):
 
     save_file_raw: bool = False
 
+    db_readers: int = 4
+    image_cache_size: int = 256
+    import_workers: int = 0
+    import_tasks: int = 64
+    fast_decode: bool = False
+
 
 class UploadError(Enum):
     invalid_csv = "The csv file is invalid, are you using ';' as separator ? "
@@ -519,6 +534,14 @@ class DeleteFolderConfirm:
     deleted_sha1s: list[str]
 
 
+@dataclass(slots=True)
+class FolderChanges:
+    folder: str
+    added: list[str] = field(default_factory=list)
+    modified: list[str] = field(default_factory=list)
+    deleted: list[str] = field(default_factory=list)
+
+
 @dataclass(slots=True)
 class VectorStats:
     count: dict[int, int]
@@ -573,6 +596,7 @@ class ProjectState(BaseModel):
     tasks: list[TaskState] = []
     plugins: list[PluginDescription] = []
     settings: ProjectSettings
+    image_version: str = ''
 
 
 class ProjectIdPayload(BaseModel):
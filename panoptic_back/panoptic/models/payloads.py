@@ -131,3 +131,17 @@ class IgnoredPluginPayload(CamelModel):
 
 class DeleteVectorTypePayload(CamelModel):
     id: int
+
+
+class SimilarImagesPayload(CamelModel):
+    type_id: int
+    # one query per sha1 or per vector
+    sha1s: list[str] = []
+    vectors: list[list[float]] = []
+    k: int = 50
+    # lists of the vector index scanned per query, the search is exact without it or without index
+    nprobe: int | None = None
+
+
+class ImageBatchPayload(CamelModel):
+    sha1s: list[str]
@@ -1,9 +1,27 @@
+import struct
 from sys import platform
 
 import aiofiles.os
+from starlette.requests import Request
 from starlette.responses import FileResponse, Response
 
 from panoptic.core.project.project import Project
+from panoptic.core.project_db.image_store import kind_bits
+
+# header of each image of a batch: served kind code (0 when missing) and byte length
+batch_header = struct.Struct('<BI')
+batch_kind_codes = {'small': 1, 'medium': 2, 'large': 3}
+# thumbnail kinds tried for each asked size of a batch
+batch_fallbacks = {
+    'small': ['small', 'medium', 'large'],
+    'medium': ['medium', 'large', 'small'],
+    'large': ['large', 'medium', 'small'],
+}
+# bytes gathered before a chunk of the batch is sent
+batch_chunk_size = 256 * 1024
+
+# lifetime of an image url carrying the current image version, it changes with the thumbnail settings
+image_max_age = 365 * 24 * 3600
 
 
 async def get_image_small(project: Project, sha1: str):
@@ -53,3 +71,75 @@ raw_order = [get_image_raw, get_image_large, get_image_medium, get_image_small]
 large_order = [get_image_large, get_image_raw, get_image_medium, get_image_small]
 medium_order = [get_image_medium, get_image_large, get_image_raw, get_image_small]
 small_order = raw_order[::-1]
+
+# thumbnail getters skipped without a lookup when the availability bitmap says the size is missing
+getter_kinds = {get_image_small: 'small', get_image_medium: 'medium', get_image_large: 'large'}
+
+
+def image_etag(project: Project, sha1: str, getter):
+    # the served size is part of the tag: a fallback image is replaced once the asked size is generated
+    size = getter.__name__.removeprefix('get_image_')
+    return f'"{sha1}-{size}-{project.image_version}"'
+
+
+def etag_matches(request: Request, etag: str):
+    header = request.headers.get('if-none-match')
+    if not header:
+        return False
+    tags = [t.strip().removeprefix('W/') for t in header.split(',')]
+    return '*' in tags or etag in tags
+
+
+async def get_image_response(project: Project, request: Request, sha1: str, order: list):
+    """
+    Serves the first available image of the order with a strong ETag.
+    The response is immutable when the url is versioned with the current image version (?v=) and the asked size
+    is served, otherwise the browser revalidates it and receives a 304 while the image is unchanged
+    """
+    versioned = request.query_params.get('v') == project.image_version
+
+    available = project.db.images.available_kinds(sha1)
+    for getter in order:
+        kind = getter_kinds.get(getter)
+        if kind and not available & kind_bits[kind]:
+            continue
+        res = await getter(project, sha1)
+        if res:
+            etag = image_etag(project, sha1, getter)
+            # a fallback is replaced once the asked size is generated
+            if versioned and getter is order[0]:
+                cache_control = f'public, max-age={image_max_age}, immutable'
+            else:
+                cache_control = 'no-cache'
+            headers = {'ETag': etag, 'Cache-Control': cache_control}
+            if etag_matches(request, etag):
+                return Response(status_code=304, headers=headers)
+            res.headers.update(headers)
+            return res
+
+
+async def stream_image_batch(project: Project, sha1s: list[str], size: str):
+    """
+    Thumbnails of the sha1s in order, each one is a batch_header followed by the jpeg bytes.
+    A missing image has the kind code 0 and no bytes
+    """
+    images = project.db.images
+    kinds = batch_fallbacks[size]
+    chunk = []
+    chunk_size = 0
+    for sha1 in sha1s:
+        available = images.available_kinds(sha1)
+        kind = next((k for k in kinds if available & kind_bits[k]), None)
+        image = images.get_image(kind, sha1) if kind else None
+        if not image:
+            chunk.append(batch_header.pack(0, 0))
+        else:
+            chunk.append(batch_header.pack(batch_kind_codes[kind], len(image)))
+            chunk.append(image)
+            chunk_size += len(image)
+        if chunk_size >= batch_chunk_size:
+            yield b''.join(chunk)
+            chunk = []
+            chunk_size = 0
+    if chunk:
+        yield b''.join(chunk)
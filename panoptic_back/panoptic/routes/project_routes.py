@@ -5,20 +5,24 @@ from pathlib import Path
 from time import time
 from typing import Optional, Annotated
 
+import numpy as np
 import orjson
 from fastapi import APIRouter, UploadFile, Depends, HTTPException, Form
 from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
 from starlette.requests import Request
-from starlette.responses import FileResponse, StreamingResponse
+from starlette.responses import FileResponse, StreamingResponse, PlainTextResponse
 
 from panoptic.core.project.project import Project
 from panoptic.core.project_db.utils import group_property_stream
+from panoptic.core.task.task_metrics import to_prometheus
 from panoptic.models import Property, VectorDescription, ExecuteActionPayload, \
     ExportPropertiesPayload, UIDataPayload, PluginParamsPayload, ImportPayload, DbCommit, CommitHistory, Update, \
-    ProjectSettings, TagMergePayload, LoadState, DeleteVectorTypePayload, InstanceValuesArray, ImageValuesArray
-from panoptic.models.results import LoadResult
-from panoptic.routes.image_utils import medium_order, large_order, small_order, raw_order
+    ProjectSettings, TagMergePayload, LoadState, DeleteVectorTypePayload, InstanceValuesArray, ImageValuesArray, \
+    ImageBatchPayload, SimilarImagesPayload
+from panoptic.models.results import LoadResult, ActionResult, Group, ScoreList
+from panoptic.routes.image_utils import medium_order, large_order, small_order, raw_order, get_image_response, \
+    batch_fallbacks, stream_image_batch
 from panoptic.routes.panoptic_routes import get_panoptic, get_server
 from panoptic.utils import save_upload_file
 
@@ -220,6 +224,16 @@ async def reimport_folder_route(req: IdRequest, project: Project = Depends(get_p
     return await project.db.get_folders()
 
 
+@project_router.post("/rescan_folder")
+async def rescan_folder_route(req: IdRequest, project: Project = Depends(get_project_from_id)):
+    try:
+        folder = await project.db.get_folder(req.id)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f'Folder id does not exist [{req.id}]')
+    await project.import_folder(folder.path, rescan=True)
+    return await project.db.get_folders()
+
+
 @project_router.delete('/folder')
 async def delete_folder(folder_id: int, project: Project = Depends(get_project_from_id)):
     res = await project.delete_folder(folder_id)
@@ -302,6 +316,33 @@ async def post_delete_vector_type(req: DeleteVectorTypePayload, project: Project
     await project.delete_vector_type(req.id)
 
 
+@project_router.post('/similar_images')
+async def get_similar_images_route(req: SimilarImagesPayload, project: Project = Depends(get_project_from_id)):
+    """
+    One group per query sha1 or vector, with the k closest images by cosine similarity
+    """
+    types = await project.db.get_vector_types()
+    if not any(t.id == req.type_id for t in types):
+        raise HTTPException(status_code=404, detail=f'Vector type does not exist [{req.type_id}]')
+    search = project.db.vector_search
+    results = []
+    if req.sha1s:
+        results += await search.search_sha1s(req.type_id, req.sha1s, req.k, req.nprobe)
+    if req.vectors:
+        results += await search.search(req.type_id, np.array(req.vectors, dtype=np.float32), req.k, req.nprobe)
+    groups = [Group(sha1s=[sha1 for sha1, _ in result],
+                    scores=ScoreList(values=[score for _, score in result], min=-1, max=1,
+                                     description='Cosine similarity'))
+              for result in results]
+    return ActionResult(groups=groups)
+
+
+@project_router.post('/vector_index')
+async def build_vector_index_route(req: IdRequest, project: Project = Depends(get_project_from_id)):
+    project.build_vector_index(req.id)
+    return project.task_queue.get_task_states()
+
+
 @project_router.post('/default_vectors')
 async def set_default_vectors(vector_description: VectorDescription, project: Project = Depends(get_project_from_id)):
     await project.db.set_default_vectors(vector_description)
@@ -330,39 +371,71 @@ async def commit_route(commit: DbCommit, project: Project = Depends(get_project_
 
 
 @project_router.get('/image/raw/{sha1:path}')
-async def get_image_raw_route(sha1: str, project: Project = Depends(get_project_from_id)):
-    order = raw_order
-    for getter in order:
-        res = await getter(project, sha1)
-        if res:
-            return res
+async def get_image_raw_route(sha1: str, request: Request, project: Project = Depends(get_project_from_id)):
+    return await get_image_response(project, request, sha1, raw_order)
 
 
 @project_router.get('/image/large/{sha1:path}')
-async def get_image_large_route(sha1: str, project: Project = Depends(get_project_from_id)):
-    order = large_order
-    for getter in order:
-        res = await getter(project, sha1)
-        if res:
-            return res
+async def get_image_large_route(sha1: str, request: Request, project: Project = Depends(get_project_from_id)):
+    return await get_image_response(project, request, sha1, large_order)
 
 
 @project_router.get('/image/medium/{sha1:path}')
-async def get_image_medium_route(sha1: str, project: Project = Depends(get_project_from_id)):
-    order = medium_order
-    for getter in order:
-        res = await getter(project, sha1)
-        if res:
-            return res
+async def get_image_medium_route(sha1: str, request: Request, project: Project = Depends(get_project_from_id)):
+    return await get_image_response(project, request, sha1, medium_order)
 
 
 @project_router.get('/image/small/{sha1:path}')
-async def get_image_small_route(sha1: str, project: Project = Depends(get_project_from_id)):
-    order = small_order
-    for getter in order:
-        res = await getter(project, sha1)
-        if res:
-            return res
+async def get_image_small_route(sha1: str, request: Request, project: Project = Depends(get_project_from_id)):
+    return await get_image_response(project, request, sha1, small_order)
+
+
+@project_router.post('/images/{size}')
+async def get_image_batch_route(size: str, payload: ImageBatchPayload,
+                                project: Project = Depends(get_project_from_id)):
+    if size not in batch_fallbacks:
+        raise HTTPException(status_code=404, detail="Unknown image size")
+    return StreamingResponse(stream_image_batch(project, payload.sha1s, size), media_type='application/octet-stream')
+
+
+@project_router.get('/image_cache')
+async def get_image_cache_route(project: Project = Depends(get_project_from_id)):
+    return project.db.images.cache.get_stats()
+
+
+@project_router.get('/metrics')
+async def get_metrics_route(project: Project = Depends(get_project_from_id)):
+    return {'tasks': project.task_queue.metrics.get_stats(), 'image_cache': project.db.images.cache.get_stats()}
+
+
+@project_router.get('/metrics/prometheus', response_class=PlainTextResponse)
+async def get_prometheus_metrics_route(project: Project = Depends(get_project_from_id)):
+    text = to_prometheus(project.id, project.task_queue.metrics.get_stats(), project.db.images.cache.get_stats())
+    return PlainTextResponse(text, media_type='text/plain; version=0.0.4')
+
+
+def get_task_key(key: str, project: Project = Depends(get_project_from_id)) -> str:
+    if not any(state.id == key for state in project.task_queue.get_task_states()):
+        raise HTTPException(status_code=404, detail=f'Task key does not exist [{key}]')
+    return key
+
+
+@project_router.post('/tasks/{key}/pause')
+async def pause_tasks_route(key: str = Depends(get_task_key), project: Project = Depends(get_project_from_id)):
+    project.task_queue.pause(key)
+    return project.task_queue.get_task_states()
+
+
+@project_router.post('/tasks/{key}/resume')
+async def resume_tasks_route(key: str = Depends(get_task_key), project: Project = Depends(get_project_from_id)):
+    project.task_queue.resume(key)
+    return project.task_queue.get_task_states()
+
+
+@project_router.post('/tasks/{key}/cancel')
+async def cancel_tasks_route(key: str = Depends(get_task_key), project: Project = Depends(get_project_from_id)):
+    project.task_queue.cancel(key)
+    return project.task_queue.get_task_states()
 
 
 @project_router.get('/settings')
@@ -0,0 +1,68 @@
+import io
+import os
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+from panoptic.core.task.import_instance_task import ImportInstanceTask
+from panoptic.models import ProjectSettings
+
+# --- CONFIGURATION ---
+NUM_IMAGES = 20
+IMAGE_SIZE = (4000, 3000)
+FORMATS = ['jpeg', 'png', 'webp']
+
+
+def generate_images(output_dir: str, format_: str):
+    # a photo-like image: smooth shapes over sensor noise
+    noise = Image.effect_noise(IMAGE_SIZE, 24).convert('RGB')
+    files = []
+    for i in range(NUM_IMAGES):
+        img = noise.copy()
+        draw = ImageDraw.Draw(img)
+        for j in range(12):
+            x, y = (i * 311 + j * 977) % IMAGE_SIZE[0], (i * 173 + j * 541) % IMAGE_SIZE[1]
+            draw.ellipse((x, y, x + 900, y + 600), fill=((i * 40) % 255, (j * 20) % 255, 120))
+        path = os.path.join(output_dir, f'number_{i}.{format_}')
+        img.save(path, quality=90) if format_ != 'png' else img.save(path)
+        files.append(path)
+    return files
+
+
+def import_all(files, settings):
+    start = time.perf_counter()
+    res = [ImportInstanceTask._import_image(f, settings) for f in files]
+    return time.perf_counter() - start, res
+
+
+def psnr(a: bytes, b: bytes):
+    a = np.asarray(Image.open(io.BytesIO(a)), dtype=np.float64)
+    b = np.asarray(Image.open(io.BytesIO(b)), dtype=np.float64)
+    mse = ((a - b) ** 2).mean()
+    return float('inf') if mse == 0 else 10 * np.log10(255 ** 2 / mse)
+
+
+def main():
+    settings = ProjectSettings(save_image_large=True)
+    fast_settings = settings.model_copy(update={'fast_decode': True})
+    print(f"--- {NUM_IMAGES} IMAGES {IMAGE_SIZE[0]}x{IMAGE_SIZE[1]}, THUMBNAILS "
+          f"{settings.image_large_size}/{settings.image_medium_size}/{settings.image_small_size} ---")
+    for format_ in FORMATS:
+        with tempfile.TemporaryDirectory() as folder:
+            files = generate_images(folder, format_)
+            full_time, full_res = import_all(files, settings)
+            fast_time, fast_res = import_all(files, fast_settings)
+
+        # large, medium and small thumbnails compared to the full decode
+        quality = [np.mean([psnr(full[i], fast[i]) for full, fast in zip(full_res, fast_res)]) for i in (4, 5, 6)]
+        same_sha1 = sum(full[0] == fast[0] for full, fast in zip(full_res, fast_res))
+        print(f"  {format_:>5}: full {full_time / NUM_IMAGES * 1000:.0f}ms/image, "
+              f"fast {fast_time / NUM_IMAGES * 1000:.0f}ms/image ({full_time / fast_time:.1f}x), "
+              f"PSNR large/medium/small {quality[0]:.1f}/{quality[1]:.1f}/{quality[2]:.1f}dB, "
+              f"same sha1 {same_sha1}/{NUM_IMAGES}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+import asyncio
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from generate_images import generate_images
+from panoptic.core.project.import_pool import ImportPool
+from panoptic.core.task.import_instance_task import ImportInstanceTask
+from panoptic.models import ProjectSettings
+
+# --- CONFIGURATION ---
+NUM_IMAGES = 400
+IMAGE_SIZE = (3000, 2000)
+THREAD_WORKERS = 8
+
+
+def make_images(output_dir: str):
+    print(f"--- 1. GENERATING {NUM_IMAGES} IMAGES {IMAGE_SIZE[0]}x{IMAGE_SIZE[1]} ---")
+    files = generate_images(output_dir, NUM_IMAGES, IMAGE_SIZE, 'jpg')
+    print("  Images Ready.\n")
+    return files
+
+
+async def import_with_threads(files, settings):
+    executor = ThreadPoolExecutor(max_workers=THREAD_WORKERS)
+    futures = [asyncio.wrap_future(executor.submit(ImportInstanceTask._import_image, f, settings)) for f in files]
+    res = await asyncio.gather(*futures)
+    executor.shutdown()
+    return res
+
+
+async def import_with_processes(files, settings, workers):
+    pool = ImportPool(ThreadPoolExecutor(max_workers=1))
+    settings = settings.model_copy(update={'import_workers': workers})
+    pool.set_settings(settings)
+    # start the workers outside of the measure
+    await asyncio.gather(*[pool.run(ImportInstanceTask._import_image, files[0]) for _ in range(pool.workers)])
+    start = time.perf_counter()
+    res = await asyncio.gather(*[pool.run(ImportInstanceTask._import_image, f) for f in files])
+    duration = time.perf_counter() - start
+    pool.shutdown()
+    return duration, res
+
+
+async def main():
+    settings = ProjectSettings()
+    with tempfile.TemporaryDirectory() as folder:
+        files = make_images(folder)
+
+        print("--- 2. DECODE + THUMBNAILS + HASHES ---")
+        start = time.perf_counter()
+        thread_res = await import_with_threads(files, settings)
+        thread_time = time.perf_counter() - start
+        print(f"  thread pool ({THREAD_WORKERS} threads): {thread_time:.2f}s "
+              f"({NUM_IMAGES / thread_time:.0f} images/s)")
+
+        for workers in sorted({4, 8, os.cpu_count()}):
+            process_time, process_res = await import_with_processes(files, settings, workers)
+            assert [r[0] for r in process_res] == [r[0] for r in thread_res]
+            print(f"  process pool ({workers} processes): {process_time:.2f}s "
+                  f"({NUM_IMAGES / process_time:.0f} images/s, {thread_time / process_time:.1f}x)")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,147 @@
+import json
+import random
+import sqlite3
+import time
+from collections import defaultdict
+
+# --- CONFIGURATION ---
+NUM_PROPERTIES = 10
+NUM_INSTANCES = 100_000
+KEY_COUNTS = [10_000, 100_000, 1_000_000]
+CHUNK_SIZE = 500
+DB_NAME = ":memory:"
+random.seed(42)
+
+
+def setup_database():
+    print(f"--- 1. SETTING UP instance_property_values ({NUM_PROPERTIES * NUM_INSTANCES:,} values) ---")
+    conn = sqlite3.connect(DB_NAME)
+    conn.execute("""
+        CREATE TABLE instance_property_values (
+            property_id INTEGER NOT NULL,
+            instance_id INTEGER NOT NULL,
+            value JSON,
+            PRIMARY KEY (property_id, instance_id)
+        )
+    """)
+    rows = ((p, i, json.dumps(f'v{p}_{i}')) for p in range(NUM_PROPERTIES) for i in range(NUM_INSTANCES))
+    conn.executemany("INSERT INTO instance_property_values VALUES (?, ?, ?)", rows)
+    conn.commit()
+    print("  Database Ready.\n")
+    return conn
+
+
+def random_keys(nb: int):
+    # half of the keys exist, half are missing like in a commit that adds new values
+    return [(random.randrange(NUM_PROPERTIES), random.randrange(NUM_INSTANCES * 2)) for _ in range(nb)]
+
+
+def lookup_or_chain(conn, keys):
+    res = []
+    query = 'SELECT * FROM instance_property_values WHERE '
+    for i in range(0, len(keys), CHUNK_SIZE):
+        chunk = keys[i:i + CHUNK_SIZE]
+        conditions = ' OR '.join(['(property_id = ? AND instance_id = ?)'] * len(chunk))
+        params = [p for k in chunk for p in k]
+        res.extend(conn.execute(query + conditions, params).fetchall())
+    return res
+
+
+def group_keys(keys):
+    groups = defaultdict(list)
+    for property_id, instance_id in keys:
+        groups[property_id].append(instance_id)
+    return groups
+
+
+def lookup_json_each_pairs(conn, keys):
+    query = """
+        SELECT v.* FROM json_each(?) AS k
+        JOIN instance_property_values AS v
+        ON v.property_id = json_extract(k.value, '$[0]') AND v.instance_id = json_extract(k.value, '$[1]')
+    """
+    return conn.execute(query, (json.dumps(keys),)).fetchall()
+
+
+def lookup_json_each(conn, keys):
+    # one statement per property, the instance ids are probed on the primary key
+    query = """
+        SELECT * FROM instance_property_values
+        WHERE property_id = ? AND instance_id IN (SELECT value FROM json_each(?))
+    """
+    res = []
+    for property_id, ids in group_keys(keys).items():
+        res.extend(conn.execute(query, (property_id, json.dumps(ids))).fetchall())
+    return res
+
+
+def lookup_temp_table(conn, keys):
+    conn.execute("CREATE TEMP TABLE IF NOT EXISTS keys (property_id INTEGER, instance_id INTEGER)")
+    conn.execute("DELETE FROM keys")
+    conn.executemany("INSERT INTO keys VALUES (?, ?)", keys)
+    res = conn.execute("""
+        SELECT v.* FROM keys AS k
+        JOIN instance_property_values AS v
+        ON v.property_id = k.property_id AND v.instance_id = k.instance_id
+    """).fetchall()
+    conn.execute("DELETE FROM keys")
+    return res
+
+
+def delete_many(conn, keys):
+    conn.executemany("DELETE FROM instance_property_values WHERE property_id = ? AND instance_id = ?", keys)
+
+
+def delete_json_each(conn, keys):
+    query = """
+        DELETE FROM instance_property_values
+        WHERE property_id = ? AND instance_id IN (SELECT value FROM json_each(?))
+    """
+    for property_id, ids in group_keys(keys).items():
+        conn.execute(query, (property_id, json.dumps(ids)))
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    res = function(*args)
+    return time.perf_counter() - start, res
+
+
+def benchmark_lookups(conn):
+    print("--- 2. KEY LOOKUPS ---")
+    for nb in KEY_COUNTS:
+        keys = random_keys(nb)
+        or_time, or_res = timed(lookup_or_chain, conn, keys)
+        pairs_time, pairs_res = timed(lookup_json_each_pairs, conn, keys)
+        temp_time, temp_res = timed(lookup_temp_table, conn, keys)
+        json_time, json_res = timed(lookup_json_each, conn, keys)
+        assert set(or_res) == set(pairs_res) == set(temp_res) == set(json_res)
+        print(f"  {nb:>9,} keys | OR chain: {or_time:.3f}s | json_each pairs: {pairs_time:.3f}s "
+              f"| temp table: {temp_time:.3f}s | json_each per property: {json_time:.3f}s "
+              f"({or_time / json_time:.1f}x)")
+
+
+def benchmark_deletes(conn):
+    print("\n--- 3. KEY DELETES ---")
+    for nb in KEY_COUNTS:
+        keys = random_keys(nb)
+        conn.execute("SAVEPOINT bench")
+        before = conn.total_changes
+        many_time, _ = timed(delete_many, conn, keys)
+        many_changes = conn.total_changes - before
+        conn.execute("ROLLBACK TO bench")
+        before = conn.total_changes
+        json_time, _ = timed(delete_json_each, conn, keys)
+        json_changes = conn.total_changes - before
+        conn.execute("ROLLBACK TO bench")
+        conn.execute("RELEASE bench")
+        assert many_changes == json_changes
+        print(f"  {nb:>9,} keys | executemany: {many_time:.3f}s | json_each: {json_time:.3f}s "
+              f"({many_time / json_time:.1f}x)")
+
+
+if __name__ == "__main__":
+    conn = setup_database()
+    benchmark_lookups(conn)
+    benchmark_deletes(conn)
+    conn.close()
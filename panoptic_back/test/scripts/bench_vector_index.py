@@ -0,0 +1,64 @@
+import asyncio
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+from panoptic.core.project.project_paths import ProjectPaths
+from panoptic.core.project_db.vector_search import VectorSearch
+from panoptic.core.project_db.vector_store import VectorStore
+
+# --- CONFIGURATION ---
+NUM_VECTORS = 200_000
+DIM = 512
+CLUSTERS = 2_000
+NOISE = 1.5
+WRITE_CHUNK = 100_000
+NUM_QUERIES = 100
+K = 10
+NPROBES = [1, 2, 4, 8, 16, 32, 64]
+
+
+async def timed_search(search: VectorSearch, queries: np.ndarray, nprobe: int | None):
+    start = time.perf_counter()
+    res = await search.search(1, queries, K, nprobe)
+    return res, (time.perf_counter() - start) / len(queries)
+
+
+async def main():
+    rng = np.random.default_rng(0)
+    centers = rng.standard_normal((CLUSTERS, DIM), dtype=np.float32)
+    with tempfile.TemporaryDirectory() as folder:
+        paths = ProjectPaths(Path(folder))
+        paths.create_paths()
+        store = VectorStore(paths)
+        await store.start({})
+
+        for i in range(0, NUM_VECTORS, WRITE_CHUNK):
+            sha1s = [f'{j:040x}' for j in range(i, min(i + WRITE_CHUNK, NUM_VECTORS))]
+            noise = rng.standard_normal((len(sha1s), DIM), dtype=np.float32) * NOISE
+            await store.write(1, sha1s, centers[rng.integers(0, CLUSTERS, len(sha1s))] + noise)
+        print(f"--- {NUM_VECTORS}x{DIM} VECTORS in {CLUSTERS} clusters ---")
+
+        search = VectorSearch(store)
+        start = time.perf_counter()
+        index = await search.build_index(1, lambda f, *args: asyncio.get_running_loop().run_in_executor(None, f, *args))
+        print(f"  index of {len(index.centroids)} lists built in {time.perf_counter() - start:.1f}s")
+
+        queries = centers[rng.integers(0, CLUSTERS, NUM_QUERIES)] \
+            + rng.standard_normal((NUM_QUERIES, DIM), dtype=np.float32) * NOISE
+        await search.get_blocks(1)
+        exact, exact_time = await timed_search(search, queries, None)
+        exact = [{sha1 for sha1, _ in r} for r in exact]
+        print(f"  exact: {exact_time * 1000:.2f}ms/query")
+
+        for nprobe in NPROBES:
+            res, ann_time = await timed_search(search, queries, nprobe)
+            recall = np.mean([len({sha1 for sha1, _ in r} & e) / K for r, e in zip(res, exact)])
+            print(f"  nprobe {nprobe:>3}: recall@{K} {recall:.3f}, {ann_time * 1000:.2f}ms/query "
+                  f"({exact_time / ann_time:.1f}x)")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
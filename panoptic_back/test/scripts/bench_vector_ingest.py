@@ -0,0 +1,64 @@
+import asyncio
+import tempfile
+import time
+
+import numpy as np
+
+from panoptic.core.project.project import Project
+from panoptic.models import Vector, VectorType
+
+# --- CONFIGURATION ---
+NUM_SINGLE = 5_000
+NUM_VECTORS = 200_000
+DIM = 768
+BATCH = 2_000
+# time the fake model takes per vector of a batch
+MODEL_TIME = 0.00005
+
+
+async def embed(rng: np.random.Generator, start: int, size: int):
+    await asyncio.sleep(size * MODEL_TIME)
+    return [f'{i:040x}' for i in range(start, start + size)], rng.standard_normal((size, DIM), dtype=np.float32)
+
+
+async def batches(rng: np.random.Generator, offset: int):
+    for start in range(0, NUM_VECTORS, BATCH):
+        yield await embed(rng, offset + start, BATCH)
+
+
+async def main():
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as folder:
+        project = Project(folder, [], name='bench')
+        await project.start()
+        await project.wait_full_start()
+        db = project.db
+        single_type = await db._db.add_vector_type(VectorType(-1, 'bench', {}))
+        bulk_type = await db._db.add_vector_type(VectorType(-1, 'bench', {}))
+        stream_type = await db._db.add_vector_type(VectorType(-1, 'bench', {}))
+        print(f"--- {DIM}d VECTORS, batches of {BATCH}, model {MODEL_TIME * 1e6:.0f}us/vector ---")
+
+        sha1s, vectors = await embed(rng, 0, NUM_SINGLE)
+        start = time.perf_counter()
+        for sha1, vector in zip(sha1s, vectors):
+            await db.add_vector(Vector(single_type.id, sha1, vector))
+        duration = time.perf_counter() - start
+        print(f"  add_vector: {NUM_SINGLE / duration:,.0f} vectors/s (storage only)")
+
+        start = time.perf_counter()
+        for i in range(0, NUM_VECTORS, BATCH):
+            sha1s, vectors = await embed(rng, i, BATCH)
+            await db.add_vectors(bulk_type.id, sha1s, vectors)
+        duration = time.perf_counter() - start
+        print(f"  add_vectors: {NUM_VECTORS / duration:,.0f} vectors/s")
+
+        start = time.perf_counter()
+        await db.add_vectors_stream(stream_type.id, batches(rng, 0))
+        duration = time.perf_counter() - start
+        print(f"  add_vectors_stream: {NUM_VECTORS / duration:,.0f} vectors/s")
+        print(f"  model alone: {1 / MODEL_TIME:,.0f} vectors/s")
+        await project.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,66 @@
+import asyncio
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from panoptic.core.project.project import Project
+from panoptic.core.project_db.vector_precision import precisions
+from panoptic.models import VectorType
+
+# --- CONFIGURATION ---
+NUM_VECTORS = 100_000
+DIM = 768
+CLUSTERS = 1_000
+NOISE = 1.0
+BATCH = 10_000
+NUM_QUERIES = 100
+K = 10
+REPEAT = 3
+
+
+async def main():
+    rng = np.random.default_rng(0)
+    centers = rng.standard_normal((CLUSTERS, DIM), dtype=np.float32)
+    vectors = centers[rng.integers(0, CLUSTERS, NUM_VECTORS)] \
+        + rng.standard_normal((NUM_VECTORS, DIM), dtype=np.float32) * NOISE
+    sha1s = [f'{i:040x}' for i in range(NUM_VECTORS)]
+    queries = centers[rng.integers(0, CLUSTERS, NUM_QUERIES)] \
+        + rng.standard_normal((NUM_QUERIES, DIM), dtype=np.float32) * NOISE
+
+    with tempfile.TemporaryDirectory() as folder:
+        project = Project(folder, [], name='bench')
+        await project.start()
+        await project.wait_full_start()
+        db = project.db
+        print(f"--- {NUM_VECTORS}x{DIM} VECTORS, top {K} of {NUM_QUERIES} queries ---")
+
+        exact = None
+        for precision in precisions:
+            vector_type = await db._db.add_vector_type(VectorType(-1, 'bench', {'precision': precision}))
+            for start in range(0, NUM_VECTORS, BATCH):
+                await db.add_vectors(vector_type.id, sha1s[start:start + BATCH], vectors[start:start + BATCH])
+
+            matrix_size = os.path.getsize(project.paths.get_vector_matrix_path(vector_type.id))
+            cursor = await db._db.conn.execute_read('SELECT sum(length(data)) FROM vectors WHERE type_id = ?',
+                                                    (vector_type.id,))
+            db_size = (await cursor.fetchone())[0]
+
+            await db.vector_search.get_blocks(vector_type.id)
+            times = []
+            for _ in range(REPEAT):
+                start = time.perf_counter()
+                res = await db.vector_search.search(vector_type.id, queries, K)
+                times.append(time.perf_counter() - start)
+            found = [{sha1 for sha1, _ in r} for r in res]
+            if exact is None:
+                exact = found
+            recall = np.mean([len(f & e) / K for f, e in zip(found, exact)])
+            print(f"  {precision:>7}: matrix {matrix_size / 2 ** 20:6.0f}MB, vectors table {db_size / 2 ** 20:6.0f}MB, "
+                  f"recall@{K} {recall:.3f}, search {min(times) * 1000:.0f}ms")
+        await project.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
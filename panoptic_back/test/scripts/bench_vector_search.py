@@ -0,0 +1,51 @@
+import asyncio
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+from panoptic.core.project.project_paths import ProjectPaths
+from panoptic.core.project_db.vector_search import VectorSearch
+from panoptic.core.project_db.vector_store import VectorStore
+
+# --- CONFIGURATION ---
+NUM_VECTORS = 1_000_000
+DIM = 512
+WRITE_CHUNK = 100_000
+QUERY_SIZES = [1, 16, 64]
+K = 50
+REPEAT = 5
+
+
+async def main():
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as folder:
+        paths = ProjectPaths(Path(folder))
+        paths.create_paths()
+        store = VectorStore(paths)
+        await store.start({})
+
+        start = time.perf_counter()
+        for i in range(0, NUM_VECTORS, WRITE_CHUNK):
+            sha1s = [f'{j:040x}' for j in range(i, min(i + WRITE_CHUNK, NUM_VECTORS))]
+            await store.write(1, sha1s, rng.standard_normal((len(sha1s), DIM), dtype=np.float32))
+        print(f"--- {NUM_VECTORS}x{DIM} VECTORS, written in {time.perf_counter() - start:.1f}s ---")
+
+        search = VectorSearch(store)
+        start = time.perf_counter()
+        await search.get_blocks(1)
+        print(f"  inverse norms: {time.perf_counter() - start:.2f}s")
+
+        for size in QUERY_SIZES:
+            queries = rng.standard_normal((size, DIM), dtype=np.float32)
+            times = []
+            for _ in range(REPEAT):
+                start = time.perf_counter()
+                await search.search(1, queries, K)
+                times.append(time.perf_counter() - start)
+            print(f"  {size:>3} queries, top {K}: {min(times) * 1000:.0f}ms (best of {REPEAT})")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
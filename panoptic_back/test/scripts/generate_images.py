@@ -1,11 +1,6 @@
 from PIL import Image, ImageDraw, ImageFont
 import os
 
-# Create a directory for the images
-output_dir = "../data/images"
-if not os.path.exists(output_dir):
-    os.makedirs(output_dir)
-
 # Image settings
 image_size = (500, 500)  # Width, height
 background_color = (255, 255, 255)  # White background
@@ -14,6 +9,12 @@ font_color = (0, 0, 0)  # Black text
 # Path to macOS system font 'Helvetica'
 font_path = "/System/Library/Fonts/Helvetica.ttc"  # macOS default system font
 
+
+def text_size(draw, text, font):
+    left, top, right, bottom = draw.textbbox((0, 0), text, font=font)
+    return right - left, bottom - top
+
+
 # Function to find the maximum font size that fits within the image
 def get_max_font_size(draw, text, image_size, max_font_size=400, font_path=None):
     font_size = 10
@@ -22,7 +23,7 @@ def get_max_font_size(draw, text, image_size, max_font_size=400, font_path=None)
     while font_size <= max_font_size:
         try:
             font = ImageFont.truetype(font_path, font_size) if font_path else ImageFont.load_default()
-            text_width, text_height = draw.textsize(text, font=font)
+            text_width, text_height = text_size(draw, text, font)
             if text_width > image_size[0] * 0.9 or text_height > image_size[1] * 0.9:
                 break
             font_size += 1
@@ -33,23 +34,42 @@ def get_max_font_size(draw, text, image_size, max_font_size=400, font_path=None)
 
     return font
 
-for i in range(1, 11):
-    # Create a blank image with white background
-    img = Image.new('RGB', image_size, background_color)
-    draw = ImageDraw.Draw(img)
 
-    # Get maximum font size that fits the image
-    text = str(i)
-    font = get_max_font_size(draw, text, image_size, max_font_size=400, font_path=font_path)
+def generate_images(output_dir, count=10, size=image_size, ext='png'):
+    """
+    Writes number_1 to number_<count> images showing their number, returns their paths
+    """
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    files = []
+    font = None
+    for i in range(1, count + 1):
+        # Create a blank image with white background
+        img = Image.new('RGB', size, background_color)
+        draw = ImageDraw.Draw(img)
+
+        # Get maximum font size that fits the image, again when the number gets one more digit
+        text = str(i)
+        if font is None or i == 10 ** (len(text) - 1):
+            font = get_max_font_size(draw, text, size, max_font_size=400, font_path=font_path)
+
+        # Calculate text size and position for center alignment
+        text_width, text_height = text_size(draw, text, font)
+        position = ((size[0] - text_width) // 2, (size[1] - text_height) // 2)
 
-    # Calculate text size and position for center alignment
-    text_width, text_height = draw.textsize(text, font=font)
-    position = ((image_size[0] - text_width) // 2, (image_size[1] - text_height) // 2)
+        # Add text to the image
+        draw.text(position, text, font=font, fill=font_color)
 
-    # Add text to the image
-    draw.text(position, text, font=font, fill=font_color)
+        # Save the image
+        path = os.path.join(output_dir, f'number_{i}.{ext}')
+        img.save(path)
+        files.append(path)
+    return files
 
-    # Save the image
-    img.save(os.path.join(output_dir, f'number_{i}.png'))
 
-print(f"10 images generated in the '{output_dir}' folder.")
+if __name__ == "__main__":
+    # Create a directory for the images
+    output_dir = "../data/images"
+    generate_images(output_dir)
+    print(f"10 images generated in the '{output_dir}' folder.")
@@ -1,8 +1,35 @@
+import asyncio
+import multiprocessing
+import os
+import shutil
+import sqlite3
+from io import BytesIO
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+import numpy as np
+import pytest
+from PIL import Image
+from starlette.requests import Request
+
+from panoptic.core.project import import_pool
+from panoptic.core.project.import_pool import ImportPool
 from panoptic.core.project.project import Project
-from panoptic.models import PropertyType, Property, PropertyMode, InstanceProperty, DbCommit, Instance
+from panoptic.core.task.generate_atlas_task import GenerateAtlasTask
+from panoptic.core.project_db import vector_search
+from panoptic.core.project_db.vector_precision import get_precision
+from panoptic.core.task import import_folder_task
+from panoptic.core.task.import_folder_task import ImportFolderTask
+from panoptic.core.task.import_instance_task import ImportInstanceTask, fast_decode
+from panoptic.core.task.task import Task
+from panoptic.core.task.task_metrics import to_prometheus
+from panoptic.models import PropertyType, Property, PropertyMode, InstanceProperty, DbCommit, Instance, \
+    InstancePropertyKey, ImagePropertyKey, Vector, VectorType, SimilarImagesPayload
+from panoptic.core.project_db.image_store import kind_bits
+from panoptic.routes.image_utils import get_image_response, small_order, large_order, stream_image_batch, batch_header, \
+    batch_kind_codes
+from panoptic.routes.project_routes import get_similar_images_route
 from panoptic.utils import Trie, RelativePathTrie
 
 TAG_ID = 1
@@ -944,3 +971,948 @@ async def test_trie(data_project: Project):
 
     res6 = trie.search_relative_path(unix_no_slash)
     assert (len(res6) == 0)
+
+
+async def test_db_wal_read_pool(data_project: Project):
+    conn = data_project.db._db.conn
+    cursor = await conn.execute_query('PRAGMA journal_mode')
+    assert (await cursor.fetchone())[0] == 'wal'
+    assert len(conn.readers) == conn.nb_readers
+
+    # an open write transaction must not block nor leak into the read pool
+    await conn.conn.execute('BEGIN IMMEDIATE')
+    await conn.conn.execute('DELETE FROM instance_property_values')
+    values = await data_project.db.get_instance_property_values()
+    assert len(values) == 50
+    await conn.conn.rollback()
+
+    assert len(await data_project.db.get_instances()) == 10
+
+
+async def test_group_commit_concurrent(data_project: Project):
+    db = data_project.db
+    instances = await db.get_instances()
+    commits = [DbCommit(instance_values=[InstanceProperty(STRING_ID, i.id, f'group_{i.id}')]) for i in instances]
+    invalid = DbCommit(instance_values=[InstanceProperty(9999, instances[0].id, 'nope')])
+
+    results = await asyncio.gather(*[db.apply_commit(c) for c in commits], db.apply_commit(invalid),
+                                   return_exceptions=True)
+    inverses, error = results[:-1], results[-1]
+    assert isinstance(error, Exception)
+    assert all(isinstance(inv, DbCommit) for inv in inverses)
+    assert all(len(inv.instance_values) + len(inv.empty_instance_values) == 1 for inv in inverses)
+
+    values = await db.get_instance_property_values(property_ids=[STRING_ID])
+    assert {v.value for v in values} == {f'group_{i.id}' for i in instances}
+
+    # inverses are kept separate and restore the previous state
+    await asyncio.gather(*[db.apply_commit(inv) for inv in inverses])
+    values = await db.get_instance_property_values(property_ids=[STRING_ID])
+    assert not any(str(v.value).startswith('group_') for v in values)
+
+
+async def test_values_from_keys(data_project: Project):
+    db = data_project.db
+    instances = await db.get_instances()
+    keys = [InstancePropertyKey(p, i.id) for i in instances for p in [STRING_ID, NUMBER_ID, 9999]]
+    values = await db.get_instance_property_values_from_keys(keys)
+    expected = await db.get_instance_property_values(property_ids=[STRING_ID, NUMBER_ID])
+    assert sorted((v.property_id, v.instance_id, str(v.value)) for v in values) == \
+           sorted((v.property_id, v.instance_id, str(v.value)) for v in expected)
+
+    image_values = await db.get_image_property_values()
+    image_keys = [ImagePropertyKey(v.property_id, v.sha1) for v in image_values]
+    found = await db.get_image_property_values_from_keys(image_keys + [ImagePropertyKey(TAG_ID, 'missing')])
+    assert len(found) == len(image_values)
+
+    await db._db.delete_instance_property_values(keys)
+    await db._db.delete_image_property_values(image_keys)
+    assert len(await db.get_instance_property_values(property_ids=[STRING_ID, NUMBER_ID])) == 0
+    assert len(await db.get_image_property_values()) == 0
+
+
+async def test_id_allocator(data_project: Project):
+    db = data_project.db._db
+    instances = await data_project.db.get_instances()
+    last_id = max(i.id for i in instances)
+
+    batches = await asyncio.gather(*[db.get_new_instance_ids(3) for _ in range(20)])
+    ids = [i for b in batches for i in b]
+    assert len(set(ids)) == len(ids) == 60
+    assert min(ids) > last_id
+
+    # a block is reserved ahead so ids are never given twice after a restart
+    cursor = await db.conn.execute_read("SELECT next FROM id_counter WHERE name = 'instance'")
+    row = await cursor.fetchone()
+    assert row[0] > max(ids)
+
+
+async def test_image_store(data_project: Project, request):
+    # thumbnails of the test db are moved from the blob columns to the pack files on start
+    base_path = Path(request.fspath).parent / 'data' / 'data.db'
+    with sqlite3.connect(base_path) as conn:
+        blobs = conn.execute('SELECT sha1, small, medium, large FROM images').fetchall()
+
+    db = data_project.db
+    for sha1, small, medium, large in blobs:
+        assert await db.has_image(sha1)
+        assert bytes(await db.get_small_image(sha1)) == small
+        assert bytes(await db.get_medium_image(sha1)) == medium
+        assert bytes(await db.get_large_image(sha1)) == large
+    assert not await db._db.has_image_blobs()
+
+    sha1 = 'ab' * 20
+    await db.import_image(sha1, b'small', b'', b'large')
+    await db.import_raw_image(sha1, 'image/png', b'raw')
+    assert bytes(await db.get_small_image(sha1)) == b'small'
+    assert not await db.get_medium_image(sha1)
+    assert await db.get_raw_image(sha1) == ('image/png', b'raw')
+
+    await db.delete_small_images()
+    assert await db.get_small_image(sha1) is None
+    assert bytes(await db.get_large_image(sha1)) == b'large'
+
+    # the index is read back from the pack files
+    project_path = data_project.base_path
+    await data_project.close()
+    project = Project(project_path, [], name='test_project')
+    await project.start()
+    await project.wait_full_start()
+    assert await project.db.get_raw_image(sha1) == ('image/png', b'raw')
+    assert await project.db.get_small_image(sha1) is None
+    assert bytes(await project.db.get_medium_image(blobs[0][0])) == blobs[0][2]
+    await project.close()
+
+
+async def test_close_applies_queued_commits(data_project: Project):
+    db = data_project.db
+    instances = await db.get_instances()
+    tasks = [asyncio.create_task(db.apply_commit(DbCommit(instance_values=[InstanceProperty(STRING_ID, i.id, 'x')])))
+             for i in instances]
+    await asyncio.sleep(0)
+    await db.close()
+    results = await asyncio.wait_for(asyncio.gather(*tasks, return_exceptions=True), 5)
+    assert all(isinstance(r, DbCommit) for r in results)
+
+
+async def test_id_reservation_rolled_back(data_project: Project):
+    db = data_project.db._db
+    conn = db.conn
+    with pytest.raises(ValueError):
+        async with conn.transaction():
+            await db.get_new_instance_ids(5000)
+            raise ValueError()
+
+    ids = await db.get_new_instance_ids(1)
+    cursor = await conn.execute_read("SELECT next FROM id_counter WHERE name = 'instance'")
+    row = await cursor.fetchone()
+    assert row[0] > ids[0]
+
+
+async def test_id_reservation_failed(data_project: Project, monkeypatch):
+    db = data_project.db._db
+    conn = db.conn
+    execute_query = conn.execute_query
+
+    async def failing_query(*args, **kwargs):
+        raise RuntimeError()
+
+    monkeypatch.setattr(conn, 'execute_query', failing_query)
+    with pytest.raises(RuntimeError):
+        await db.get_new_tag_ids(5000)
+    monkeypatch.setattr(conn, 'execute_query', execute_query)
+
+    # the failed reservation is written again before handing out the next ids
+    ids = await db.get_new_tag_ids(1)
+    cursor = await conn.execute_read("SELECT next FROM id_counter WHERE name = 'tag'")
+    row = await cursor.fetchone()
+    assert row[0] > ids[0]
+
+
+async def test_db_readers_setting(data_project: Project):
+    conn = data_project.db._db.conn
+    assert len(conn.readers) == data_project.settings.db_readers
+
+    settings = data_project.settings.model_copy()
+    settings.db_readers = 2
+    await data_project.update_settings(settings)
+    assert len(conn.readers) == 2
+    assert (await data_project.db.get_project_settings()).db_readers == 2
+    assert len(await data_project.db.get_instances()) == 10
+
+
+def make_request(query: str = '', headers: dict = None):
+    raw_headers = [(k.lower().encode(), v.encode()) for k, v in (headers or {}).items()]
+    return Request({'type': 'http', 'method': 'GET', 'path': '/', 'query_string': query.encode(),
+                    'headers': raw_headers})
+
+
+async def test_image_etag(data_project: Project):
+    sha1 = (await data_project.db.get_instances())[0].sha1
+
+    res = await get_image_response(data_project, make_request(), sha1, small_order)
+    assert res.status_code == 200
+    assert res.headers['cache-control'] == 'no-cache'
+    etag = res.headers['etag']
+
+    res = await get_image_response(data_project, make_request(headers={'If-None-Match': etag}), sha1, small_order)
+    assert res.status_code == 304
+
+    versioned = make_request(f'v={data_project.image_version}')
+    res = await get_image_response(data_project, versioned, sha1, small_order)
+    assert 'immutable' in res.headers['cache-control']
+    # the fallback of a missing size is revalidated
+    await data_project.db.delete_large_images()
+    res = await get_image_response(data_project, versioned, sha1, large_order)
+    assert res.status_code == 200
+    assert res.headers['cache-control'] == 'no-cache'
+
+    # the tags change with the thumbnail sizes
+    settings = data_project.settings.model_copy()
+    settings.image_small_size = 64
+    await data_project.update_settings(settings)
+    res = await get_image_response(data_project, make_request(headers={'If-None-Match': etag}), sha1, small_order)
+    assert res.headers['etag'] != etag
+
+
+async def test_image_cache(data_project: Project):
+    images = data_project.db.images
+    sha1 = (await data_project.db.get_instances())[0].sha1
+    # every small and medium thumbnail of the test data fits in the default budget
+    assert len(images.cache) == 20
+
+    hits = images.cache.hits
+    assert bytes(await data_project.db.get_small_image(sha1)) == images.cache.get('small', sha1)
+    assert images.cache.hits == hits + 2
+
+    assert images.available_kinds(sha1) == kind_bits['small'] | kind_bits['medium'] | kind_bits['large']
+    await data_project.db.delete_small_images()
+    assert images.available_kinds(sha1) == kind_bits['medium'] | kind_bits['large']
+    assert images.cache.get('small', sha1) is None
+    res = await get_image_response(data_project, make_request(), sha1, small_order)
+    assert res.headers['etag'].startswith(f'"{sha1}-medium')
+
+    images.cache.set_budget(images.cache.size // 2)
+    assert images.cache.size <= images.cache.budget
+
+
+async def test_image_batch(data_project: Project):
+    sha1s = [i.sha1 for i in await data_project.db.get_instances()][:3] + ['00' * 20]
+    data = b''.join([chunk async for chunk in stream_image_batch(data_project, sha1s, 'small')])
+
+    position = 0
+    for sha1 in sha1s:
+        kind, size = batch_header.unpack_from(data, position)
+        position += batch_header.size
+        if sha1 == '00' * 20:
+            assert kind == 0 and size == 0
+            continue
+        assert kind == batch_kind_codes['small']
+        assert data[position:position + size] == bytes(await data_project.db.get_small_image(sha1))
+        position += size
+    assert position == len(data)
+
+
+async def test_generate_atlas_incremental(data_project: Project, monkeypatch):
+    task = GenerateAtlasTask()
+    task.set_project(data_project)
+    await task.run()
+    atlas = await data_project.db.get_atlas(0)
+    sha1s = await data_project.db.get_all_instance_sha1s()
+    assert set(atlas.sha1_mapping) == sha1s
+    assert atlas.atlas_nb == 1
+
+    # nothing new, the sheet is not drawn again
+    sheet_path = data_project.paths.get_atlas_sheet_path(0, 0)
+    Image.new('RGBA', (2048, 2048)).save(sheet_path)
+    await task.run()
+    assert Image.open(sheet_path).getpixel((32, 32))[3] == 0
+
+    # only the missing sha1 is appended after the last cell
+    removed = sorted(sha1s)[0]
+    mapping = dict(atlas.sha1_mapping)
+    del mapping[removed]
+    atlas.sha1_mapping = mapping
+    await data_project.db.import_atlas(atlas)
+    await task.run()
+    atlas = await data_project.db.get_atlas(0)
+    assert tuple(atlas.sha1_mapping[removed]) == (0, len(sha1s))
+    sheet = Image.open(sheet_path)
+    # cells of the other images were kept as they were (empty here)
+    assert sheet.getpixel((32, 32))[3] == 0
+    assert sheet.getpixel((len(sha1s) * 64 + 32, 32))[3] > 0
+
+    # an image that can't be read takes no cell and is tried again, the thumbnails are read outside the cache
+    failed = sorted(sha1s)[1]
+    del atlas.sha1_mapping[failed]
+    await data_project.db.import_atlas(atlas)
+    images = data_project.db.images
+    get_image = images.get_image
+    monkeypatch.setattr(images, 'get_image', lambda kind, sha1, cached=True:
+                        b'broken' if sha1 == failed else get_image(kind, sha1, cached))
+    lookups = images.cache.hits + images.cache.misses
+    await task.run()
+    atlas = await data_project.db.get_atlas(0)
+    assert failed not in atlas.sha1_mapping
+    assert atlas.atlas_nb == 1
+    assert images.cache.hits + images.cache.misses == lookups
+    monkeypatch.undo()
+    await task.run()
+    atlas = await data_project.db.get_atlas(0)
+    assert tuple(atlas.sha1_mapping[failed]) == (0, len(sha1s) + 1)
+
+
+async def test_import_pool(empty_project: Project, image_dir: str):
+    file = str(next(Path(image_dir).rglob('*.png')))
+    res = await empty_project.import_pool.run(ImportInstanceTask._import_image, file)
+    expected = ImportInstanceTask._import_image(file, empty_project.settings)
+    assert res[0] == expected[0]
+    assert not empty_project.import_pool._broken
+
+
+def crash_worker(crash: bool, settings):
+    # only a worker process exits, the thread fallback answers
+    if multiprocessing.parent_process() is None:
+        return 'thread'
+    if crash:
+        os._exit(1)
+    return 'process'
+
+
+async def test_import_pool_broken():
+    fallback = ThreadPoolExecutor(1)
+    pool = ImportPool(fallback, workers=1)
+    # the call lost with the pool runs on a thread, the next one gets a new pool
+    assert await pool.run(crash_worker, True) == 'thread'
+    assert not pool._broken
+    assert await pool.run(crash_worker, False) == 'process'
+    # pools that keep breaking leave the imports on threads
+    for _ in range(import_pool.max_pool_failures):
+        assert await pool.run(crash_worker, True) == 'thread'
+    assert pool._broken
+    assert await pool.run(crash_worker, False) == 'thread'
+    pool.shutdown()
+    fallback.shutdown()
+
+
+async def test_import_sink_batches(instance_project: Project, image_dir: str, tmp_path: Path):
+    folder = (await instance_project.db.get_folders())[0]
+    files = []
+    for i, file in enumerate(sorted(Path(image_dir).rglob('*.png'))):
+        copy = tmp_path / f'copy_{i}.png'
+        shutil.copy(file, copy)
+        files.append(str(copy))
+
+    imported = []
+
+    async def on_import(instances):
+        imported.append(instances)
+
+    instance_project.db.on_import_instances.register(on_import)
+    commits = len(instance_project.ui.commits)
+    tasks = [ImportInstanceTask(i, f, folder.id) for i, f in enumerate(files)]
+    for task in tasks:
+        task.set_project(instance_project)
+    instances = await asyncio.gather(*[t.run() for t in tasks])
+    await asyncio.sleep(0)
+
+    assert len({i.id for i in instances}) == len(files)
+    assert len(await instance_project.db.get_instances()) == 10 + len(files)
+    # one commit and one event for the whole batch
+    assert len(instance_project.ui.commits) == commits + 1
+    assert len(imported) == 1 and len(imported[0]) == len(files)
+
+
+@pytest.mark.parametrize('format_', ['jpeg', 'png', 'webp'])
+def test_fast_decode(empty_project: Project, tmp_path: Path, format_: str):
+    file = tmp_path / f'image.{format_}'
+    gradient = np.linspace(0, 255, 3000, dtype=np.uint8)
+    pixels = np.stack(np.broadcast_arrays(gradient[None, :], gradient[:2000, None], 128), axis=-1)
+    Image.fromarray(pixels.astype(np.uint8)).save(file)
+
+    image = Image.open(file)
+    reduced = fast_decode(image, 700)
+    assert 700 <= max(reduced.size) < 1400
+
+    settings = empty_project.settings
+    full = ImportInstanceTask._import_image(str(file), settings)
+    fast = ImportInstanceTask._import_image(str(file), settings.model_copy(update={'fast_decode': True}))
+    # same sha1 and size as the full decode and visually the same thumbnails
+    assert fast[:3] == full[:3]
+    for full_bytes, fast_bytes in zip(full[5:7], fast[5:7]):
+        full_image = np.asarray(Image.open(BytesIO(full_bytes)), dtype=np.float32)
+        fast_image = np.asarray(Image.open(BytesIO(fast_bytes)), dtype=np.float32)
+        assert full_image.shape == fast_image.shape
+        assert np.abs(full_image - fast_image).mean() < 2
+
+
+async def test_reimport_folder_skips_known_files(empty_project: Project, image_dir: str):
+    queued = []
+    empty_project.task_queue.add_tasks = queued.extend
+    imported = []
+
+    async def on_import(instances):
+        imported.extend(instances)
+
+    empty_project.db.on_import_instances.register(on_import)
+
+    task = ImportFolderTask(1, image_dir)
+    task.set_project(empty_project)
+    await task.run()
+    assert len(queued) == 10
+    for instance_task in queued:
+        instance_task.set_project(empty_project)
+    await asyncio.gather(*[t.run() for t in queued[:6]])
+
+    # only the files missing from the project are imported again
+    queued.clear()
+    imported.clear()
+    task = ImportFolderTask(2, image_dir)
+    task.set_project(empty_project)
+    await task.run()
+    await asyncio.sleep(0)
+    assert len(queued) == 4
+    assert len(imported) == 6
+    assert {t.file for t in queued}.isdisjoint({i.url for i in imported})
+
+
+async def test_rescan_folder(empty_project: Project, image_dir: str, tmp_path: Path, monkeypatch):
+    folder = tmp_path / 'images'
+    shutil.copytree(image_dir, folder)
+    queued = []
+    empty_project.task_queue.add_tasks = queued.extend
+    emitted_folders = []
+    monkeypatch.setattr(empty_project.on.sync, 'emitFolders', emitted_folders.append)
+
+    async def run_folder_task(seq: int, rescan: bool):
+        queued.clear()
+        task = ImportFolderTask(seq, str(folder), rescan)
+        task.set_project(empty_project)
+        await task.run()
+        for instance_task in queued:
+            instance_task.set_project(empty_project)
+        return await asyncio.gather(*[t.run() for t in queued])
+
+    await run_folder_task(1, False)
+    instances = {Path(i.url).name: i for i in await empty_project.db.get_instances()}
+    assert len(instances) == 10
+
+    changes = []
+
+    async def on_rescan(res):
+        changes.append(res)
+
+    empty_project.on.rescan_folder.register(on_rescan)
+    # the tree is sent once when it is created, not again for an unchanged folder
+    assert len(emitted_folders) == 1
+    assert await run_folder_task(2, True) == []
+    assert len(emitted_folders) == 1
+
+    files = sorted(folder.rglob('*.png'))
+    modified, deleted = files[0], files[1]
+    Image.new('RGB', (64, 64), (255, 0, 0)).save(modified)
+    deleted.unlink()
+    shutil.copy(files[2], folder / 'added.png')
+
+    synced = []
+    monkeypatch.setattr(empty_project.on.sync, 'emitCommit', synced.append)
+    updated = await run_folder_task(3, True)
+    await asyncio.sleep(0)
+    res = changes[-1]
+    assert res.added == [str(folder / 'added.png')]
+    assert res.modified == [str(modified)]
+    assert res.deleted == [str(deleted)]
+
+    now = {Path(i.url).name: i for i in await empty_project.db.get_instances()}
+    assert len(now) == 10
+    assert deleted.name not in now
+    # the modified file keeps its instance with the new content
+    old = instances[modified.name]
+    assert now[modified.name].id == old.id
+    assert now[modified.name].sha1 != old.sha1
+    assert now[modified.name].sha1 in {i.sha1 for i in updated}
+    assert str(modified) in empty_project.sha1_to_files[now[modified.name].sha1]
+    assert str(modified) not in empty_project.sha1_to_files.get(old.sha1, [])
+    # the other clients receive the updated instance
+    assert any(i.id == old.id and i.sha1 == now[modified.name].sha1 for c in synced for i in c.instances)
+
+    # the folders removed from the disk are removed from the project
+    shutil.rmtree(folder / '7-10')
+    await run_folder_task(4, True)
+    await asyncio.sleep(0)
+    assert len(changes[-1].deleted) == 4
+    folders = {f.path for f in await empty_project.db.get_folders()}
+    assert folders == {str(folder), str(folder / '2-3'), str(folder / '4-6')}
+    assert {f.path for f in emitted_folders[-1]} == folders
+    assert len(await empty_project.db.get_instances()) == 6
+
+    # the new content and the fingerprint of a file are written together
+    async def fail(fingerprints):
+        raise sqlite3.OperationalError('disk full')
+
+    Image.new('RGB', (64, 64), (0, 0, 255)).save(modified)
+    monkeypatch.setattr(empty_project.db, 'set_file_fingerprints', fail)
+    with pytest.raises(sqlite3.OperationalError):
+        await run_folder_task(5, True)
+    instance = (await empty_project.db.get_instances(ids=[old.id]))[0]
+    assert instance.sha1 == now[modified.name].sha1
+
+
+async def test_folder_tree_bulk_insert(empty_project: Project, image_dir: str):
+    files = list(ImportFolderTask._scan_directories([image_dir], 100))
+    task = ImportFolderTask(1, image_dir)
+    task.set_project(empty_project)
+    root_id, file_to_folder_id = await task._compute_folder_structure(image_dir, files)
+
+    folders = {f.name: f for f in await empty_project.db.get_folders()}
+    assert len(folders) == 4
+    assert folders['images'].id == root_id and folders['images'].parent is None
+    for name in ['2-3', '4-6', '7-10']:
+        assert folders[name].parent == root_id
+        assert folders[name].path == image_dir + '/' + name
+    assert {file_to_folder_id[f] for f in files} == {f.id for f in folders.values()}
+
+    # the existing folders keep their ids
+    again = await task._compute_folder_structure(image_dir, files)
+    assert again == (root_id, file_to_folder_id)
+    assert len(await empty_project.db.get_folders()) == 4
+
+
+async def test_import_folder_streams(empty_project: Project, image_dir: str, monkeypatch):
+    monkeypatch.setattr(import_folder_task, 'scan_chunk_size', 1)
+    monkeypatch.setattr(import_folder_task, 'import_backlog', 2)
+    queue = empty_project.task_queue
+    backlogs = []
+    add_tasks = queue.add_tasks
+
+    def add(tasks):
+        backlogs.append(queue.count_waiting('ImportInstanceTask'))
+        add_tasks(tasks)
+
+    queue.add_tasks = add
+    # the imports wait behind the scan until the queue makes room
+    queue.set_limit('ImportInstanceTask', 1)
+    await empty_project.import_folder(image_dir)
+    await queue.onFinish.wait()
+
+    # one chunk per directory
+    assert len(backlogs) == 4
+    assert max(backlogs) < 2
+    assert len(await empty_project.db.get_instances()) == 10
+
+
+async def test_vector_matrix(empty_project: Project):
+    db = empty_project.db
+    vector_type = await db._db.add_vector_type(VectorType(-1, 'test', {}))
+    rng = np.random.default_rng(0)
+    sha1s = [f'{i:040x}' for i in range(20)]
+    vectors = rng.random((20, 8), dtype=np.float32)
+    for sha1, vector in zip(sha1s, vectors):
+        await db.add_vector(Vector(vector_type.id, sha1, vector))
+    # a known sha1 is replaced in place
+    vectors[3] = 0
+    await db.add_vector(Vector(vector_type.id, sha1s[3], vectors[3]))
+    with pytest.raises(ValueError):
+        await db.add_vector(Vector(vector_type.id, 'ff' * 20, np.zeros(4, dtype=np.float32)))
+
+    rows, matrix = await db.get_vector_matrix(vector_type.id)
+    assert rows == sha1s
+    assert np.array_equal(matrix, vectors)
+    assert isinstance(matrix.base, np.memmap) and not matrix.flags.writeable
+
+    # the rows of the deleted sha1s are removed when the matrix is compacted
+    await db.vectors.delete(sha1s[:2])
+    assert np.array_equal(matrix, vectors)
+    rows, matrix = await db.get_vector_matrix(vector_type.id)
+    assert rows == sha1s[2:]
+    assert np.array_equal(matrix, vectors[2:])
+    saved = np.load(empty_project.paths.get_vector_matrix_path(vector_type.id))
+    assert np.array_equal(saved, vectors[2:])
+
+    # a missing matrix is built again from the vectors table
+    await db._db.delete_vectors(sha1s[:2])
+    project_path = empty_project.base_path
+    await empty_project.close()
+    empty_project.paths.get_vector_index_path(vector_type.id).unlink()
+    project = Project(project_path, [], name='test_project')
+    await project.start()
+    rows, matrix = await project.db.get_vector_matrix(vector_type.id)
+    assert sorted(zip(rows, matrix.tolist())) == sorted(zip(sha1s[2:], vectors[2:].tolist()))
+    await project.close()
+
+
+async def test_vector_search(empty_project: Project, monkeypatch):
+    monkeypatch.setattr(vector_search, 'search_block_size', 64)
+    vector_type = await empty_project.db._db.add_vector_type(VectorType(-1, 'test', {}))
+    rng = np.random.default_rng(0)
+    sha1s = [f'{i:040x}' for i in range(500)]
+    vectors = rng.standard_normal((500, 16)).astype(np.float32)
+    await empty_project.db.vectors.write(vector_type.id, sha1s, vectors)
+
+    normalized = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    expected = np.argsort(-(normalized[:3] @ normalized.T), axis=1)
+
+    req = SimilarImagesPayload(type_id=vector_type.id, sha1s=sha1s[:3], vectors=(vectors[:3] * 2).tolist(), k=10)
+    groups = (await get_similar_images_route(req, empty_project)).groups
+    assert len(groups) == 6
+    for i in range(3):
+        # the query sha1 is not in its own results
+        assert groups[i].sha1s == [sha1s[r] for r in expected[i][1:11]]
+        assert groups[i + 3].sha1s == [sha1s[r] for r in expected[i][:10]]
+        assert groups[i + 3].scores.values[0] == pytest.approx(1, abs=1e-5)
+        assert groups[i].scores.values == sorted(groups[i].scores.values, reverse=True)
+
+    # the blocks follow the changes of the matrix
+    await empty_project.db.vectors.write(vector_type.id, ['ff' * 20], normalized[0] * 3)
+    res = await empty_project.db.vector_search.search_sha1s(vector_type.id, [sha1s[0]], 1)
+    assert res == [[('ff' * 20, pytest.approx(1, abs=1e-5))]]
+
+
+async def test_add_vectors(empty_project: Project):
+    db = empty_project.db
+    vector_type = await db._db.add_vector_type(VectorType(-1, 'test', {}))
+    rng = np.random.default_rng(0)
+    sha1s = [f'{i:040x}' for i in range(100)]
+    vectors = rng.random((100, 8))
+    assert await db.add_vectors(vector_type.id, sha1s[:50], vectors[:50]) == 50
+    with pytest.raises(ValueError):
+        await db.add_vectors(vector_type.id, sha1s[50:], vectors[50:60])
+    with pytest.raises(ValueError):
+        await db.add_vectors(vector_type.id, ['ff' * 20], np.zeros((1, 4)))
+
+    async def batches():
+        for start in range(40, 100, 20):
+            yield sha1s[start:start + 20], vectors[start:start + 20]
+            await asyncio.sleep(0)
+
+    # known sha1s are replaced
+    vectors[40:50] = 0
+    assert await db.add_vectors_stream(vector_type.id, batches()) == 60
+    rows, matrix = await db.get_vector_matrix(vector_type.id)
+    assert rows == sha1s
+    assert np.allclose(matrix, vectors)
+    saved = await db.get_vectors(vector_type.id)
+    assert len(saved) == 100
+    assert all(np.allclose(v.data, vectors[int(v.sha1, 16)]) for v in saved)
+
+
+async def test_vector_precision(empty_project: Project):
+    db = empty_project.db
+    rng = np.random.default_rng(0)
+    sha1s = [f'{i:040x}' for i in range(200)]
+    vectors = rng.standard_normal((200, 32)).astype(np.float32)
+    vectors[5] = 0
+    with pytest.raises(ValueError):
+        get_precision({'precision': 'int4'})
+
+    types = {}
+    for precision, itemsize, tolerance in [('float32', 4, 0), ('float16', 2, 1e-2), ('int8', 1, 3e-2)]:
+        vector_type = await db._db.add_vector_type(VectorType(-1, 'test', {'precision': precision}))
+        types[precision] = vector_type.id
+        await db.add_vectors(vector_type.id, sha1s[:100], vectors[:100])
+        for sha1, vector in zip(sha1s[100:], vectors[100:]):
+            await db.add_vector(Vector(vector_type.id, sha1, vector))
+
+        # the matrix file and the table hold the reduced vectors, they are read back as float32
+        saved = np.load(empty_project.paths.get_vector_matrix_path(vector_type.id))
+        assert saved.dtype.itemsize == itemsize
+        rows, matrix = await db.get_vector_matrix(vector_type.id)
+        assert rows == sha1s and matrix.dtype == np.float32
+        assert np.allclose(matrix, vectors, atol=tolerance * np.abs(vectors).max())
+        assert not matrix[5].any()
+        stored = await db.get_vectors(vector_type.id, sha1s[:1])
+        assert np.array_equal(stored[0].data, matrix[0])
+
+        res = await db.vector_search.search_sha1s(vector_type.id, sha1s[:20], 1)
+        exact = await db.vector_search.search_sha1s(types['float32'], sha1s[:20], 1)
+        assert sum(r[0][0] == e[0][0] for r, e in zip(res, exact)) >= 18
+
+    # a matrix is built again with the precision of its type
+    empty_project.paths.get_vector_matrix_path(types['int8']).unlink()
+    project_path = empty_project.base_path
+    await empty_project.close()
+    project = Project(project_path, [], name='test_project')
+    await project.start()
+    saved = np.load(project.paths.get_vector_matrix_path(types['int8']))
+    assert saved.dtype == np.int8 and saved.shape == (200, 32 + 4)
+    rows, matrix = await project.db.get_vector_matrix(types['int8'])
+    assert rows == sha1s
+    assert np.allclose(matrix, vectors, atol=3e-2 * np.abs(vectors).max())
+    await project.close()
+
+
+async def test_vector_index(empty_project: Project, monkeypatch):
+    db = empty_project.db
+    vector_type = await db._db.add_vector_type(VectorType(-1, 'test', {}))
+    rng = np.random.default_rng(0)
+    centers = rng.standard_normal((20, 16))
+    vectors = (centers[rng.integers(0, 20, 2000)] + rng.standard_normal((2000, 16)) * 0.1).astype(np.float32)
+    sha1s = [f'{i:040x}' for i in range(2000)]
+    await db.add_vectors(vector_type.id, sha1s, vectors)
+
+    empty_project.build_vector_index(vector_type.id)
+    await empty_project.task_queue.onFinish.wait()
+    index = db.vector_search.indexes[vector_type.id]
+    assert sum(len(rows) for rows in index.lists) == 2000
+
+    # scanning every list gives the exact result
+    queries = vectors[:5]
+    exact = await db.vector_search.search(vector_type.id, queries, 10)
+    approximate = await db.vector_search.search(vector_type.id, queries, 10, nprobe=len(index.centroids))
+    assert [[s for s, _ in r] for r in approximate] == [[s for s, _ in r] for r in exact]
+    approximate = await db.vector_search.search(vector_type.id, queries, 10, nprobe=4)
+    recall = np.mean([len({s for s, _ in a} & {s for s, _ in e}) / 10 for a, e in zip(approximate, exact)])
+    assert recall >= 0.9
+
+    # added vectors are put in the index, the deleted ones leave it when the matrix is compacted
+    await db.add_vector(Vector(vector_type.id, 'ff' * 20, vectors[0] * 2))
+    res = await db.vector_search.search_sha1s(vector_type.id, [sha1s[0]], 1, nprobe=1)
+    assert res[0][0][0] == 'ff' * 20
+    await db.vectors.delete(sha1s[:1000])
+    res = await db.vector_search.search(vector_type.id, vectors[:1], 5, nprobe=4)
+    assert res[0][0][0] == 'ff' * 20
+    assert all(int(s, 16) >= 1000 for s, _ in res[0][1:])
+    assert sum(len(rows) for rows in index.lists) == 1001
+
+    # the index is saved with the project
+    await db._db.delete_vectors(sha1s[:1000])
+    project_path = empty_project.base_path
+    await empty_project.close()
+    project = Project(project_path, [], name='test_project')
+    await project.start()
+    index = project.db.vector_search.indexes[vector_type.id]
+    assert sum(len(rows) for rows in index.lists) == 1001
+    res = await project.db.vector_search.search(vector_type.id, vectors[:1], 1, nprobe=1)
+    assert res[0][0][0] == 'ff' * 20
+
+    # the rows are committed before the matrix is written, a failed write builds the matrix again from the table
+    write = project.db.vectors.write
+
+    async def fail_once(*args):
+        monkeypatch.setattr(project.db.vectors, 'write', write)
+        raise OSError('disk full')
+
+    monkeypatch.setattr(project.db.vectors, 'write', fail_once)
+    added = [f'{i:040x}' for i in range(2000, 2010)]
+    with pytest.raises(OSError):
+        await project.db.add_vectors(vector_type.id, added, -vectors[:10])
+    assert len(await project.db.get_vectors(vector_type.id)) == 1011
+    rows, matrix = await project.db.get_vector_matrix(vector_type.id)
+    assert sorted(rows) == sorted(sha1s[1000:] + ['ff' * 20] + added)
+    index = project.db.vector_search.indexes[vector_type.id]
+    assert sum(len(rows) for rows in index.lists) == 1011
+    res = await project.db.vector_search.search(vector_type.id, -vectors[:1], 1, nprobe=1)
+    assert res[0][0][0] == added[0]
+    await project.close()
+
+
+class SleepTask(Task):
+    def __init__(self, kind: str, priority: bool, log: list):
+        super().__init__(priority=priority)
+        self.kind = kind
+        self.key = kind
+        self.log = log
+
+    async def run(self):
+        self.log.append(('start', self.kind))
+        await asyncio.sleep(0.01)
+        self.log.append(('end', self.kind))
+
+
+async def test_task_queue_limits(empty_project: Project):
+    queue = empty_project.task_queue
+    await queue.onFinish.wait()
+    log = []
+
+    # an idle queue starts a task right away
+    queue.add_task(SleepTask('short', False, log))
+    await asyncio.sleep(0)
+    assert log == [('start', 'short')]
+    await queue.onFinish.wait()
+
+    log.clear()
+    queue.set_limit('capped', 2)
+    for _ in range(6):
+        queue.add_task(SleepTask('capped', True, log))
+    for _ in range(3):
+        queue.add_task(SleepTask('normal', False, log))
+    assert not queue.onFinish.is_set()
+    await queue.onFinish.wait()
+
+    running = defaultdict(int)
+    peak = defaultdict(int)
+    for event, kind in log:
+        running[kind] += 1 if event == 'start' else -1
+        peak[kind] = max(peak[kind], running[kind])
+    assert peak['capped'] == 2
+    assert peak['normal'] == 3
+    # the normal tasks are not starved by the priority ones
+    assert log.index(('start', 'normal')) < log.index(('end', 'capped'))
+    assert all(s.done for s in queue.get_task_states())
+
+
+class FailingTask(Task):
+    async def run(self):
+        raise ValueError('failed')
+
+
+async def test_task_metrics(empty_project: Project):
+    queue = empty_project.task_queue
+    await queue.onFinish.wait()
+    log = []
+    for _ in range(4):
+        queue.add_task(SleepTask('sleep', False, log))
+    queue.add_task(FailingTask())
+    await queue.onFinish.wait()
+
+    stats = queue.metrics.get_stats()
+    sleep = stats['sleep']
+    assert (sleep['waiting'], sleep['running'], sleep['done'], sleep['failed']) == (0, 0, 4, 0)
+    assert sleep['run_time']['count'] == 4 and sleep['run_time']['mean'] >= 0.01
+    assert sleep['wait_time']['count'] == 4
+    assert sleep['throughput']['10'] == 4 / 10
+    assert sleep['eta'] == 0
+    assert stats['FailingTask']['failed'] == 1
+
+    text = to_prometheus(empty_project.id, stats, empty_project.db.images.cache.get_stats())
+    lines = text.splitlines()
+    assert f'panoptic_tasks_done_total{{project="{empty_project.id}",kind="sleep"}} 4' in lines
+    assert f'panoptic_task_run_seconds_bucket{{project="{empty_project.id}",kind="sleep",le="+Inf"}} 4' in lines
+    assert f'panoptic_tasks_failed_total{{project="{empty_project.id}",kind="FailingTask"}} 1' in lines
+    assert all(line.startswith('#') or len(line.split(' ')) == 2 for line in lines)
+
+
+class BlockedTask(Task):
+    def __init__(self, key: str, log: list):
+        super().__init__()
+        self.key = key
+        self.log = log
+
+    async def run(self):
+        self.log.append(('start', self.key))
+        await asyncio.Event().wait()
+
+    async def on_cancel(self):
+        self.log.append(('cancel', self.key))
+
+
+async def test_task_queue_pause_cancel(empty_project: Project):
+    queue = empty_project.task_queue
+    await queue.onFinish.wait()
+    log = []
+
+    # the tasks of a paused key wait, the other keys go on
+    queue.pause('paused')
+    for _ in range(3):
+        queue.add_task(SleepTask('paused', False, log))
+    queue.add_task(SleepTask('other', False, log))
+    await asyncio.sleep(0.05)
+    assert ('start', 'paused') not in log and ('end', 'other') in log
+    assert next(s for s in queue.get_task_states() if s.id == 'paused').paused
+    assert queue.count_waiting('paused') == 3
+
+    queue.resume('paused')
+    await queue.onFinish.wait()
+    assert log.count(('end', 'paused')) == 3
+
+    # cancel drops the waiting tasks and stops the running ones
+    log.clear()
+    queue.set_limit('BlockedTask', 2)
+    for _ in range(5):
+        queue.add_task(BlockedTask('blocked', log))
+    await asyncio.sleep(0)
+    assert log == [('start', 'blocked')] * 2
+    queue.cancel('blocked')
+    await asyncio.wait_for(queue.onFinish.wait(), 1)
+    assert log[2:] == [('cancel', 'blocked')] * 2
+    state = next(s for s in queue.get_task_states() if s.id == 'blocked')
+    assert state.done and state.remain == 0 and state.computing == 0
+    stats = queue.metrics.get_stats()['BlockedTask']
+    assert (stats['waiting'], stats['running'], stats['cancelled']) == (0, 0, 5)
+
+    # the queue is finished when only paused tasks are left
+    queue.set_limit('held', 0)
+    queue.add_task(SleepTask('held', False, log))
+    assert not queue.onFinish.is_set()
+    queue.pause('held')
+    assert queue.onFinish.is_set()
+    queue.set_limit('held', 1)
+    queue.resume('held')
+    assert not queue.onFinish.is_set()
+    await asyncio.wait_for(queue.onFinish.wait(), 1)
+    assert ('end', 'held') in log
+
+
+async def test_task_queue_restored(empty_project: Project, image_dir: str):
+    files = [str(f) for f in sorted(Path(image_dir).rglob('*.png'))[:3]]
+    folder_id = (await empty_project.db.add_folders([(image_dir, 'images', None)]))[image_dir]
+    queue = empty_project.task_queue
+    # the first file was written before the server stopped, its task is still in the table
+    done = ImportInstanceTask(5, files[0], folder_id)
+    done.set_project(empty_project)
+    await done.run()
+
+    queue.set_limit('ImportInstanceTask', 0)
+    for i, file in enumerate(files):
+        queue.add_task(ImportInstanceTask(5, file, folder_id))
+    await queue.checkpoint()
+    assert len(await empty_project.db.get_pending_tasks()) == 3
+
+    project_path = empty_project.base_path
+    await empty_project.close()
+    project = Project(project_path, [], name='test_project')
+    await project.start()
+    await project.wait_full_start()
+    await project.task_queue.onFinish.wait()
+
+    instances = await project.db.get_instances()
+    assert sorted(i.url for i in instances) == files
+    await project.task_queue.checkpoint()
+    assert await project.db.get_pending_tasks() == []
+    await project.close()
+
+
+async def test_import_folder_restored_mid_scan(empty_project: Project, image_dir: str, monkeypatch):
+    monkeypatch.setattr(import_folder_task, 'scan_chunk_size', 1)
+    monkeypatch.setattr(import_folder_task, 'import_backlog', 2)
+    queue = empty_project.task_queue
+    # the server stops while the scan waits for the queued imports
+    queue.set_limit('ImportInstanceTask', 0)
+    await empty_project.import_folder(image_dir)
+    while queue.count_waiting('ImportInstanceTask') < 2:
+        await asyncio.sleep(0.01)
+    queued = queue.count_waiting('ImportInstanceTask')
+    assert queued < 10
+
+    project_path = empty_project.base_path
+    await empty_project.close()
+    project = Project(project_path, [], name='test_project')
+    await project.start()
+    await project.wait_full_start()
+    await project.task_queue.onFinish.wait()
+
+    # the scan starts again but the files of the restored imports are not queued twice
+    instances = await project.db.get_instances()
+    assert len(instances) == 10
+    assert len({i.url for i in instances}) == 10
+    await project.close()
+
+
+async def test_cancel_import_stops_scan(empty_project: Project, image_dir: str, monkeypatch):
+    monkeypatch.setattr(import_folder_task, 'scan_chunk_size', 1)
+    monkeypatch.setattr(import_folder_task, 'import_backlog', 2)
+    queue = empty_project.task_queue
+    queue.set_limit('ImportInstanceTask', 0)
+    await empty_project.import_folder(image_dir)
+    while queue.count_waiting('ImportInstanceTask') < 2:
+        await asyncio.sleep(0.01)
+
+    # cancelling the imports cancels the scan that queues them, it doesn't queue more once room is made
+    key = next(s.id for s in queue.get_task_states() if s.id.startswith('ImportInstanceTask'))
+    queue.cancel(key)
+    await asyncio.wait_for(queue.onFinish.wait(), 1)
+    assert queue.count_waiting('ImportInstanceTask') == 0
+    states = {s.id: s for s in queue.get_task_states()}
+    assert states[key].done and states[key].remain == 0
+    assert states[key.replace('ImportInstanceTask', 'ImportFolderTask')].done
+    assert await empty_project.db.get_instances() == []
@@ -31,6 +31,8 @@ export const useDataStore = defineStore('dataStore', () => {
     const baseUrl = shallowRef('')
     const maps = shallowRef<MapIndex>({})
     const atlas = ref<ImageAtlas>()
+    // image version of the project, the image urls carrying it are cached by the browser without revalidation
+    const imageVersion = shallowRef('')
 
     const history = ref<CommitHistory>({ undo: [], redo: [] })
     const sha1Index = shallowRef<Sha1ToInstances>({})
@@ -120,6 +122,24 @@ export const useDataStore = defineStore('dataStore', () => {
     }
 
 
+    function setImageUrls(img: Instance, projectId: number) {
+        const version = imageVersion.value ? `?v=${imageVersion.value}` : ''
+        img.urlSmall = `${SERVER_PREFIX}/projects/${projectId}/image/small/${img.sha1}${version}`
+        img.urlMedium = `${SERVER_PREFIX}/projects/${projectId}/image/medium/${img.sha1}${version}`
+        img.urlLarge = `${SERVER_PREFIX}/projects/${projectId}/image/large/${img.sha1}${version}`
+        img.urlRaw = `${SERVER_PREFIX}/projects/${projectId}/image/raw/${img.sha1}${version}`
+    }
+
+    function setImageVersion(version: string) {
+        if (version == imageVersion.value) return
+        imageVersion.value = version
+        const projectId = usePanopticStore().clientState.connectedProject
+        for (let img of Object.values(instances.value)) {
+            setImageUrls(img, projectId)
+        }
+        triggerRef(instances)
+    }
+
     function importInstances(toImport: Instance[]) {
         const panopticStore = usePanopticStore()
         const projectId = panopticStore.clientState.connectedProject
@@ -127,10 +147,7 @@ export const useDataStore = defineStore('dataStore', () => {
         for (let img of toImport) {
             const values = getComputedValues(img)
 
-            img.urlSmall = `${SERVER_PREFIX}/projects/${projectId}/image/small/${img.sha1}`
-            img.urlMedium = `${SERVER_PREFIX}/projects/${projectId}/image/medium/${img.sha1}`
-            img.urlLarge = `${SERVER_PREFIX}/projects/${projectId}/image/large/${img.sha1}`
-            img.urlRaw = `${SERVER_PREFIX}/projects/${projectId}/image/raw/${img.sha1}`
+            setImageUrls(img, projectId)
 
             let res = computeContainerRatio(img)
             img.containerRatio = res.ratio
@@ -406,6 +423,7 @@ export const useDataStore = defineStore('dataStore', () => {
         sha1Index.value = {}
         vectorTypes.value = []
         vectorStats.value = { count: {}, sha1Count: 0 }
+        imageVersion.value = ''
 
         onChange.clear()
         dirtyInstances.clear()
@@ -821,7 +839,7 @@ export const useDataStore = defineStore('dataStore', () => {
         applyCommit, sendCommit, undo, redo, onUndo,
         addPropertyGroup, propertyGroups, propertyGroupsList, updatePropertyGroup, deletePropertyGroup,
         updateVectorTypes, deleteVectorType, updateVectorStats,
-        clear,
+        clear, setImageVersion,
         importFolders, importVectorTypes, applyMultipleCommits, baseImgUrl, baseUrl, loadMaps, maps, loadMapData, hasMaps, deleteMap, hasAtlas, atlas, loadAtlas
     }
 
@@ -779,6 +779,7 @@ export interface ProjectState {
     tasks: TaskState[]
     plugins: PluginDescription[]
     settings: ProjectSettings
+    imageVersion: string
 }
 
 export interface TextQuery {
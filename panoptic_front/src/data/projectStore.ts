@@ -48,6 +48,7 @@ export const useProjectStore = defineStore('projectStore', () => {
         const projectId = panoptic.clientState.connectedProject
         if (isNaN(projectId) || projectId < 0) return
         state.value = await apiGetProjectState()
+        dataStore.setImageVersion(state.value.imageVersion)
         await loadUiState()
 
         if (localStorage.getItem('tutorialFinished') != 'true') {
@@ -66,6 +67,7 @@ export const useProjectStore = defineStore('projectStore', () => {
         state.value = st
         console.log('import state', st)
         if (state.value) {
+            dataStore.setImageVersion(state.value.imageVersion)
             actionStore.init()
         }
 
@@ -162,8 +164,12 @@ export const useProjectStore = defineStore('projectStore', () => {
         if (!state.value) return
         state.value.tasks = tasks
     }
-    function importSettings(settings: ProjectSettings) {
+    async function importSettings(settings: ProjectSettings) {
         state.value.settings = settings
+        // the image version follows the thumbnail settings
+        const st = await apiGetProjectState()
+        state.value.imageVersion = st.imageVersion
+        dataStore.setImageVersion(st.imageVersion)
     }
 
     return {